@@ -0,0 +1,456 @@
+"""
+Local OpenAI-compatible stub for benchmarks.
+
+Serves `POST /v1/chat/completions` with answers in the JSON shape asked by the `StructuredOutputParser`
+format instructions of the prompt (streamed as server-sent events when the request has `"stream": true`), and `POST /v1/images/generations` with PNG images (as b64_json or
+as a URL served by `GET /images/<id>.png`). Every request waits a latency drawn from a configurable
+distribution, so the pipeline can be measured without spending money or hitting the live API.
+The files and batches endpoints of the Batch API (`POST /v1/files`, `GET /v1/files/<id>/content`,
+`POST /v1/batches`, `GET /v1/batches/<id>` and `POST /v1/batches/<id>/cancel`) are served too: a batch
+answers every line of its input file with the chat completions above, after `--batch-latency`.
+With `--chat-rpm` / `--image-rpm` the requests over the limit of the last minute are answered with 429,
+and every answer carries the x-ratelimit-* headers of the live API.
+The usage of the chat completions reports `prompt_tokens_details.cached_tokens` as the prompt caching of
+the live API does: the longest prefix already seen, from 1024 tokens in steps of 128 (4 characters a token).
+
+Latency specs: `fixed:S`, `uniform:A,B`, `normal:MEAN,SD`, `lognormal:MEDIAN,SIGMA` and `exp:MEAN`, in seconds.
+
+Usage:
+    python benchmarks/fake_openai.py [--port 8765] [--chat-latency lognormal:2,0.5] [--image-latency fixed:8]
+
+Point the clients to it with OPENAI_BASE_URL / OPENAI_API_BASE = http://127.0.0.1:<port>/v1.
+"""
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from email.parser import BytesParser
+from email.policy import HTTP
+from typing import Callable, Dict, Any, Iterator, List, Tuple
+import argparse
+import base64
+import hashlib
+import json
+import math
+import random
+import re
+import struct
+import threading
+import time
+import uuid
+import zlib
+
+# "key": type  // description, as written by StructuredOutputParser.get_format_instructions
+# prompt caching of the live API: prefixes from 1024 tokens, in steps of 128 tokens
+prompt_cache_min_tokens = 1024
+prompt_cache_step_tokens = 128
+chars_per_token = 4
+format_key_pattern = re.compile(r'"(\w+)": (string|int|integer|float|number|bool|boolean)\s+//')
+words = ("el drac va volar sobre el bosc i la lluna brillava mentre els amics cantaven una cançó "
+         "de colors que feia riure tothom a la vora del riu").split()
+
+def parse_latency(spec:str) -> Callable[[], float]:
+    """
+    Returns a function that draws a latency in seconds from the distribution of the spec.
+    """
+    name, _, values = spec.partition(":")
+    args = [float(value) for value in values.split(",") if value.strip()]
+    name = name.strip().lower()
+    if name == "fixed":
+        return lambda: args[0]
+    if name == "uniform":
+        return lambda: random.uniform(args[0], args[1])
+    if name == "normal":
+        return lambda: max(0.0, random.gauss(args[0], args[1]))
+    if name == "lognormal":
+        return lambda: random.lognormvariate(math.log(args[0]), args[1])
+    if name in ("exp", "exponential"):
+        return lambda: random.expovariate(1 / args[0]) if args[0] > 0 else 0.0
+    raise ValueError(f"Unknown latency distribution {spec}")
+
+def png_image(width:int, height:int) -> bytes:
+    """
+    A white RGB PNG with a black frame, built with zlib only.
+    """
+    white = b"\xff\xff\xff" * width
+    framed = b"\x00\x00\x00" * 4 + b"\xff\xff\xff" * (width - 8) + b"\x00\x00\x00" * 4
+    black = b"\x00\x00\x00" * width
+    rows = []
+    for y in range(height):
+        row = black if y < 4 or y >= height - 4 else framed if width > 8 else white
+        rows.append(b"\x00" + row)
+    raw = zlib.compress(b"".join(rows), 9)
+
+    def chunk(kind:bytes, data:bytes) -> bytes:
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff)
+
+    header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", raw) + chunk(b"IEND", b"")
+
+def sentence(number_of_words:int) -> str:
+    return " ".join(random.choice(words) for _ in range(number_of_words)).capitalize() + "."
+
+def answer_for(keys:List[Tuple[str, str]], words_per_page:int) -> Dict[str, Any]:
+    """
+    Builds an answer with a plausible value for every key of the format instructions.
+    """
+    answer = {}
+    for key, kind in keys:
+        if kind in ("int", "integer"):
+            answer[key] = 0
+        elif kind in ("float", "number"):
+            answer[key] = 0.0
+        elif kind in ("bool", "boolean"):
+            answer[key] = True
+        elif key == "title":
+            answer[key] = sentence(4)[:-1]
+        elif key.startswith("question_"):
+            answer[key] = sentence(8)[:-1] + "?"
+        elif key.startswith(("prompt_image_", "description_image_")):
+            answer[key] = "Black and white line art for coloring. " + sentence(20)
+        else:
+            answer[key] = sentence(words_per_page)
+    return answer
+
+class FakeOpenAI:
+    """
+    The stub server. It runs in a background thread, `url` is the base URL for the clients.
+    """
+    def __init__(self, host:str = "127.0.0.1", port:int = 0,
+                 chat_latency:str = "fixed:0", image_latency:str = "fixed:0",
+                 image_size:int = 1024, words_per_page:int = 60,
+                 chat_rpm:int = 0, image_rpm:int = 0, batch_latency:str = "fixed:0"):
+        self.chat_latency = parse_latency(chat_latency)
+        self.image_latency = parse_latency(image_latency)
+        self.image = png_image(image_size, image_size)
+        self.words_per_page = words_per_page
+        self.batch_latency = parse_latency(batch_latency)
+        self.stats = {"chat": 0, "images": 0, "downloads": 0, "errors": 0, "rate_limited": 0,
+                      "files": 0, "batches": 0, "prompt_tokens": 0, "cached_tokens": 0}
+        self._prompt_prefixes: set = set()
+        self.files: Dict[str, Dict[str, Any]] = {}
+        self.batches: Dict[str, Dict[str, Any]] = {}
+        self.rpm = {"chat": chat_rpm, "images": image_rpm}
+        self._requests: Dict[str, List[float]] = {"chat": [], "images": []}
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def count(self, kind:str) -> None:
+        with self._lock:
+            self.stats[kind] += 1
+
+    def rate_limit(self, kind:str) -> Tuple[bool, Dict[str, str]]:
+        """
+        Counts a request in the window of the last minute. Returns whether it is over the limit and
+        the rate limit headers of the answer (none without a limit).
+        """
+        limit = self.rpm[kind]
+        if not limit:
+            return False, {}
+        with self._lock:
+            now = time.monotonic()
+            window = self._requests[kind] = [t for t in self._requests[kind] if now - t < 60]
+            limited = len(window) >= limit
+            if limited:
+                self.stats["rate_limited"] += 1
+            else:
+                window.append(now)
+            reset = 60 - (now - window[0]) if window else 0.0
+        headers = {"x-ratelimit-limit-requests": str(limit),
+                   "x-ratelimit-remaining-requests": str(max(0, limit - len(window))),
+                   "x-ratelimit-reset-requests": f"{reset:.3f}s"}
+        if limited:
+            headers["retry-after"] = f"{max(1, math.ceil(reset))}"
+        return limited, headers
+
+    def chat_content(self, body:Dict[str, Any]) -> Tuple[str, int, int]:
+        prompt = "\n".join(str(message.get("content", "")) for message in body.get("messages", []))
+        keys = list(dict.fromkeys(format_key_pattern.findall(prompt)))
+        content = "```json\n" + json.dumps(answer_for(keys, self.words_per_page), ensure_ascii=False) + "\n```"
+        return content, max(1, len(prompt) // 4), max(1, len(content) // 4)
+
+    def cached_tokens(self, body:Dict[str, Any]) -> int:
+        """
+        Returns the tokens of the longest prefix of the prompt seen in a previous request (0 under 1024
+        tokens) and remembers the prefixes of this one.
+        """
+        prompt = "\n".join(str(message.get("content", "")) for message in body.get("messages", []))
+        digests = [hashlib.sha1(prompt[:tokens * chars_per_token].encode("utf-8")).digest()
+                   for tokens in range(prompt_cache_min_tokens, len(prompt) // chars_per_token + 1,
+                                       prompt_cache_step_tokens)]
+        with self._lock:
+            cached = 0
+            for i, digest in enumerate(digests):
+                if digest not in self._prompt_prefixes:
+                    break
+                cached = prompt_cache_min_tokens + i * prompt_cache_step_tokens
+            self._prompt_prefixes.update(digests)
+        return cached
+
+    def chat_completion(self, body:Dict[str, Any], wait:bool = True) -> Dict[str, Any]:
+        content, prompt_tokens, completion_tokens = self.chat_content(body)
+        cached_tokens = self.cached_tokens(body)
+        with self._lock:
+            self.stats["prompt_tokens"] += prompt_tokens
+            self.stats["cached_tokens"] += cached_tokens
+        if wait:
+            time.sleep(self.chat_latency())
+        return {"id": f"chatcmpl-{uuid.uuid4().hex}", "object": "chat.completion", "created": int(time.time()),
+                "model": body.get("model", "fake"), "system_fingerprint": None,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content},
+                             "logprobs": None, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                          "total_tokens": prompt_tokens + completion_tokens,
+                          "prompt_tokens_details": {"cached_tokens": cached_tokens}}}
+
+    def chat_completion_chunks(self, body:Dict[str, Any], chunk_size:int = 16) -> Iterator[Tuple[float, Dict[str, Any]]]:
+        """
+        The answer split in chunks of `chunk_size` characters, with the wait before each one: a tenth of the
+        latency before the first chunk and the rest spread over the others, as a model writing the answer.
+        """
+        content, _, _ = self.chat_content(body)
+        latency = self.chat_latency()
+        pieces = [content[i:i + chunk_size] for i in range(0, len(content), chunk_size)]
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        created = int(time.time())
+
+        def chunk(delta:Dict[str, Any], finish_reason:str|None) -> Dict[str, Any]:
+            return {"id": completion_id, "object": "chat.completion.chunk", "created": created,
+                    "model": body.get("model", "fake"), "system_fingerprint": None,
+                    "choices": [{"index": 0, "delta": delta, "logprobs": None, "finish_reason": finish_reason}]}
+
+        yield latency * 0.1, chunk({"role": "assistant", "content": ""}, None)
+        for piece in pieces:
+            yield latency * 0.9 / max(1, len(pieces)), chunk({"content": piece}, None)
+        yield 0.0, chunk({}, "stop")
+
+    def upload_file(self, content_type:str, body:bytes) -> Dict[str, Any]:
+        """
+        Stores the file of a multipart/form-data upload (the `file` and `purpose` fields of files.create).
+        """
+        message = BytesParser(policy=HTTP).parsebytes(f"Content-Type: {content_type}\r\n\r\n".encode("ascii") + body)
+        fields = {}
+        for part in message.iter_parts():
+            fields[part.get_param("name", header="content-disposition")] = part
+        upload = fields["file"]
+        content = upload.get_payload(decode=True)
+        item = {"id": f"file-{uuid.uuid4().hex}", "object": "file", "bytes": len(content),
+                "created_at": int(time.time()), "filename": upload.get_filename() or "upload.jsonl",
+                "purpose": fields["purpose"].get_payload(decode=True).decode("utf-8") if "purpose" in fields else "batch",
+                "status": "processed"}
+        with self._lock:
+            self.files[item["id"]] = {"meta": item, "content": content}
+        return item
+
+    def add_file(self, content:bytes, filename:str, purpose:str) -> str:
+        item = {"id": f"file-{uuid.uuid4().hex}", "object": "file", "bytes": len(content),
+                "created_at": int(time.time()), "filename": filename, "purpose": purpose, "status": "processed"}
+        with self._lock:
+            self.files[item["id"]] = {"meta": item, "content": content}
+        return item["id"]
+
+    def create_batch(self, body:Dict[str, Any]) -> Dict[str, Any]:
+        if body.get("input_file_id") not in self.files:
+            raise KeyError(f"Unknown file {body.get('input_file_id')}")
+        now = int(time.time())
+        batch = {"id": f"batch_{uuid.uuid4().hex}", "object": "batch", "endpoint": body.get("endpoint"),
+                 "errors": None, "input_file_id": body["input_file_id"],
+                 "completion_window": body.get("completion_window", "24h"), "status": "validating",
+                 "output_file_id": None, "error_file_id": None, "created_at": now, "in_progress_at": None,
+                 "expires_at": now + 24 * 3600, "finalizing_at": None, "completed_at": None, "failed_at": None,
+                 "expired_at": None, "cancelling_at": None, "cancelled_at": None,
+                 "request_counts": {"total": 0, "completed": 0, "failed": 0}, "metadata": body.get("metadata")}
+        with self._lock:
+            self.batches[batch["id"]] = batch
+        threading.Thread(target=self.run_batch, args=(batch["id"],), daemon=True).start()
+        return dict(batch)
+
+    def run_batch(self, batch_id:str) -> None:
+        """
+        Answers every line of the input file of a batch after the batch latency, as the Batch API does.
+        """
+        batch = self.batches[batch_id]
+        lines = [json.loads(line) for line in self.files[batch["input_file_id"]]["content"].decode("utf-8").splitlines()
+                 if line.strip()]
+        with self._lock:
+            batch.update(status="in_progress", in_progress_at=int(time.time()))
+            batch["request_counts"]["total"] = len(lines)
+        latency = self.batch_latency()
+        time.sleep(latency)
+        if batch["status"] != "in_progress":
+            return
+        outputs, errors = [], []
+        for line in lines:
+            item = {"id": f"batch_req_{uuid.uuid4().hex}", "custom_id": line.get("custom_id")}
+            if line.get("url") != "/v1/chat/completions":
+                errors.append({**item, "response": None,
+                               "error": {"code": "invalid_url", "message": f"Unsupported url {line.get('url')}"}})
+                continue
+            completion = self.chat_completion(line.get("body", {}), wait=False)
+            outputs.append({**item, "response": {"status_code": 200, "request_id": uuid.uuid4().hex,
+                                                 "body": completion}, "error": None})
+
+        def jsonl(items:List[Dict[str, Any]]) -> bytes:
+            return "".join(json.dumps(i, ensure_ascii=False) + "\n" for i in items).encode("utf-8")
+
+        output_file_id = self.add_file(jsonl(outputs), f"{batch_id}_output.jsonl", "batch_output") if outputs else None
+        error_file_id = self.add_file(jsonl(errors), f"{batch_id}_error.jsonl", "batch_output") if errors else None
+        with self._lock:
+            now = int(time.time())
+            batch.update(status="completed", output_file_id=output_file_id, error_file_id=error_file_id,
+                         finalizing_at=now, completed_at=now)
+            batch["request_counts"].update(completed=len(outputs), failed=len(errors))
+
+    def cancel_batch(self, batch_id:str) -> Dict[str, Any]:
+        with self._lock:
+            batch = self.batches[batch_id]
+            if batch["status"] in ("validating", "in_progress"):
+                batch.update(status="cancelled", cancelling_at=int(time.time()), cancelled_at=int(time.time()))
+            return dict(batch)
+
+    def image_generation(self, body:Dict[str, Any], host:str) -> Dict[str, Any]:
+        time.sleep(self.image_latency())
+        item = {"revised_prompt": body.get("prompt", "")}
+        if body.get("response_format") == "url":
+            item["url"] = f"http://{host}/images/{uuid.uuid4().hex}.png"
+        else:
+            item["b64_json"] = base64.b64encode(self.image).decode("ascii")
+        return {"created": int(time.time()), "data": [item] * int(body.get("n", 1) or 1)}
+
+    def _handler(self) -> type:
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def send_json(self, status:int, payload:Dict[str, Any], headers:Dict[str, str]|None = None) -> None:
+                data = json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def send_stream(self, chunks:Iterator[Tuple[float, Dict[str, Any]]],
+                            headers:Dict[str, str]|None = None) -> None:
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.end_headers()
+
+                def write(data:bytes) -> None:
+                    self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+                    self.wfile.flush()
+
+                for wait, chunk in chunks:
+                    time.sleep(wait)
+                    write(b"data: " + json.dumps(chunk, ensure_ascii=False).encode("utf-8") + b"\n\n")
+                write(b"data: [DONE]\n\n")
+                self.wfile.write(b"0\r\n\r\n")
+                self.wfile.flush()
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                try:
+                    raw = self.rfile.read(length)
+                    path = self.path.rstrip("/")
+                    if path.endswith("/v1/files"):
+                        fake.count("files")
+                        return self.send_json(200, fake.upload_file(self.headers.get("Content-Type", ""), raw))
+                    if path.endswith("/v1/batches"):
+                        fake.count("batches")
+                        return self.send_json(200, fake.create_batch(json.loads(raw or b"{}")))
+                    if "/v1/batches/" in path and path.endswith("/cancel"):
+                        return self.send_json(200, fake.cancel_batch(path.split("/")[-2]))
+                    body = json.loads(raw or b"{}")
+                    kind = ("chat" if self.path.endswith("/chat/completions")
+                            else "images" if self.path.endswith("/images/generations") else None)
+                    limited, headers = fake.rate_limit(kind) if kind is not None else (False, {})
+                    if limited:
+                        self.send_json(429, {"error": {"message": "Rate limit reached for requests",
+                                                       "type": "requests", "code": "rate_limit_exceeded"}},
+                                       headers)
+                    elif kind == "chat" and body.get("stream"):
+                        fake.count("chat")
+                        self.send_stream(fake.chat_completion_chunks(body), headers)
+                    elif kind == "chat":
+                        fake.count("chat")
+                        self.send_json(200, fake.chat_completion(body), headers)
+                    elif kind == "images":
+                        fake.count("images")
+                        self.send_json(200, fake.image_generation(body, self.headers.get("Host", "")), headers)
+                    else:
+                        self.send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+                except Exception as e:
+                    fake.count("errors")
+                    self.send_json(500, {"error": {"message": str(e), "type": "server_error"}})
+
+            def do_GET(self):
+                if self.path.startswith("/images/"):
+                    fake.count("downloads")
+                    self.send_response(200)
+                    self.send_header("Content-Type", "image/png")
+                    self.send_header("Content-Length", str(len(fake.image)))
+                    self.end_headers()
+                    self.wfile.write(fake.image)
+                elif self.path.rstrip("/").endswith("/stats"):
+                    self.send_json(200, dict(fake.stats))
+                elif "/v1/files/" in self.path and self.path.endswith("/content"):
+                    item = fake.files.get(self.path.split("/")[-2])
+                    if item is None:
+                        return self.send_json(404, {"error": {"message": f"Unknown file {self.path}"}})
+                    self.send_response(200)
+                    self.send_header("Content-Type", "application/octet-stream")
+                    self.send_header("Content-Length", str(len(item["content"])))
+                    self.end_headers()
+                    self.wfile.write(item["content"])
+                elif "/v1/batches/" in self.path:
+                    batch = fake.batches.get(self.path.rstrip("/").split("/")[-1])
+                    if batch is None:
+                        return self.send_json(404, {"error": {"message": f"Unknown batch {self.path}"}})
+                    with fake._lock:
+                        self.send_json(200, json.loads(json.dumps(batch)))
+                else:
+                    self.send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+
+        return Handler
+
+    def start(self) -> "FakeOpenAI":
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--chat-latency", default="fixed:0", help="Latency of a chat completion, for example lognormal:2,0.5")
+    parser.add_argument("--image-latency", default="fixed:0", help="Latency of an image, for example fixed:8")
+    parser.add_argument("--image-size", type=int, default=1024, help="Width and height of the images in pixels")
+    parser.add_argument("--words-per-page", type=int, default=60)
+    parser.add_argument("--chat-rpm", type=int, default=0, help="Chat requests per minute before 429, 0 without limit")
+    parser.add_argument("--image-rpm", type=int, default=0, help="Image requests per minute before 429, 0 without limit")
+    parser.add_argument("--batch-latency", default="fixed:0", help="Time a batch takes to complete, for example fixed:30")
+    args = parser.parse_args()
+    fake = FakeOpenAI(args.host, args.port, args.chat_latency, args.image_latency, args.image_size, args.words_per_page,
+                      args.chat_rpm, args.image_rpm, args.batch_latency)
+    print(f"Fake OpenAI server on {fake.url}")
+    try:
+        fake.server.serve_forever()
+    except KeyboardInterrupt:
+        fake.stop()
@@ -0,0 +1,121 @@
+"""
+Import time benchmark.
+
+Runs `python -X importtime` in a fresh process for every entry point and module of the project and
+appends one record per run to `benchmarks/import_time.jsonl`, so the import time can be followed
+from commit to commit. The record of every target keeps its cumulative import time, the slowest
+imports below it and the time of the process. It also measures `main.py --help`.
+
+Usage:
+    python benchmarks/import_time.py [--repeat 5] [--top 10] [--no-save]
+"""
+from pathlib import Path
+from datetime import datetime as dt
+from typing import Dict, Any, List
+import argparse
+import json
+import platform
+import re
+import statistics
+import subprocess
+import sys
+import time
+
+root_path = Path(__file__).parent.parent
+history_path = Path(__file__).parent / "import_time.jsonl"
+targets = ["main", "read_configuration", "prepare_prompt", "history_generator", "image_generator",
+           "pdf_generator", "pipeline", "batch_runner"]
+importtime_pattern = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)")
+
+def parse_importtime(stderr:str) -> List[Dict[str, Any]]:
+    """
+    Parses the `-X importtime` output into (module, self_us, cumulative_us, depth) rows.
+    """
+    rows = []
+    for line in stderr.splitlines():
+        match = importtime_pattern.match(line)
+        if match:
+            rows.append({"module": match.group(4),
+                         "self_us": int(match.group(1)),
+                         "cumulative_us": int(match.group(2)),
+                         "depth": (len(match.group(3)) - 1) // 2})
+    return rows
+
+def measure_import(module:str, top:int) -> Dict[str, Any]:
+    code = (f"import sys; sys.path[:0] = [{str(root_path / 'src')!r}, {str(root_path / 'logging')!r}, "
+            f"{str(root_path)!r}]; import {module}")
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code],
+                            capture_output=True, text=True, cwd=root_path)
+    wall = time.perf_counter() - start
+    rows = parse_importtime(result.stderr)
+    target = [row for row in rows if row["module"] == module]
+    measure = {"wall_s": round(wall, 4),
+               "cumulative_us": target[-1]["cumulative_us"] if target else None,
+               "slowest": [{"module": row["module"], "cumulative_us": row["cumulative_us"]}
+                           for row in sorted(rows, key=lambda row: row["cumulative_us"], reverse=True)
+                           if row["module"] != module][:top]}
+    if result.returncode != 0:
+        measure["error"] = result.stderr.strip().splitlines()[-1] if result.stderr.strip() else "failed"
+    return measure
+
+def measure_help() -> float:
+    start = time.perf_counter()
+    subprocess.run([sys.executable, str(root_path / "main.py"), "--help"],
+                   capture_output=True, text=True, cwd=root_path)
+    return time.perf_counter() - start
+
+def git_commit() -> str|None:
+    result = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, cwd=root_path)
+    return result.stdout.strip() or None
+
+def run(repeat:int = 5, top:int = 10) -> Dict[str, Any]:
+    """
+    Measures every target `repeat` times and keeps the median, the slowest imports come from the median run.
+    """
+    record = {"date": dt.now().isoformat(timespec="seconds"),
+              "commit": git_commit(),
+              "python": platform.python_version(),
+              "repeat": repeat,
+              "targets": {}}
+    for module in targets:
+        measures = [measure_import(module, top) for _ in range(repeat)]
+        measures = [m for m in measures if m["cumulative_us"] is not None] or measures
+        measures.sort(key=lambda m: m["cumulative_us"] or 0)
+        median = measures[len(measures) // 2]
+        median["wall_s"] = round(statistics.median(m["wall_s"] for m in measures), 4)
+        record["targets"][module] = median
+    record["main_help_s"] = round(statistics.median(measure_help() for _ in range(repeat)), 4)
+    return record
+
+def previous_record() -> Dict[str, Any]|None:
+    if not history_path.exists():
+        return None
+    lines = [line for line in history_path.read_text(encoding="utf-8").splitlines() if line.strip()]
+    return json.loads(lines[-1]) if lines else None
+
+def report(record:Dict[str, Any], previous:Dict[str, Any]|None) -> None:
+    print(f"{'target':<20}{'import ms':>12}{'previous':>12}{'process s':>12}")
+    for module, measure in record["targets"].items():
+        current = measure["cumulative_us"]
+        before = None
+        if previous is not None:
+            before = previous["targets"].get(module, {}).get("cumulative_us")
+        current_ms = f"{current / 1000:.1f}" if current is not None else "error"
+        before_ms = f"{before / 1000:.1f}" if before is not None else "-"
+        print(f"{module:<20}{current_ms:>12}{before_ms:>12}{measure['wall_s']:>12.3f}")
+        if "error" in measure:
+            print(f"    {measure['error']}")
+    print(f"main.py --help: {record['main_help_s']:.3f} s")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=5, help="Number of runs per target, the median is kept")
+    parser.add_argument("--top", type=int, default=10, help="Number of slowest imports kept per target")
+    parser.add_argument("--no-save", action="store_true", help=f"Do not append the record to {history_path.name}")
+    args = parser.parse_args()
+    record = run(repeat=args.repeat, top=args.top)
+    report(record, previous_record())
+    if not args.no_save:
+        with open(history_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record) + "\n")
@@ -0,0 +1,298 @@
+"""
+End-to-end benchmark of the pipeline against the local fake OpenAI server (`fake_openai.py`).
+
+Every scenario runs `main.wrapper` (zero-shot) or `main.wrapper_review` in a fresh process, with a
+temporary configuration.ini for its number of children, pages and concurrency, and reports:
+
+- the wall time of every stage (span from its first start to its last end, and busy time summed
+  over the histories, which differ when the histories overlap),
+- the total wall time and the throughput in books per hour,
+- the peak RSS of the pipeline process and of the pdflatex processes,
+- the number of document compiles and pdflatex processes,
+- the requests served by the fake server.
+
+The lists given to --children, --pages and --concurrency are swept (every combination is run).
+A concurrency of 0 runs without --concurrent; any other value runs with --concurrent and uses it for
+LLM_CONCURRENCY and IMAGE_CONCURRENCY. --pdf-backend sweeps the PDF renderers (latex, native).
+--batch-api runs the review scenarios in the offline bulk mode (Batch API of the fake server). Results are appended to benchmarks/pipeline_benchmark.jsonl.
+
+Usage:
+    python benchmarks/pipeline_benchmark.py --mode review --children 1,2,4 --pages 4,8 --concurrency 0,4 \\
+        --pdf-backend latex,native \\
+        --chat-latency lognormal:2,0.4 --image-latency lognormal:6,0.3
+"""
+from pathlib import Path
+from datetime import datetime as dt
+from typing import Dict, Any, List
+import argparse
+import configparser
+import itertools
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+root_path = Path(__file__).parent.parent
+results_path = Path(__file__).parent / "pipeline_benchmark.jsonl"
+output_dirs = ("stories", "images", "data")
+stage_functions = {
+    "history_generator": {"llm_call_chain_for_history_generation": "candidates",
+                          "make_review": "review",
+                          "make_prompt_images_after_review": "image_prompts"},
+    "image_generator": {"generate_images_for_history": "images",
+                        "generate_images_for_history_after_review": "images"},
+    "line_art": {"line_art_for_history": "line_art"},
+    "pdf_generator": {"generate_pdf": "pdf"},
+    "pdf_native": {"generate_pdf": "pdf"},
+}
+
+def write_configuration(path:Path, children:int, pages:int, concurrency:int, questions:int = 2,
+                        llm_streaming:bool = False, batch_api:bool = False) -> None:
+    """
+    Writes a copy of configuration.ini with the number of children, pages and concurrency of the scenario.
+    """
+    config = configparser.ConfigParser()
+    config.optionxform = str
+    config.read(root_path / "configuration.ini")
+    config["childs"]["NAMES"] = ", ".join(f"Child{i}" for i in range(children))
+    config["childs"]["BIRTHDAYS"] = ", ".join("2018-01-01" for _ in range(children))
+    config["book"]["PAGES"] = str(pages)
+    config["activity"]["QUESTIONS"] = str(questions)
+    if not config.has_section("execution"):
+        config.add_section("execution")
+    if concurrency > 0:
+        config["execution"]["LLM_CONCURRENCY"] = str(concurrency)
+        config["execution"]["IMAGE_CONCURRENCY"] = str(concurrency)
+    config["execution"]["LLM_STREAMING"] = "true" if llm_streaming else "false"
+    if not config.has_section("batch_api"):
+        config.add_section("batch_api")
+    config["batch_api"]["ENABLED"] = "true" if batch_api else "false"
+    # the fake server answers the batches at once
+    config["batch_api"]["POLL_SECONDS"] = "0.2"
+    config["batch_api"]["GATHER_SECONDS"] = "0.2"
+    with open(path, "w", encoding="utf-8") as f:
+        config.write(f)
+
+class StageTimer:
+    """
+    Times the stage functions. A stage called from inside another stage (the review calls the LLM chain)
+    is counted only in the outer one.
+    """
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stages: Dict[str, Dict[str, float]] = {}
+        self.compiles = 0
+        self.latex_processes = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def wrap(self, stage:str, function):
+        timer = self
+
+        def timed(*args, **kwargs):
+            if getattr(timer._local, "stage", None) is not None:
+                return function(*args, **kwargs)
+            timer._local.stage = stage
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                end = time.perf_counter()
+                timer._local.stage = None
+                timer.record(stage, start, end)
+        return timed
+
+    def record(self, stage:str, start:float, end:float) -> None:
+        with self._lock:
+            values = self.stages.setdefault(stage, {"calls": 0, "busy_s": 0.0, "first_start": start, "last_end": end})
+            values["calls"] += 1
+            values["busy_s"] += end - start
+            values["first_start"] = min(values["first_start"], start)
+            values["last_end"] = max(values["last_end"], end)
+
+    def report(self) -> Dict[str, Dict[str, float]]:
+        return {stage: {"calls": int(values["calls"]),
+                        "busy_s": round(values["busy_s"], 3),
+                        "span_s": round(values["last_end"] - values["first_start"], 3),
+                        "start_s": round(values["first_start"] - self.start, 3)}
+                for stage, values in self.stages.items()}
+
+def instrument(timer:StageTimer) -> None:
+    """
+    Wraps the stage functions, the document compiles and the pdflatex processes of this process.
+    """
+    import importlib
+    for module_name, functions in stage_functions.items():
+        module = importlib.import_module(module_name)
+        for function_name, stage in functions.items():
+            setattr(module, function_name, timer.wrap(stage, getattr(module, function_name)))
+
+    pdf_generator = importlib.import_module("pdf_generator")
+    compile_document = pdf_generator.compile_document
+
+    def counted_compile(*args, **kwargs):
+        with timer._lock:
+            timer.compiles += 1
+        return compile_document(*args, **kwargs)
+    pdf_generator.compile_document = counted_compile
+
+    popen = subprocess.Popen
+
+    class CountedPopen(popen):
+        def __init__(self, args, *more, **kwargs):
+            command = args[0] if isinstance(args, (list, tuple)) else str(args).split()[0]
+            if "latex" in Path(str(command)).name:
+                with timer._lock:
+                    timer.latex_processes += 1
+            super().__init__(args, *more, **kwargs)
+    subprocess.Popen = CountedPopen
+
+def peak_rss_mb(who:int) -> float:
+    rss = resource.getrusage(who).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return round(rss / (1024 * 1024) if platform.system() == "Darwin" else rss / 1024, 1)
+
+def snapshot() -> Dict[str, set]:
+    return {name: set(os.listdir(root_path / name)) if (root_path / name).exists() else set()
+            for name in output_dirs}
+
+def run_scenario(scenario:Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Runs one scenario in this process. It is called in a fresh process by `main` below.
+    """
+    sys.path.insert(0, str(root_path))
+    import main
+    main.setup_paths()
+    import read_configuration as rc
+    rc.default_path = Path(scenario["configuration"])
+
+    timer = StageTimer()
+    instrument(timer)
+    before = snapshot()
+    start = time.perf_counter()
+    error = None
+    try:
+        if scenario["mode"] == "review":
+            main.wrapper_review(use_logger=False, save_data=False, concurrent=scenario["concurrency"] > 0,
+                                pdf_backend=scenario.get("pdf_backend"))
+        else:
+            main.wrapper(use_logger=False, save_data=False, concurrent=scenario["concurrency"] > 0,
+                         pdf_backend=scenario.get("pdf_backend"))
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+    total = time.perf_counter() - start
+    after = snapshot()
+    new_outputs = {name: sorted(after[name] - before[name]) for name in output_dirs}
+    pdfs = [name for name in new_outputs["stories"] if name.endswith(".pdf")]
+    result = {"total_s": round(total, 3),
+              "books": len(pdfs),
+              "books_per_hour": round(len(pdfs) / total * 3600, 1) if total > 0 else None,
+              "stages": timer.report(),
+              "compiles": timer.compiles,
+              "latex_processes": timer.latex_processes,
+              "peak_rss_mb": peak_rss_mb(resource.RUSAGE_SELF),
+              "peak_rss_latex_mb": peak_rss_mb(resource.RUSAGE_CHILDREN)}
+    if error is not None:
+        result["error"] = error
+    if not scenario.get("keep_output"):
+        for name, entries in new_outputs.items():
+            for entry in entries:
+                path = root_path / name / entry
+                shutil.rmtree(path) if path.is_dir() else path.unlink(missing_ok=True)
+    return result
+
+def run_in_process(scenario:Dict[str, Any], base_url:str) -> Dict[str, Any]:
+    env = dict(os.environ, OPENAI_API_KEY="fake-key", OPENAI_BASE_URL=base_url, OPENAI_API_BASE=base_url)
+    process = subprocess.run([sys.executable, str(Path(__file__).resolve()), "--scenario", json.dumps(scenario)],
+                             capture_output=True, text=True, env=env, cwd=root_path)
+    for line in reversed(process.stdout.splitlines()):
+        if line.startswith("RESULT "):
+            return json.loads(line[len("RESULT "):])
+    message = process.stderr.strip().splitlines()[-1] if process.stderr.strip() else f"exit code {process.returncode}"
+    return {"error": message}
+
+def print_result(record:Dict[str, Any]) -> None:
+    scenario = record["scenario"]
+    result = record["result"]
+    print(f"mode={scenario['mode']} children={scenario['children']} pages={scenario['pages']} "
+          f"concurrency={scenario['concurrency']} pdf_backend={scenario.get('pdf_backend')}")
+    if "total_s" in result:
+        print(f"  total {result['total_s']:.2f} s, {result['books']} books, {result['books_per_hour']} books/hour, "
+              f"peak RSS {result['peak_rss_mb']} MB (pdflatex {result['peak_rss_latex_mb']} MB), "
+              f"{result['compiles']} compiles, {result['latex_processes']} pdflatex processes")
+        for stage, values in result["stages"].items():
+            print(f"  {stage:<14} span {values['span_s']:>8.2f} s  busy {values['busy_s']:>8.2f} s  "
+                  f"calls {values['calls']:>3}  starts at {values['start_s']:.2f} s")
+        print(f"  fake server: {record['requests']}")
+    if "error" in result:
+        print(f"  error: {result['error']}")
+
+def split_ints(value:str) -> List[int]:
+    return [int(item) for item in value.split(",") if item.strip()]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mode", default="review", help="review, wrapper or both separated by commas")
+    parser.add_argument("--children", default="1", help="Numbers of children to sweep, for example 1,2,4")
+    parser.add_argument("--pages", default="4", help="Numbers of pages to sweep, for example 4,8")
+    parser.add_argument("--concurrency", default="0", help="Concurrency values to sweep, 0 runs without --concurrent")
+    parser.add_argument("--pdf-backend", default="latex", help="PDF backends to sweep, for example latex,native")
+    parser.add_argument("--llm-streaming", action="store_true", help="Stream the LLM answers (LLM_STREAMING)")
+    parser.add_argument("--batch-api", action="store_true", help="Send the LLM requests through the Batch API")
+    parser.add_argument("--batch-latency", default="fixed:0", help="Time a batch of the fake server takes to complete")
+    parser.add_argument("--repeat", type=int, default=1, help="Runs of every scenario")
+    parser.add_argument("--chat-latency", default="fixed:0.2", help="Latency of the chat completions")
+    parser.add_argument("--image-latency", default="fixed:0.5", help="Latency of the images")
+    parser.add_argument("--image-size", type=int, default=1024, help="Width and height of the fake images")
+    parser.add_argument("--words-per-page", type=int, default=60, help="Words of every page in the fake answers")
+    parser.add_argument("--chat-rpm", type=int, default=0, help="Chat requests per minute of the fake server before 429")
+    parser.add_argument("--image-rpm", type=int, default=0, help="Image requests per minute of the fake server before 429")
+    parser.add_argument("--keep-output", action="store_true", help="Keep the PDFs, images and data of the runs")
+    parser.add_argument("--no-save", action="store_true", help=f"Do not append the results to {results_path.name}")
+    parser.add_argument("--scenario", default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.scenario is not None:
+        print("RESULT " + json.dumps(run_scenario(json.loads(args.scenario))))
+        sys.exit(0)
+
+    sys.path.insert(0, str(Path(__file__).parent))
+    from fake_openai import FakeOpenAI
+    fake = FakeOpenAI(chat_latency=args.chat_latency, image_latency=args.image_latency,
+                      image_size=args.image_size, words_per_page=args.words_per_page,
+                      chat_rpm=args.chat_rpm, image_rpm=args.image_rpm,
+                      batch_latency=args.batch_latency).start()
+    records = []
+    try:
+        with tempfile.TemporaryDirectory() as temp:
+            sweep = itertools.product(args.mode.split(","), split_ints(args.children), split_ints(args.pages),
+                                      split_ints(args.concurrency), args.pdf_backend.split(","), range(args.repeat))
+            for mode, children, pages, concurrency, pdf_backend, _ in sweep:
+                configuration = Path(temp) / f"configuration_{children}_{pages}_{concurrency}.ini"
+                write_configuration(configuration, children, pages, concurrency, llm_streaming=args.llm_streaming,
+                                    batch_api=args.batch_api)
+                scenario = {"mode": mode.strip(), "children": children, "pages": pages,
+                            "concurrency": concurrency, "pdf_backend": pdf_backend.strip(), "configuration": str(configuration),
+                            "llm_streaming": args.llm_streaming, "batch_api": args.batch_api,
+                            "keep_output": args.keep_output}
+                requests_before = dict(fake.stats)
+                result = run_in_process(scenario, fake.url)
+                record = {"date": dt.now().isoformat(timespec="seconds"),
+                          "scenario": {k: v for k, v in scenario.items() if k != "configuration"},
+                          "latency": {"chat": args.chat_latency, "image": args.image_latency},
+                          "requests": {k: fake.stats[k] - requests_before[k] for k in fake.stats},
+                          "result": result}
+                print_result(record)
+                records.append(record)
+    finally:
+        fake.stop()
+    if not args.no_save:
+        with open(results_path, "a", encoding="utf-8") as f:
+            for record in records:
+                f.write(json.dumps(record) + "\n")
@@ -6,12 +6,8 @@ import os
 import time
 
 
-unique_id = time.strftime("%Y-%m-%dT%H-%M-%S")
-log_file_name = f"story_teller_{unique_id}.log"
-path = Path(__file__).parent / "logs"
-path.mkdir(exist_ok=True)
-path = path / log_file_name
-path = str(path.resolve())
+# the logs directory is created when a logger is configured, not at import
+logs_path = Path(__file__).parent / "logs"
 name = 'story_teller'
 maxBytes = 10485760  # 10MB
 backupCount = 5
@@ -21,7 +17,7 @@ class StdoutFilter(logging.Filter):
         return record.levelno < logging.WARNING
 
 
-def configure_logger(name:str = name, path:str=path,
+def configure_logger(name:str = name, path:str|None = None,
                      maxBytes:int=maxBytes, backupCount:int=backupCount,
                      identifier:str|None = None) -> logging.Logger:
     """
@@ -29,7 +25,7 @@ def configure_logger(name:str = name, path:str=path,
 
     Parameters:
     - name: Name of the logger.
-    - path: Path for the log file.
+    - path: Path for the log file. Defaults to logs/story_teller_<time>.log.
     - maxBytes: Maximum file size before rotation.
     - backupCount: Number of backup files to keep.
 
@@ -38,10 +34,13 @@ def configure_logger(name:str = name, path:str=path,
     """
     if identifier is not None:
         log_file_name = f"{identifier}_story_teller.log"
-        path = Path(__file__).parent / "logs"
-        path.mkdir(exist_ok=True)
-        path = path / log_file_name
-        path = str(path.resolve())
+        logs_path.mkdir(exist_ok=True)
+        path = str((logs_path / log_file_name).resolve())
+    elif path is None:
+        unique_id = time.strftime("%Y-%m-%dT%H-%M-%S")
+        log_file_name = f"story_teller_{unique_id}.log"
+        logs_path.mkdir(exist_ok=True)
+        path = str((logs_path / log_file_name).resolve())
     logging_config = {
         "version": 1,
         "disable_existing_loggers": False,
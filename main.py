@@ -1,27 +1,27 @@
 from pathlib import Path
 import sys
+from datetime import datetime as dt
+
 src_path = Path(__file__).parent / 'src'
 logging_path = Path(__file__).parent / 'logging'
-if not src_path.exists():
-    raise FileNotFoundError(f"Directory {src_path} not found")
-else:
-    sys.path.append(str(src_path))
-if not logging_path.exists():
-    raise FileNotFoundError(f"Directory {logging_path} not found")
-else:
-    sys.path.append(str(logging_path))
-import read_configuration as rc
-import prepare_prompt as pp
-import history_generator as hg
-import image_generator as ig
-import pdf_generator as pg
-import pickle
-import logger_code as lc
-from datetime import datetime as dt
+
+def setup_paths() -> None:
+    """
+    Adds the `src` and `logging` directories to sys.path. It is called by the entry points, not at import,
+    and the modules of each stage (and langchain, openai or pylatex) are imported by the function that runs it.
+    """
+    if not src_path.exists():
+        raise FileNotFoundError(f"Directory {src_path} not found")
+    if not logging_path.exists():
+        raise FileNotFoundError(f"Directory {logging_path} not found")
+    for path in (str(src_path), str(logging_path)):
+        if path not in sys.path:
+            sys.path.append(path)
 
 image_model = "dall-e-3"
 
-def wrapper(use_logger:bool = False, save_data:bool = False):
+def wrapper(use_logger:bool = False, save_data:bool = False, concurrent:bool = False,
+            pdf_backend:str|None = None):
     """
     This function generates a history, images, and a PDF.
 
@@ -29,7 +29,20 @@ def wrapper(use_logger:bool = False, save_data:bool = False):
     then calls the `generate_images_for_history` function to generate images using the history data and an image model,
     and finally calls the `generate_pdf` function to generate a PDF using the generated data.
 
+    If `concurrent` is True the requests are sent concurrently (see the `[execution]` section in configuration.ini).
+    `pdf_backend` (latex or native) overrides PDF_BACKEND of configuration.ini for this run.
     """
+    setup_paths()
+    import pickle
+    import read_configuration as rc
+    import history_generator as hg
+    import image_generator as ig
+    import line_art
+    import logger_code as lc
+    import metrics
+    from image_assets import ImageAssets
+    from pipeline import (open_llm_cache, open_image_cache, open_layout_memo, open_metrics, close_metrics,
+                          pdf_renderer, with_pdf_backend)
     identifier = dt.now().strftime("%Y_%m_%dT%H_%M_%S")
     path_save_data = Path(__file__).parent / "data"
     path_save_data.mkdir(exist_ok=True)
@@ -38,69 +51,195 @@ def wrapper(use_logger:bool = False, save_data:bool = False):
     if use_logger:
         logger = lc.configure_logger(identifier)
 
-    print("Generating story...")
-    data = hg.llm_call_chain_for_history_generation(logger=logger)
-    if save_data:
-        with open(path_save_data, "wb") as f:
-            pickle.dump(data, f)
-    print("Generating images...")
-    data = ig.generate_images_for_history(data=data, model=image_model, logger=logger)
-    if save_data:
-        with open(path_save_data, "wb") as f:
-            pickle.dump(data, f)
-    print("Generating PDF...")
-    pg.generate_pdf(data, logger=logger)
-
-def wrapper_review(use_logger:bool = False, save_data:bool = False):
+    configuration = with_pdf_backend(rc.load_configuration(), pdf_backend)
+    base_dict_values = configuration.history
+    execution_values = configuration.execution
+    llm_concurrency = execution_values.llm_concurrency if concurrent else None
+    image_concurrency = execution_values.image_concurrency if concurrent else None
+    cache_values = configuration.cache
+    llm_cache = open_llm_cache(cache_values)
+    image_cache = open_image_cache(cache_values)
+    layout_memo = open_layout_memo(cache_values)
+    assets = ImageAssets(Path(__file__).parent / "images" / identifier)
+
+    open_metrics(identifier, configuration.metrics)
+    try:
+        print("Generating story...")
+        with metrics.span("candidates"):
+            data = hg.llm_call_chain_for_history_generation(logger=logger, max_concurrency=llm_concurrency,
+                                                            base_dict_values=base_dict_values,
+                                                            cache=llm_cache if cache_values.llm_cache_candidates else None)
+        if save_data:
+            with open(path_save_data, "wb") as f:
+                pickle.dump(data, f)
+        print("Generating images...")
+        with metrics.span("images"):
+            data = ig.generate_images_for_history(data=data, model=image_model, logger=logger,
+                                                  max_concurrency=image_concurrency, cache=image_cache,
+                                                  assets=assets,
+                                                  response_format=execution_values.image_response_format,
+                                                  base_dict_values=base_dict_values)
+        if configuration.images.line_art:
+            data = line_art.line_art_for_history(data, configuration.images, logger=logger)
+        if save_data:
+            with open(path_save_data, "wb") as f:
+                pickle.dump(data, f)
+        print("Generating PDF...")
+        with metrics.span("pdf"):
+            pdf_renderer(execution_values.pdf_backend)(data, logger=logger, base_dict_values=base_dict_values,
+                                                       precompiled_format=execution_values.latex_format,
+                                                       build_dir=execution_values.latex_build_dir,
+                                                       layout_memo=layout_memo)
+    finally:
+        assets.close()
+        close_metrics(logger)
+        if llm_cache is not None:
+            llm_cache.log_stats(logger)
+            llm_cache.close()
+        if image_cache is not None:
+            image_cache.log_stats(logger)
+        if layout_memo is not None:
+            layout_memo.log_stats(logger)
+            layout_memo.close()
+
+def wrapper_review(use_logger:bool = False, save_data:bool = False, concurrent:bool = False,
+                   resume:str|None = None, pdf_backend:str|None = None, batch_api:bool = False):
     """
     Executes the process of generating stories, reviewing them, generating images, and generating a PDF.
 
+    When `save_data` is True every stage is checkpointed in `data/<identifier>/` as soon as it is done
+    (each image in its own file). Passing the identifier of a previous run in `resume` loads the stages,
+    images and PDFs already done and only runs what is missing.
+
     Args:
         use_logger (bool, optional): Flag indicating whether to use a logger for logging. Defaults to False.
         save_data (bool, optional): Flag indicating whether to save the generated data. Defaults to False.
+        concurrent (bool, optional): Flag indicating whether to send the requests concurrently. Defaults to False.
+        resume (str|None, optional): Identifier of the run to resume. Defaults to None.
+        pdf_backend (str|None, optional): latex or native. Defaults to None (PDF_BACKEND of configuration.ini).
+        batch_api (bool, optional): Send the stories, reviews and image prompts through the OpenAI Batch API.
+            Defaults to False (ENABLED of the [batch_api] section).
     """
-    identifier = dt.now().strftime("%Y_%m_%dT%H_%M_%S")
-    path_save_data = Path(__file__).parent / "data"
-    path_save_data = path_save_data / f"{identifier}_data.pkl"
+    setup_paths()
+    import read_configuration as rc
+    import logger_code as lc
+    from checkpoint import Checkpoint
+    from pipeline import (open_llm_cache, open_image_cache, open_layout_memo, open_story_index, open_batch_collector,
+                          open_metrics, close_metrics, run_review_pipeline, with_pdf_backend, with_batch_api)
+    identifier = resume if resume is not None else dt.now().strftime("%Y_%m_%dT%H_%M_%S")
     logger = None
     
     if use_logger:
         logger = lc.configure_logger(identifier = identifier)
 
+    checkpoint = None
+    if save_data or resume is not None:
+        checkpoint = Checkpoint(identifier, logger=logger)
+    if resume is not None and not checkpoint.exists():
+        raise FileNotFoundError(f"No checkpoint found for {resume} in {checkpoint.path}")
 
-    base_dict_values = rc.history_base_values()
-    output_parser, output_prompts = pp.generate_prompts_for_chain(4,base_dict_values)
-    
-    print("Generating multiple stories...")
-    data = hg.llm_call_chain_for_history_generation(logger=logger,
-                                                    parser=output_parser,
-                                                    prompts=output_prompts)
-    if save_data:
-        with open(path_save_data, "wb") as f:
-            pickle.dump(data, f)
-    
-    print("Reviewing best story...")
-    data = hg.make_review(data, logger=logger)
-
-    if save_data:
-        with open(path_save_data, "wb") as f:
-            pickle.dump(data, f)
-    print("Generating prompts to produce images...")
-    data = hg.make_prompt_images_after_review(data, logger=logger,
-                                       base_dict_values=base_dict_values)
-    if save_data:
-        with open(path_save_data, "wb") as f:
-            pickle.dump(data, f)
-    print("Generating images...")
-    data = ig.generate_images_for_history_after_review(data=data, model=image_model, logger=logger)
-    if save_data:
-        with open(path_save_data, "wb") as f:
-            pickle.dump(data, f)
-    print("Generating PDF...")
-    pg.generate_pdf(data, logger=logger, identifier=identifier)
-
-
-def main(review: bool = True, use_logger: bool = False, save_data: bool = False):
+    configuration = with_batch_api(with_pdf_backend(rc.load_configuration(), pdf_backend), batch_api)
+    llm_cache = open_llm_cache(configuration.cache)
+    image_cache = open_image_cache(configuration.cache)
+    layout_memo = open_layout_memo(configuration.cache)
+    story_index = open_story_index(configuration.story_index, logger)
+    batch = open_batch_collector(configuration, logger)
+    open_metrics(identifier, configuration.metrics)
+    try:
+        run_review_pipeline(identifier, configuration, logger=logger, checkpoint=checkpoint,
+                            concurrent=concurrent, llm_cache=llm_cache, image_cache=image_cache,
+                            image_model=image_model, layout_memo=layout_memo, batch=batch,
+                            story_index=story_index)
+    finally:
+        if batch is not None:
+            batch.close()
+        close_metrics(logger)
+        if llm_cache is not None:
+            llm_cache.log_stats(logger)
+            llm_cache.close()
+        if image_cache is not None:
+            image_cache.log_stats(logger)
+        if layout_memo is not None:
+            layout_memo.log_stats(logger)
+            layout_memo.close()
+        if story_index is not None:
+            story_index.log_stats(logger)
+            story_index.close()
+
+
+def wrapper_batch(manifest:str, use_logger:bool = False, concurrent:bool = False, resume:str|None = None,
+                  pdf_backend:str|None = None, batch_api:bool = False):
+    """
+    Generates one reviewed book per row of a manifest. Every row is checkpointed in `data/<batch_id>_<row>_<child>/`
+    and its status is written to `data/<batch_id>_report.jsonl`.
+
+    Args:
+        manifest (str): Path of the JSONL or CSV manifest.
+        use_logger (bool, optional): Flag indicating whether to use a logger for logging. Defaults to False.
+        concurrent (bool, optional): Flag indicating whether each row sends its requests concurrently. Defaults to False.
+        resume (str|None, optional): Identifier of the batch to resume. Defaults to None.
+        pdf_backend (str|None, optional): latex or native. Defaults to None (PDF_BACKEND of configuration.ini).
+        batch_api (bool, optional): Send the LLM requests through the OpenAI Batch API. Defaults to False
+            (ENABLED of the [batch_api] section).
+    """
+    setup_paths()
+    import read_configuration as rc
+    import logger_code as lc
+    from batch_runner import run_manifest
+    from pipeline import with_pdf_backend, with_batch_api
+    batch_id = resume if resume is not None else dt.now().strftime("%Y_%m_%dT%H_%M_%S")
+    logger = None
+
+    if use_logger:
+        logger = lc.configure_logger(identifier = batch_id)
+
+    configuration = with_batch_api(with_pdf_backend(rc.load_configuration(), pdf_backend), batch_api)
+    report = run_manifest(manifest, batch_id, logger=logger, concurrent=concurrent, configuration=configuration)
+    print(f"Batch report saved in {report}")
+
+def wrapper_service(use_logger:bool = False, save_data:bool = False, concurrent:bool = False,
+                    pdf_backend:str|None = None, host:str|None = None, port:int|None = None):
+    """
+    Runs the generation service until it is interrupted: books are submitted, polled and cancelled through
+    a local HTTP/JSON API (see service.py) and generated by warm worker threads.
+
+    Args:
+        use_logger (bool, optional): Flag indicating whether to use a logger for logging. Defaults to False.
+        save_data (bool, optional): Flag indicating whether to checkpoint every job in `data/<job id>/`. Defaults to False.
+        concurrent (bool, optional): Flag indicating whether each job sends its requests concurrently. Defaults to False.
+        pdf_backend (str|None, optional): latex or native. Defaults to None (PDF_BACKEND of configuration.ini).
+        host (str|None, optional): The host of the API. Defaults to HOST of the [service] section.
+        port (int|None, optional): The port of the API. Defaults to PORT of the [service] section.
+    """
+    setup_paths()
+    import read_configuration as rc
+    import logger_code as lc
+    from pipeline import with_pdf_backend
+    from service import StoryService, make_server
+    service_id = dt.now().strftime("%Y_%m_%dT%H_%M_%S")
+    logger = None
+
+    if use_logger:
+        logger = lc.configure_logger(identifier = service_id)
+
+    configuration = with_pdf_backend(rc.load_configuration(), pdf_backend)
+    host = host or configuration.service.host
+    port = port if port is not None else configuration.service.port
+    service = StoryService(configuration, service_id, logger=logger, concurrent=concurrent,
+                           save_data=save_data).start()
+    server = make_server(service, host, port)
+    print(f"Story service listening on http://{host}:{server.server_address[1]}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.stop()
+
+def main(review: bool = True, use_logger: bool = False, save_data: bool = False, concurrent: bool = False,
+         resume: str | None = None, manifest: str | None = None, pdf_backend: str | None = None,
+         serve: bool = False, port: int | None = None, batch_api: bool = False):
     """
     Main function for story generation process.
 
@@ -108,6 +247,14 @@ def main(review: bool = True, use_logger: bool = False, save_data: bool = False)
         review (bool): Flag indicating whether to review the generated story (default is True).
         use_logger (bool): Flag indicating whether to use a logger for logging (default is False).
         save_data (bool): Flag indicating whether to save the generated data (default is False).
+        concurrent (bool): Flag indicating whether to send the requests concurrently (default is False).
+        resume (str | None): Identifier of a previous review run or batch to resume (default is None).
+        manifest (str | None): Path of a JSONL or CSV manifest to generate one book per row (default is None).
+        pdf_backend (str | None): latex or native, overrides PDF_BACKEND of configuration.ini (default is None).
+        serve (bool): Flag indicating whether to run the generation service instead of one run (default is False).
+        port (int | None): Port of the service, overrides PORT of configuration.ini (default is None).
+        batch_api (bool): Flag indicating whether to send the LLM requests of the review process or the manifest
+            through the OpenAI Batch API (default is False, ENABLED of the [batch_api] section).
     """
     path_save_data = Path(__file__).parent / "data"
     path_save_images = Path(__file__).parent / "images"
@@ -116,10 +263,19 @@ def main(review: bool = True, use_logger: bool = False, save_data: bool = False)
     path_save_images.mkdir(exist_ok=True)
     path_save_stories.mkdir(exist_ok=True)
 
-    if review:
-        wrapper_review(use_logger=use_logger, save_data=save_data)
+    if serve:
+        wrapper_service(use_logger=use_logger, save_data=save_data, concurrent=concurrent,
+                        pdf_backend=pdf_backend, port=port)
+    elif manifest is not None:
+        wrapper_batch(manifest, use_logger=use_logger, concurrent=concurrent, resume=resume,
+                      pdf_backend=pdf_backend, batch_api=batch_api)
+    elif resume is not None and not review:
+        raise ValueError("Only the review process can be resumed")
+    elif review:
+        wrapper_review(use_logger=use_logger, save_data=save_data, concurrent=concurrent, resume=resume,
+                       pdf_backend=pdf_backend, batch_api=batch_api)
     else:
-        wrapper(use_logger=use_logger, save_data=save_data)
+        wrapper(use_logger=use_logger, save_data=save_data, concurrent=concurrent, pdf_backend=pdf_backend)
     
     print("Story generation process finished")
     
@@ -138,5 +294,17 @@ if __name__ == "__main__":
     parser.add_argument("--review", type=str2bool, nargs='?', const=True, help="Run the review process", default=True)
     parser.add_argument("--use_logger", type=str2bool, nargs='?', const=True, default=True, help="Use the logger")
     parser.add_argument("--save_data", type=str2bool, nargs='?', const=True, default=True, help="Save the data")
+    parser.add_argument("--concurrent", type=str2bool, nargs='?', const=True, default=False, help="Send the requests concurrently")
+    parser.add_argument("--resume", type=str, default=None, help="Identifier of the run or batch to resume")
+    parser.add_argument("--manifest", type=str, default=None, help="JSONL or CSV manifest with one book per row")
+    parser.add_argument("--pdf_backend", type=str, choices=("latex", "native"), default=None,
+                        help="PDF renderer of this run (defaults to PDF_BACKEND of configuration.ini)")
+    parser.add_argument("--serve", type=str2bool, nargs='?', const=True, default=False,
+                        help="Run the generation service with its HTTP/JSON job API")
+    parser.add_argument("--port", type=int, default=None, help="Port of the service (defaults to PORT of configuration.ini)")
+    parser.add_argument("--batch_api", type=str2bool, nargs='?', const=True, default=False,
+                        help="Send the LLM requests of the review process or the manifest through the OpenAI Batch API")
     args = parser.parse_args()
-    main(review=args.review, use_logger=args.use_logger, save_data=args.save_data)
+    main(review=args.review, use_logger=args.use_logger, save_data=args.save_data, concurrent=args.concurrent,
+         resume=args.resume, manifest=args.manifest, pdf_backend=args.pdf_backend,
+         serve=args.serve, port=args.port, batch_api=args.batch_api)
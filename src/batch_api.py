@@ -0,0 +1,197 @@
+from pathlib import Path
+from typing import Any, Dict, List, Tuple
+import itertools
+import json
+import logging
+import threading
+import time
+import read_configuration as rc
+import clients
+import metrics
+# the OpenAI client is built when the first batch is submitted (see clients.openai_client)
+
+files_path = Path(__file__).parent.parent / "data" / "batches"
+endpoint = "/v1/chat/completions"
+terminal_statuses = ("completed", "failed", "expired", "cancelled")
+# langchain message types and the roles of the chat completions API
+roles = {"human": "user", "ai": "assistant", "system": "system"}
+
+class BatchRequestError(Exception):
+    """
+    A request of a batch without an answer: the request failed, or the whole batch failed, expired or was cancelled.
+    """
+
+def request_line(custom_id:str, prompt_value:Any, model:str, temperature:float) -> Dict[str, Any]:
+    """
+    The line of the batch file of one rendered prompt: the same chat completion that ChatOpenAI sends.
+    """
+    messages = [{"role": roles.get(message.type, message.type), "content": message.content}
+                for message in prompt_value.to_messages()]
+    return {"custom_id": custom_id, "method": "POST", "url": endpoint,
+            "body": {"model": model, "temperature": temperature, "messages": messages}}
+
+def read_output(text:str, usage:Dict[str, int]|None = None) -> Dict[str, str|Exception]:
+    """
+    Returns the answer (or the error) of every custom_id of an output or error file of a batch.
+    The token usage of the answers is added to `usage` if it is given.
+    """
+    results = {}
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        item = json.loads(line)
+        response = item.get("response") or {}
+        if item.get("error") or response.get("status_code") != 200:
+            error = item.get("error") or response.get("body", {}).get("error") or response
+            results[item["custom_id"]] = BatchRequestError(f"Request {item['custom_id']} failed: {error}")
+            continue
+        results[item["custom_id"]] = response["body"]["choices"][0]["message"]["content"]
+        if usage is not None:
+            for key, value in metrics.token_usage(response["body"].get("usage")).items():
+                usage[key] = usage.get(key, 0) + value
+    return results
+
+class BatchCollector:
+    """
+    Sends the LLM requests of the pipeline through the OpenAI Batch API (half the price, much higher limits,
+    answers within the completion window). `complete` is called instead of the LLM by every stage that is
+    running (candidates, reviews, image prompts of every history and every manifest row) and blocks until
+    the answers arrive; the requests that arrive within `gather_seconds` of each other go in the same batch.
+
+    Each batch is written to `data/batches/<name>_input.jsonl`, uploaded, polled every `poll_seconds` and its
+    output saved next to it; the answers are returned as the LLM would, so the stages parse them with their
+    StructuredOutputParser and build the same data.
+    """
+    def __init__(self, api_key:str, values:rc.BatchApiConfig, logger:logging.Logger|None = None,
+                 path:str|Path = files_path):
+        self.api_key = api_key
+        self.values = values
+        self.logger = logger
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self._pending: List[Tuple[str, Dict[str, Any]]] = []
+        self._results: Dict[str, str|Exception] = {}
+        self._events: Dict[str, threading.Event] = {}
+        self._last_request = 0.0
+        self._counter = itertools.count()
+        self._batches = itertools.count()
+        self._condition = threading.Condition()
+        self._closed = False
+        self._name = time.strftime("%Y_%m_%dT%H_%M_%S")
+        self._thread = threading.Thread(target=self._gather, name="batch-api", daemon=True)
+        self._thread.start()
+
+    def complete(self, prompt_values:List, model:str, temperature:float) -> List[str|Exception]:
+        """
+        Adds the prompts to the next batch and waits for their answers.
+
+        Returns:
+            List[str|Exception]: The completion text or the error of each prompt, in the order of the prompts.
+        """
+        ids = []
+        with self._condition:
+            for prompt_value in prompt_values:
+                custom_id = f"request-{next(self._counter)}"
+                self._events[custom_id] = threading.Event()
+                self._pending.append((custom_id, request_line(custom_id, prompt_value, model, temperature)))
+                ids.append(custom_id)
+            self._last_request = time.monotonic()
+            self._condition.notify_all()
+        results = []
+        for custom_id in ids:
+            self._events[custom_id].wait()
+            with self._condition:
+                del self._events[custom_id]
+                results.append(self._results.pop(custom_id))
+        return results
+
+    def _gather(self) -> None:
+        while True:
+            with self._condition:
+                while not self._closed and not self._pending:
+                    self._condition.wait()
+                if self._closed and not self._pending:
+                    return
+                wait = self._last_request + self.values.gather_seconds - time.monotonic()
+                if wait > 0 and not self._closed:
+                    self._condition.wait(wait)
+                    continue
+                entries, self._pending = self._pending, []
+            # the next requests gather in the next batch while this one runs
+            threading.Thread(target=self._run, args=(entries,), daemon=True).start()
+
+    def _finish(self, results:Dict[str, str|Exception]) -> None:
+        with self._condition:
+            self._results.update(results)
+            for custom_id in results:
+                self._events[custom_id].set()
+
+    def _run(self, entries:List[Tuple[str, Dict[str, Any]]]) -> None:
+        ids = [custom_id for custom_id, _ in entries]
+        try:
+            with metrics.span("batch_api", requests=len(entries)) as values:
+                results = self.run_batch([line for _, line in entries], values)
+        except Exception as e:
+            if self.logger is not None:
+                self.logger.error(f"Batch of {len(entries)} requests failed: {e}")
+            results = {}
+            error = e
+        else:
+            error = BatchRequestError("The batch has no answer for this request")
+        self._finish({custom_id: results.get(custom_id, error) for custom_id in ids})
+
+    def run_batch(self, lines:List[Dict[str, Any]], values:Dict[str, Any]|None = None) -> Dict[str, str|Exception]:
+        """
+        Writes, uploads and submits one batch, waits for it and returns the answer of every custom_id.
+
+        Args:
+            lines (List[Dict[str, Any]]): The requests of the batch (see `request_line`).
+            values (Dict[str, Any]|None, optional): The attributes of the metrics span of the batch. Defaults to None.
+
+        Returns:
+            Dict[str, str|Exception]: The completion text or the error of every custom_id.
+        """
+        values = values if values is not None else {}
+        name = f"{self._name}_{next(self._batches)}"
+        input_file = self.path / f"{name}_input.jsonl"
+        with open(input_file, "w", encoding="utf-8") as f:
+            for line in lines:
+                f.write(json.dumps(line, ensure_ascii=False) + "\n")
+        client = clients.openai_client(self.api_key)
+        with open(input_file, "rb") as f:
+            uploaded = client.files.create(file=f, purpose="batch")
+        batch = client.batches.create(input_file_id=uploaded.id, endpoint=endpoint,
+                                      completion_window=self.values.completion_window,
+                                      metadata={"description": name})
+        values["batch_id"] = batch.id
+        if self.logger is not None:
+            self.logger.info(f"Batch {batch.id} submitted with {len(lines)} requests ({input_file.name})")
+        while batch.status not in terminal_statuses:
+            time.sleep(self.values.poll_seconds)
+            batch = client.batches.retrieve(batch.id)
+        values["batch_status"] = batch.status
+        if batch.request_counts is not None:
+            values["completed"] = batch.request_counts.completed
+            values["failed"] = batch.request_counts.failed
+        if self.logger is not None:
+            self.logger.info(f"Batch {batch.id} {batch.status}")
+        results, usage = {}, {}
+        for kind, file_id in (("errors", batch.error_file_id), ("output", batch.output_file_id)):
+            if file_id is None:
+                continue
+            text = client.files.content(file_id).text
+            (self.path / f"{name}_{kind}.jsonl").write_text(text, encoding="utf-8")
+            results.update(read_output(text, usage))
+        values.update(usage)
+        if batch.status != "completed" and not results:
+            raise BatchRequestError(f"Batch {batch.id} {batch.status}: {batch.errors}")
+        return results
+
+    def close(self) -> None:
+        """
+        Sends the requests still gathering and stops the collector.
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join()
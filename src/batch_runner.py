@@ -0,0 +1,165 @@
+from pathlib import Path
+from typing import Dict, Any, List
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import replace
+import csv
+import json
+import logging
+import re
+import threading
+import time
+import read_configuration as rc
+import clients
+from checkpoint import Checkpoint
+from pipeline import (open_llm_cache, open_image_cache, open_layout_memo, open_story_index, open_batch_collector,
+                      open_metrics, close_metrics, run_review_pipeline)
+
+required_fields = ("child", "age", "topic", "language", "pages", "questions")
+report_path = Path(__file__).parent.parent / "data"
+
+def read_manifest(path:str|Path) -> List[Dict[str, Any]]:
+    """
+    Reads a manifest of books, one row per child. JSONL (.jsonl) and CSV (.csv) files are supported.
+    Every row needs the fields child, age, topic, language, pages and questions.
+    words_per_page, moral_value and story_genere are optional and default to configuration.ini.
+    """
+    path = Path(path)
+    if not path.exists():
+        raise FileNotFoundError(f"File {path} not found")
+    if path.suffix.lower() == ".jsonl":
+        with open(path, encoding="utf-8") as f:
+            return [json.loads(line) for line in f if line.strip()]
+    if path.suffix.lower() == ".csv":
+        with open(path, encoding="utf-8", newline="") as f:
+            return [dict(row) for row in csv.DictReader(f)]
+    raise ValueError(f"Unsupported manifest format {path.suffix}, use .jsonl or .csv")
+
+def row_configuration(row:Dict[str, Any], base_dict_values:rc.HistoryConfig) -> rc.HistoryConfig:
+    """
+    Builds the history values of one manifest row. The values that the row does not set are
+    taken from configuration.ini.
+    """
+    missing = [field for field in required_fields if str(row.get(field, "")).strip() == ""]
+    if missing:
+        raise ValueError(f"Missing fields {', '.join(missing)}")
+    values = {
+        "names": (str(row["child"]).strip().lower().capitalize(),),
+        "birthdays": (),
+        "ages": (int(row["age"]),),
+        "topics": (str(row["topic"]).strip().lower(),),
+        "language": str(row["language"]).strip().lower().capitalize(),
+        "pages": int(row["pages"]),
+        "questions": int(row["questions"]),
+    }
+    if str(row.get("words_per_page", "")).strip():
+        values["words_per_page"] = int(row["words_per_page"])
+    if str(row.get("moral_value", "")).strip():
+        values["moral_values"] = (str(row["moral_value"]).strip().lower(),)
+    if str(row.get("story_genere", "")).strip():
+        values["story_genere"] = (str(row["story_genere"]).strip().lower(),)
+    return replace(base_dict_values, **values)
+
+def row_identifier(batch_id:str, index:int, row:Dict[str, Any]) -> str:
+    child = re.sub(r"\W+", "_", str(row.get("child", "")).strip()) or "child"
+    return f"{batch_id}_{index:05d}_{child}"
+
+def run_manifest(manifest_path:str|Path, batch_id:str,
+                 logger:logging.Logger|None = None,
+                 max_workers:int|None = None,
+                 concurrent:bool = False,
+                 configuration:rc.Configuration|None = None) -> Path:
+    """
+    Produces one book per manifest row. Every row runs the whole review pipeline (candidates, review,
+    image prompts, images and PDF) with its own checkpoint; at most `max_workers` rows run at the same time,
+    which bounds the number of requests in flight. With the Batch API enabled the LLM requests of the rows
+    running at the same time are sent together in batches. A status line per row is appended to
+    `data/<batch_id>_report.jsonl` as soon as the row finishes. Running the same batch_id again only
+    generates what is missing.
+
+    Args:
+        manifest_path (str|Path): The JSONL or CSV manifest.
+        batch_id (str): The identifier of the batch. It prefixes the identifier of every row.
+        logger (logging.Logger|None, optional): The logger object. Defaults to None.
+        max_workers (int|None, optional): Number of rows generated at the same time. Defaults to BATCH_CONCURRENCY.
+        concurrent (bool, optional): Flag indicating whether each row sends its requests concurrently. Defaults to False.
+        configuration (rc.Configuration|None, optional): The configuration. Defaults to configuration.ini.
+
+    Returns:
+        Path: The path of the report.
+    """
+    if configuration is None:
+        configuration = rc.load_configuration()
+    if max_workers is None:
+        max_workers = configuration.execution.batch_concurrency
+    rows = read_manifest(manifest_path)
+    report_path.mkdir(exist_ok=True)
+    report = report_path / f"{batch_id}_report.jsonl"
+    report_lock = threading.Lock()
+    llm_cache = open_llm_cache(configuration.cache)
+    image_cache = open_image_cache(configuration.cache)
+    layout_memo = open_layout_memo(configuration.cache)
+    story_index = open_story_index(configuration.story_index, logger)
+    batch = open_batch_collector(configuration, logger)
+    # the spans of every row go to the metrics of the batch, tagged with the identifier of the row
+    open_metrics(batch_id, configuration.metrics)
+
+    def write_status(status:Dict[str, Any]) -> None:
+        with report_lock:
+            with open(report, "a", encoding="utf-8") as f:
+                f.write(json.dumps(status, ensure_ascii=False) + "\n")
+
+    def run_row(index:int, row:Dict[str, Any]) -> Dict[str, Any]:
+        identifier = row_identifier(batch_id, index, row)
+        status = {"row": index, "child": row.get("child"), "identifier": identifier}
+        start = time.perf_counter()
+        try:
+            base_dict_values = row_configuration(row, configuration.history)
+            checkpoint = Checkpoint(identifier, logger=logger)
+            run_review_pipeline(identifier, configuration, base_dict_values=base_dict_values,
+                                logger=logger, checkpoint=checkpoint, concurrent=concurrent,
+                                llm_cache=llm_cache, image_cache=image_cache, verbose=False,
+                                layout_memo=layout_memo, batch=batch, story_index=story_index)
+            status["status"] = "done"
+        except Exception as e:
+            if logger is not None:
+                logger.error(f"Error generating row {index} ({identifier}): {e}")
+            status["status"] = "failed"
+            status["error"] = str(e)
+        finally:
+            # the event loop and the async clients of the worker thread (see clients.py)
+            clients.close_thread_clients()
+        status["seconds"] = round(time.perf_counter() - start, 3)
+        write_status(status)
+        return status
+
+    if logger is not None:
+        logger.info(f"Batch {batch_id}: {len(rows)} rows, {max_workers} at a time")
+    done = failed = 0
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+            futures = [executor.submit(run_row, index, row) for index, row in enumerate(rows)]
+            for future in as_completed(futures):
+                status = future.result()
+                if status["status"] == "done":
+                    done += 1
+                else:
+                    failed += 1
+                print(f"Row {status['row']} {status['status']} ({done + failed}/{len(rows)})")
+    finally:
+        if batch is not None:
+            batch.close()
+        close_metrics(logger)
+        if llm_cache is not None:
+            llm_cache.log_stats(logger)
+            llm_cache.close()
+        if image_cache is not None:
+            image_cache.log_stats(logger)
+        if layout_memo is not None:
+            layout_memo.log_stats(logger)
+            layout_memo.close()
+        if story_index is not None:
+            story_index.log_stats(logger)
+            story_index.close()
+    if logger is not None:
+        logger.info(f"Batch {batch_id} finished: {done} done, {failed} failed. Report: {report}")
+    return report
@@ -0,0 +1,96 @@
+from pathlib import Path
+from typing import Dict, Any
+import logging
+import pickle
+
+path = Path(__file__).parent.parent / "data"
+
+class Checkpoint:
+    """
+    Incremental checkpoint of a run of the review pipeline, stored in `data/<identifier>/`.
+
+    Each text stage (candidates, review, image prompts) is saved once in its own pickle, every
+    image is saved in its own file in `images_path` as soon as it arrives (see `ImageAssets`) and
+    every finished PDF leaves a marker file. A run started again with the same identifier only does
+    what is missing.
+    """
+    def __init__(self, identifier:str, path:str|Path = path, logger:logging.Logger|None = None):
+        self.identifier = identifier
+        self.path = Path(path) / identifier
+        self.images_path = self.path / "images"
+        self.logger = logger
+
+    def exists(self) -> bool:
+        return self.path.exists()
+
+    def has_stage(self, stage:str) -> bool:
+        return (self.path / f"{stage}.pkl").exists()
+
+    def load_stage(self, stage:str) -> Dict[str, Dict[str, Any]]:
+        with open(self.path / f"{stage}.pkl", "rb") as f:
+            data = pickle.load(f)
+        if self.logger is not None:
+            self.logger.info(f"Stage {stage} loaded from checkpoint {self.identifier}")
+        return data
+
+    def save_stage(self, stage:str, data:Dict[str, Dict[str, Any]]) -> None:
+        """
+        Saves the result of a text stage. Results with errors are not saved so the stage runs again on resume.
+        Images are not saved here, they have their own files.
+        """
+        if any("error" in details for details in data.values()):
+            if self.logger is not None:
+                self.logger.warning(f"Stage {stage} has errors, it is not saved in checkpoint {self.identifier}")
+            return
+        self.path.mkdir(parents=True, exist_ok=True)
+        text_data = {history: {k: v for k, v in details.items() if not k.startswith("image_")}
+                     for history, details in data.items()}
+        temp_file = self.path / f"{stage}.pkl.tmp"
+        with open(temp_file, "wb") as f:
+            pickle.dump(text_data, f)
+        temp_file.replace(self.path / f"{stage}.pkl")
+
+    def load_history_stage(self, stage:str, history:str) -> Dict[str, Any]|None:
+        """
+        Returns the saved stage of one history, or None if it is not saved. Stages saved for every
+        history at once (older runs) are also read.
+        """
+        if self.has_stage(f"{stage}_{history}"):
+            return self.load_stage(f"{stage}_{history}")[history]
+        if self.has_stage(stage):
+            return self.load_stage(stage).get(history)
+        return None
+
+    def save_history_stage(self, stage:str, history:str, details:Dict[str, Any]) -> None:
+        """
+        Saves the stage of one history so every history can move through the stages on its own.
+        """
+        self.save_stage(f"{stage}_{history}", {history: details})
+
+    def _image_file(self, history:str, page_number:int) -> Path:
+        return self.images_path / f"{history}_image_{page_number}.png"
+
+    def load_images(self, data:Dict[str, Dict[str, Any]]) -> int:
+        """
+        Adds the paths of the saved images to the data. Returns the number of images found.
+        """
+        loaded = 0
+        for history, details in data.items():
+            for key in list(details.keys()):
+                if not key.startswith("prompt_image_"):
+                    continue
+                page_number = int(key.split("_")[-1])
+                file = self._image_file(history, page_number)
+                if file.exists():
+                    details[f"image_{page_number}"] = file
+                    loaded += 1
+        if loaded and self.logger is not None:
+            self.logger.info(f"{loaded} images loaded from checkpoint {self.identifier}")
+        return loaded
+
+    def has_pdf(self, history:str) -> bool:
+        return (self.path / f"pdf_{history}.done").exists()
+
+    def mark_pdf(self, history:str) -> None:
+        self.path.mkdir(parents=True, exist_ok=True)
+        (self.path / f"pdf_{history}.done").touch()
@@ -0,0 +1,92 @@
+from typing import Any, Coroutine, Dict, Tuple, TYPE_CHECKING
+import asyncio
+import threading
+import transport
+if TYPE_CHECKING:
+    from langchain_openai import ChatOpenAI
+    from openai import OpenAI, AsyncOpenAI
+# openai and langchain are imported when the first client is built; every client sends its requests
+# through the pooled httpx clients of transport.py
+
+_local = threading.local()
+_shared: Dict[Tuple, Any] = {}
+_shared_lock = threading.Lock()
+
+def _thread_clients() -> Dict[Tuple, Any]:
+    clients = getattr(_local, "clients", None)
+    if clients is None:
+        clients = _local.clients = {}
+    return clients
+
+def event_loop() -> asyncio.AbstractEventLoop:
+    """
+    The event loop of this thread. It is kept open between calls so the async clients built on it
+    keep their connections, instead of a new loop (and new connections) for every `asyncio.run`.
+    """
+    loop = getattr(_local, "loop", None)
+    if loop is None or loop.is_closed():
+        loop = _local.loop = asyncio.new_event_loop()
+    return loop
+
+def run(coroutine:Coroutine) -> Any:
+    """
+    Runs the coroutine in the event loop of this thread, like `asyncio.run`.
+    """
+    return event_loop().run_until_complete(coroutine)
+
+def chat_model(api_key:str, model:str, temperature:float) -> "ChatOpenAI":
+    """
+    Returns the ChatOpenAI of this thread for the key, model and temperature, built the first time.
+    Its async client belongs to the event loop of the thread (see `run`), that is why it is not shared
+    between threads.
+    """
+    clients = _thread_clients()
+    key = ("chat", api_key, model, temperature)
+    if key not in clients:
+        from langchain_openai import ChatOpenAI
+        llm = ChatOpenAI(api_key=api_key, model=model, temperature=temperature)
+        # langchain-openai 0.1 takes a single http_client for its sync and async clients,
+        # so the OpenAI clients of the transport are set directly
+        llm.client = openai_client(api_key).chat.completions
+        llm.async_client = async_openai_client(api_key).chat.completions
+        clients[key] = llm
+    return clients[key]
+
+def openai_client(api_key:str) -> "OpenAI":
+    """
+    Returns the synchronous OpenAI client for the key, shared by every thread.
+    """
+    key = ("openai", api_key)
+    with _shared_lock:
+        if key not in _shared:
+            from openai import OpenAI
+            _shared[key] = OpenAI(api_key=api_key, http_client=transport.http_client())
+        return _shared[key]
+
+def async_openai_client(api_key:str) -> "AsyncOpenAI":
+    """
+    Returns the AsyncOpenAI client of this thread for the key, to be used in the event loop of the thread.
+    """
+    clients = _thread_clients()
+    key = ("async_openai", api_key)
+    if key not in clients:
+        from openai import AsyncOpenAI
+        clients[key] = AsyncOpenAI(api_key=api_key, http_client=transport.async_http_client())
+    return clients[key]
+
+def close_thread_clients() -> None:
+    """
+    Closes the async clients and the event loop of this thread (when a worker thread finishes).
+    """
+    clients = getattr(_local, "clients", None) or {}
+    loop = getattr(_local, "loop", None)
+    if loop is not None and not loop.is_closed():
+        for key, client in clients.items():
+            if key[0] == "async_openai":
+                loop.run_until_complete(client.close())
+        transport.close_async_http_client(loop)
+        loop.close()
+    else:
+        transport.close_async_http_client()
+    _local.clients = {}
+    _local.loop = None
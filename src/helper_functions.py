@@ -1,12 +1,32 @@
 from datetime import datetime as dt
 import datetime
-import requests
-import Levenshtein as lev
-import PyPDF2
-from typing import List
+from typing import List, TYPE_CHECKING
 from pathlib import Path
 import base64
+import os
 import pickle
+import threading
+if TYPE_CHECKING:
+    import httpx
+    import requests
+# requests, Levenshtein and PyPDF2 are imported by the functions that use them so importing this
+# module stays cheap
+
+env_path = Path(__file__).parent / ".env"
+_env_lock = threading.Lock()
+_env_loaded = False
+
+def openai_api_key() -> str|None:
+    """
+    Returns OPENAI_API_KEY. The .env file is read the first time the key is needed, not at import.
+    """
+    global _env_loaded
+    with _env_lock:
+        if not _env_loaded:
+            from dotenv import load_dotenv
+            load_dotenv(env_path)
+            _env_loaded = True
+    return os.getenv('OPENAI_API_KEY')
 
 def calculate_number_of_years(brith_date:str) -> int:
     """
@@ -25,27 +45,43 @@ def calculate_levenshtein_distance(reference_words:List[str], target_word:str):
     """
     Calculate the Levenshtein distance between a list of reference words and a target word
     """
+    import Levenshtein as lev
     distances = [lev.distance(target_word, word) for word in reference_words]
     min_distance = min(distances)
     index_min_distance = distances.index(min_distance)
     return reference_words[index_min_distance]
 
-def download_image(image_url, save_path)->None:
+def download_image(image_url, save_path, session:"requests.Session|None" = None,
+                   client:"httpx.Client|None" = None)->None:
     """
-    Download an image from a URL and save it to a path
+    Download an image from a URL and save it to a path.
+    The image is streamed to the file. If an httpx client or a requests session is given its connection pool is reused.
     """
-    response = requests.get(image_url)
-    response.raise_for_status()  # Asegura que la descarga fue exitosa
-    
-    with open(save_path, 'wb') as f:
-        f.write(response.content)
+    if client is not None:
+        with client.stream("GET", image_url) as response:
+            response.raise_for_status()
+            with open(save_path, 'wb') as f:
+                for chunk in response.iter_bytes(chunk_size=64 * 1024):
+                    f.write(chunk)
+        return
+    if session is not None:
+        getter = session
+    else:
+        import requests
+        getter = requests
+    with getter.get(image_url, stream=True) as response:
+        response.raise_for_status()  # Asegura que la descarga fue exitosa
+        with open(save_path, 'wb') as f:
+            for chunk in response.iter_content(chunk_size=64 * 1024):
+                f.write(chunk)
 def convert_base64_to_jpg(b64_string, output_path):
     """
-    Convierte un string codificado en base64 a un archivo JPG.
+    Convierte un string codificado en base64 a un archivo de imagen. Los bytes se escriben tal cual,
+    así que la extensión de output_path debe ser la del formato de la imagen (PNG para DALL-E).
 
     Parámetros:
     - b64_string (str): La cadena codificada en base64 de la imagen.
-    - output_path (str): La ruta del archivo de salida donde se guardará la imagen JPG.
+    - output_path (str): La ruta del archivo de salida donde se guardará la imagen.
     """
     # Decodifica la cadena base64 a datos binarios
     img_data = base64.b64decode(b64_string)
@@ -66,6 +102,7 @@ def count_number_of_pages(pdf_path:str)->int:
     pdf_path = Path(pdf_path)
     if not pdf_path.exists():
         raise FileNotFoundError(f"File {pdf_path} not found")
+    import PyPDF2
     with open(pdf_path, 'rb') as file:
         reader = PyPDF2.PdfReader(file)
         number_of_pages = len(reader.pages)
@@ -80,7 +117,7 @@ def select_best_history(histories:dict)->str:
     return best_history
 
 if __name__ == "__main__":
-    path = Path(__file__).parent.parent /"images" / "temp_64.jpg"
+    path = Path(__file__).parent.parent /"images" / "temp_64.png"
     path_data = r'C:\proyectos_personales\Cuentos\data\2024-03-24_11-58-45_histories_images.pkl'
     with open(path_data, 'rb') as f:
         data = pickle.load(f)
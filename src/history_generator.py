@@ -1,55 +1,216 @@
 from pathlib import Path
-from langchain_openai import ChatOpenAI
 import prepare_prompt as pp
-from dotenv import load_dotenv
 import os
 from datetime import datetime as dt
 import logging
 import helper_functions as hf
-import prepare_prompt as pp
-from typing import List,Dict
-path = Path(__file__).parent / ".env"
-load_dotenv(path)
-# Load the environment variables
-openai_api_key = os.getenv('OPENAI_API_KEY')
+from read_configuration import HistoryConfig
+from typing import Any,Callable,List,Dict,TYPE_CHECKING
+import asyncio
+from llm_cache import LLMCache
+from stream_parser import JsonFieldStream
+import clients
+import metrics
+if TYPE_CHECKING:
+    from langchain_openai import ChatOpenAI
+    from batch_api import BatchCollector
+    from story_index import StoryIndex
+# langchain is imported by the functions that call the LLM and the .env file is read
+# the first time the API key is needed (hf.openai_api_key)
 model = "gpt-4-0125-preview"
 temperature = 0.5
+question = "Prepara una historia de acuerdo a las instrucciones"
+
+async def abatch_chain(llm:"ChatOpenAI", prompt_values:List, max_concurrency:int,
+                       callbacks:List|None = None) -> List:
+    """
+    Runs every prompt through `llm | StrOutputParser()` at once with LCEL `abatch`.
+
+    Parameters:
+    - llm (ChatOpenAI): The chat model.
+    - prompt_values (List[PromptValue]): The rendered prompts to run.
+    - max_concurrency (int): Maximum number of simultaneous calls.
+    - callbacks (List|None): LangChain callbacks of every call (see `metrics.llm_callbacks`).
+
+    Returns:
+    - results (List): The completion text or the exception raised for each prompt, in the order of the prompts.
+    """
+    from langchain_core.output_parsers import StrOutputParser
+    chain = llm | StrOutputParser()
+    return await chain.abatch(prompt_values,
+                              config={"max_concurrency": max(1, max_concurrency), "callbacks": callbacks or []},
+                              return_exceptions=True)
+
+async def astream_chain(llm:"ChatOpenAI", prompt_values:List, max_concurrency:int,
+                        on_chunk:Callable[[int, str], None], callbacks:List|None = None) -> List:
+    """
+    Streams every prompt through `llm | StrOutputParser()` at once, with at most `max_concurrency` streams open.
+
+    Parameters:
+    - llm (ChatOpenAI): The chat model.
+    - prompt_values (List[PromptValue]): The rendered prompts to run.
+    - max_concurrency (int): Maximum number of simultaneous calls.
+    - on_chunk (Callable[[int, str], None]): Called with the position of the prompt and every chunk of its answer.
+    - callbacks (List|None): LangChain callbacks of every call (see `metrics.llm_callbacks`).
+
+    Returns:
+    - results (List): The completion text or the exception raised for each prompt, in the order of the prompts.
+    """
+    from langchain_core.output_parsers import StrOutputParser
+    chain = llm | StrOutputParser()
+    semaphore = asyncio.Semaphore(max(1, max_concurrency))
+
+    async def stream(i:int, prompt_value) -> str:
+        async with semaphore:
+            chunks = []
+            async for chunk in chain.astream(prompt_value, config={"callbacks": callbacks or []}):
+                chunks.append(chunk)
+                on_chunk(i, chunk)
+            return "".join(chunks)
+
+    return await asyncio.gather(*[stream(i, prompt_value) for i, prompt_value in enumerate(prompt_values)],
+                                return_exceptions=True)
 
-def llm_call_chain_for_history_generation(api_key:str = openai_api_key,
+def generate_completions(llm:"ChatOpenAI", prompt_values:List, max_concurrency:int|None = None,
+                         callbacks:List|None = None,
+                         on_chunk:Callable[[int, str], None]|None = None,
+                         batch:"BatchCollector|None" = None) -> List:
+    """
+    Sends the rendered prompts to the LLM, one at a time or all at once if max_concurrency is given.
+    With a batch collector they are sent through the Batch API instead, and the call waits for the batch.
+
+    Parameters:
+    - llm (ChatOpenAI): The chat model.
+    - prompt_values (List[PromptValue]): The rendered prompts to run.
+    - max_concurrency (int|None): Maximum number of simultaneous calls. None to send the prompts one at a time.
+    - callbacks (List|None): LangChain callbacks of every call (see `metrics.llm_callbacks`).
+    - on_chunk (Callable[[int, str], None]|None): If given the answers are streamed and it is called with the
+      position of the prompt and every chunk of its answer.
+    - batch (BatchCollector|None): If given the prompts are sent in the next batch of the Batch API
+      (neither max_concurrency nor on_chunk are used).
+
+    Returns:
+    - results (List): The completion text or the exception raised for each prompt, in the order of the prompts.
+    """
+    if not prompt_values:
+        return []
+    if batch is not None:
+        return batch.complete(prompt_values, llm.model_name, llm.temperature)
+    if max_concurrency is not None:
+        if on_chunk is not None:
+            return clients.run(astream_chain(llm, prompt_values, max_concurrency, on_chunk, callbacks))
+        return clients.run(abatch_chain(llm, prompt_values, max_concurrency, callbacks))
+    from langchain_core.output_parsers import StrOutputParser
+    chain = llm | StrOutputParser()
+    results = []
+    for i, prompt_value in enumerate(prompt_values):
+        try:
+            if on_chunk is None:
+                results.append(chain.invoke(prompt_value, config={"callbacks": callbacks or []}))
+                continue
+            chunks = []
+            for chunk in chain.stream(prompt_value, config={"callbacks": callbacks or []}):
+                chunks.append(chunk)
+                on_chunk(i, chunk)
+            results.append("".join(chunks))
+        except Exception as e:
+            results.append(e)
+    return results
+
+def llm_call_chain_for_history_generation(api_key:str|None = None,
                                           model:str = model,
                                           t:float=temperature,
                                           logger:logging.Logger|None = None,
                                           parser:str|None = None,
-                                          prompts:List[str]|None = None) -> Dict[str,Dict[str,str]]:
+                                          prompts:List[str]|None = None,
+                                          max_concurrency:int|None = None,
+                                          cache:LLMCache|None = None,
+                                          base_dict_values:HistoryConfig|None = None,
+                                          on_field:Callable[[str, str, Any], None]|None = None,
+                                          batch:"BatchCollector|None" = None) -> Dict[str,Dict[str,str]]:
     """
     Generates a call chain for history generation using the ChatOpenAI class.
 
     Parameters:
-    - api_key (str): The API key for OpenAI.
+    - api_key (str|None): The API key for OpenAI. Defaults to OPENAI_API_KEY.
     - model (str): The model to use for generating the history.
     - t (float): The temperature parameter for generating the history.
+    - max_concurrency (int|None): If given, every prompt is sent at once with `abatch` with at most
+      this number of calls in flight. If None the prompts are sent one at a time.
+    - cache (LLMCache|None): If given, completions of already seen prompts are read from the cache
+      and only the missing ones are sent to the LLM. Defaults to None.
+    - base_dict_values (HistoryConfig|None): The configuration used when no prompts are given. Defaults to None.
+    - on_field (Callable[[str, str, Any], None]|None): If given the answers are streamed and parsed as they
+      arrive, and it is called with (history_<i>, key, value) as soon as each field of an answer is complete,
+      before the rest of the answer is written. Answers from the cache call it for every field at once.
+      Defaults to None.
+    - batch (BatchCollector|None): If given the prompts missing from the cache are sent through the
+      Batch API and parsed when the batch is done. Defaults to None.
 
     Returns:
     - out_put_histories (dict): A dictionary containing the generated histories.
 
     """
-    llm = ChatOpenAI(api_key=api_key, model=model, temperature=t)
+    if api_key is None:
+        api_key = hf.openai_api_key()
+    llm = clients.chat_model(api_key, model, t)
     #case condition
     
     if parser is None and prompts is None:
-        output_parser, output_prompts = pp.generate_prompts()
+        output_parser, output_prompts = pp.generate_prompts(base_dict_values=base_dict_values)
         parser = output_parser
         prompts = output_prompts
 
-    out_put_histories = {}
-    for i, prompt in enumerate(prompts):
-        chain = prompt | llm | parser
+    prompt_values = [prompt.format_prompt(question=question) for prompt in prompts]
+    completions = [None] * len(prompt_values)
+    keys = [None] * len(prompt_values)
+    if cache is not None:
+        for i, prompt_value in enumerate(prompt_values):
+            keys[i] = LLMCache.make_key(prompt_value.to_string(), model, t)
+            completions[i] = cache.get(keys[i])
+        if logger is not None:
+            hits = sum(completion is not None for completion in completions)
+            logger.info(f"LLM cache: {hits} hits, {len(completions) - hits} misses")
+
+    pending = [i for i, completion in enumerate(completions) if completion is None]
+    on_chunk = None
+    if on_field is not None:
+        for i, completion in enumerate(completions):
+            if completion is not None:
+                for key, value in JsonFieldStream().feed(completion):
+                    on_field(f"history_{i}", key, value)
+        streams = {i: JsonFieldStream() for i in pending}
+
+        def on_chunk(position:int, chunk:str) -> None:
+            i = pending[position]
+            for key, value in streams[i].feed(chunk):
+                on_field(f"history_{i}", key, value)
+
+    generated = generate_completions(llm, [prompt_values[i] for i in pending], max_concurrency,
+                                     callbacks=metrics.llm_callbacks(), on_chunk=on_chunk, batch=batch)
+    for i, completion in zip(pending, generated):
+        completions[i] = completion
+
+    results = []
+    for i, completion in enumerate(completions):
+        if isinstance(completion, Exception):
+            results.append(completion)
+            continue
         try:
-            result = chain.invoke({"question": "Prepara una historia de acuerdo a las instrucciones"})
+            results.append(parser.parse(completion))
         except Exception as e:
+            results.append(e)
+            continue
+        # only completions that can be parsed are kept
+        if cache is not None and i in pending:
+            cache.set(keys[i], completion)
+
+    out_put_histories = {}
+    for i, result in enumerate(results):
+        if isinstance(result, Exception):
             if logger is not None:
-                logger.error(f"Error while generating history: {e}")
-            result = {"error": str(e)}
+                logger.error(f"Error while generating history: {result}")
+            result = {"error": str(result)}
         try:
             out_put_histories[f"history_{i}"] = result
             if logger is not None:
@@ -79,23 +240,35 @@ def select_best_histories_step_1(data:Dict[str,Dict[str,str]]) -> Dict[str,str]:
         best_histories[new_key] = best_history
     return best_histories
 
-def make_review(data:Dict[str,Dict[str,str]], api_key:str = openai_api_key,
-                base_dict_values:Dict[str,str] = None,
+def make_review(data:Dict[str,Dict[str,str]], api_key:str|None = None,
+                base_dict_values:HistoryConfig|None = None,
                 model:str = model, t:float=temperature, logger:logging.Logger|None = None,
-                prompts:List[str]|None = None, parser:List|None = None) -> Dict[str,str]:
+                prompts:List[str]|None = None, parser:List|None = None,
+                max_concurrency:int|None = None, cache:LLMCache|None = None,
+                on_field:Callable[[str, str, Any], None]|None = None,
+                batch:"BatchCollector|None" = None,
+                story_index:"StoryIndex|None" = None) -> Dict[str,str]:
     """
     Generates a review based on the best story. It typically adds text and makes the history more interesting.
     A single pass typically improves the story.
 
     Args:
         data (Dict[str,Dict[str,str]]): The input data for generating the review.
-        api_key (str, optional): The API key for the OpenAI service. Defaults to openai_api_key.
-        base_dict_values (Dict[str,str], optional): The base dictionary values. Defaults to None.
+        api_key (str|None, optional): The API key for the OpenAI service. Defaults to OPENAI_API_KEY.
+        base_dict_values (HistoryConfig|None, optional): The configuration values. Defaults to None.
         model (str, optional): The model to use for generating the review. Defaults to model.
         t (float, optional): The temperature parameter for generating the review. Defaults to temperature.
         logger (logging.Logger|None, optional): The logger object for logging the review process. Defaults to None.
-        prompts (List[str]|None, optional): The list of prompts for generating the review. Defaults to None.
+        prompts (List[str]|None, optional): The details of the reviews, the end of their prompts
+            (see pp.review_best_history_template). Defaults to None.
         parser (List|None, optional): The parser object for formatting the review output. Defaults to None.
+        max_concurrency (int|None, optional): If given, all the reviews are requested at once. Defaults to None.
+        cache (LLMCache|None, optional): The cache of LLM completions. Defaults to None.
+        on_field (Callable[[str, str, Any], None]|None, optional): Streams the reviews and is called with each
+            field (page_<i>, title...) as soon as it is complete. Defaults to None.
+        batch (BatchCollector|None, optional): Sends the reviews through the Batch API. Defaults to None.
+        story_index (StoryIndex|None, optional): The index of the previous stories. The summaries of the ones
+            most similar to each story are added to its prompt (`other_histories`). Defaults to None.
 
     Returns:
         Dict[str,str]: The generated review.
@@ -103,17 +276,27 @@ def make_review(data:Dict[str,Dict[str,str]], api_key:str = openai_api_key,
     
     all_histories = select_best_histories_step_1(data)
     if prompts is None:
-        prompts = pp.generate_base_prompt_review(all_histories, base_dict_values)
+        other_histories = None
+        if story_index is not None:
+            other_histories = [story_index.other_histories(text) for text in all_histories.values()]
+            if logger is not None:
+                for k, other in zip(all_histories, other_histories):
+                    logger.info(f"Similar previous stories of {k}: {other}")
+        prompts = pp.generate_base_prompt_review(all_histories, base_dict_values, other_histories)
 
+    format_instructions = None
     if parser is None:
-        parser = pp.prepare_answer_format_review(base_dict_values)
-    output_parser, output_prompts = pp.generate_prompts(prompts, parser)
+        parser, format_instructions = pp.prepare_answer_format_review(base_dict_values)
+    output_parser, output_prompts = pp.generate_prompts(prompts, parser, instructions=pp.review_instructions,
+                                                        format_instructions=format_instructions)
     if logger is not None:
         logger.info("Review started")
         logger.info(output_prompts)
         
     result = llm_call_chain_for_history_generation(api_key=api_key, model=model, t=t, logger=logger,
-                                                   parser=output_parser, prompts=output_prompts)
+                                                   parser=output_parser, prompts=output_prompts,
+                                                   max_concurrency=max_concurrency, cache=cache,
+                                                   on_field=on_field, batch=batch)
     if logger is not None:
         logger.info("Review completed")
         for k,v in result.items():
@@ -121,7 +304,11 @@ def make_review(data:Dict[str,Dict[str,str]], api_key:str = openai_api_key,
     return result
 
 def make_prompt_images_after_review(data:Dict[str,Dict[str,str]], logger:logging.Logger|None = None,
-                             base_dict_values:Dict[str,str]|None = None)-> Dict[str,Dict[str,str]]:
+                             base_dict_values:HistoryConfig|None = None,
+                             max_concurrency:int|None = None,
+                             cache:LLMCache|None = None,
+                             on_field:Callable[[str, str, Any], None]|None = None,
+                             batch:"BatchCollector|None" = None)-> Dict[str,Dict[str,str]]:
     """
     Generates image prompts for each history in the given data dictionary.
     It try to preserve overall story consistency and coherence.
@@ -130,7 +317,13 @@ def make_prompt_images_after_review(data:Dict[str,Dict[str,str]], logger:logging
     Args:
         data (Dict[str,Dict[str,str]]): A dictionary containing history data.
         logger (logging.Logger|None, optional): A logger object for logging messages. Defaults to None.
-        base_dict_values (Dict[str,str]|None, optional): A dictionary containing base values for prompts. Defaults to None.
+        base_dict_values (HistoryConfig|None, optional): The configuration values for the prompts. Defaults to None.
+        max_concurrency (int|None, optional): If given, the prompts of all the histories are requested at once. Defaults to None.
+        cache (LLMCache|None, optional): The cache of LLM completions. Defaults to None.
+        on_field (Callable[[str, str, Any], None]|None, optional): Streams the answers and is called with each
+            field (prompt_image_<i>, description_image_<i>...) as soon as it is complete, so the image of a
+            page can be requested while the next prompts are written. Defaults to None.
+        batch (BatchCollector|None, optional): Sends the requests through the Batch API. Defaults to None.
 
     Returns:
         Dict[str,Dict[str,str]]: A dictionary containing the updated data with image prompts.
@@ -139,9 +332,13 @@ def make_prompt_images_after_review(data:Dict[str,Dict[str,str]], logger:logging
         Exception: If there is an error while adding images for a history.
     """
     image_prompts = pp.generate_base_prompt_to_produce_image_prompt(data)
-    parser = pp.prepare_answer_format_to_prompt_image(base_dict_values)
-    output_parser, output_prompts = pp.generate_prompts(image_prompts, parser)
-    data_image = llm_call_chain_for_history_generation(parser=output_parser, prompts=output_prompts)
+    parser, format_instructions = pp.prepare_answer_format_to_prompt_image(base_dict_values)
+    output_parser, output_prompts = pp.generate_prompts(image_prompts, parser,
+                                                        instructions=pp.image_prompt_instructions,
+                                                        format_instructions=format_instructions)
+    data_image = llm_call_chain_for_history_generation(parser=output_parser, prompts=output_prompts,
+                                                       max_concurrency=max_concurrency, cache=cache,
+                                                       on_field=on_field, batch=batch)
     for history,image_description in data_image.items():
         try:
             for element, description in image_description.items():
@@ -0,0 +1,57 @@
+from pathlib import Path
+import base64
+import threading
+import helper_functions as hf
+import transport
+
+class ImageAssets:
+    """
+    Stores the images of a run as files so the data only keeps lightweight `Path` references.
+
+    Images returned as base64 are decoded to their file as soon as they arrive. Images returned
+    as URLs are streamed to their file through the pooled httpx client of the process (see transport.py).
+    Files are written to a temporary name first so a file with the final name is always complete.
+    """
+    def __init__(self, path:str|Path):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+
+    def path_for(self, history:str, page_number:int) -> Path:
+        return self.path / f"{history}_image_{page_number}.png"
+
+    def _temp_path(self, history:str, page_number:int) -> Path:
+        return self.path_for(history, page_number).with_suffix(f".{threading.get_ident()}.tmp")
+
+    def save_bytes(self, history:str, page_number:int, image:bytes) -> Path:
+        """
+        Writes the bytes of an image and returns its path.
+        """
+        temp_path = self._temp_path(history, page_number)
+        temp_path.write_bytes(image)
+        return temp_path.replace(self.path_for(history, page_number))
+
+    def save_b64(self, history:str, page_number:int, b64_image:str) -> Path:
+        """
+        Decodes a base64 image to its file and returns its path.
+        """
+        return self.save_bytes(history, page_number, base64.b64decode(b64_image))
+
+    def download(self, history:str, page_number:int, url:str) -> Path:
+        """
+        Streams an image from a URL to its file and returns its path.
+        """
+        temp_path = self._temp_path(history, page_number)
+        hf.download_image(url, temp_path, client=transport.http_client())
+        return temp_path.replace(self.path_for(history, page_number))
+
+    def existing(self, history:str, page_number:int) -> Path|None:
+        """
+        Returns the path of the image if it was already saved.
+        """
+        path = self.path_for(history, page_number)
+        return path if path.exists() else None
+
+    def close(self) -> None:
+        """
+        Nothing to release: the downloads use the client of the process, closed by `transport.close`.
+        """
@@ -0,0 +1,83 @@
+from pathlib import Path
+import hashlib
+import logging
+import os
+import threading
+
+path = Path(__file__).parent.parent / "images" / "cache"
+max_bytes = 1024 * 1024 * 1024  # 1GB
+
+class ImageCache:
+    """
+    Content-addressed store of generated images on disk.
+
+    Images are saved decoded, one file per key, where the key is the hash of the model, size,
+    quality and prompt. The modification time of a file is its last use: when the files exceed
+    `max_bytes` the least recently used ones are removed.
+    """
+    def __init__(self, path:str|Path = path, max_bytes:int = max_bytes):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(model:str, size:str, quality:str, prompt:str) -> str:
+        """
+        Returns the key of an image: the sha256 of the model, size, quality and prompt.
+        """
+        content = f"{model}\n{size}\n{quality}\n{prompt}".encode("utf-8")
+        return hashlib.sha256(content).hexdigest()
+
+    def _file(self, key:str) -> Path:
+        return self.path / f"{key}.png"
+
+    def get(self, key:str) -> bytes|None:
+        """
+        Returns the bytes of the cached image or None if it is missing.
+        """
+        file = self._file(key)
+        with self._lock:
+            try:
+                image = file.read_bytes()
+            except FileNotFoundError:
+                self.misses += 1
+                return None
+            os.utime(file)
+            self.hits += 1
+            return image
+
+    def set(self, key:str, image:bytes) -> None:
+        """
+        Stores the bytes of an image and removes the least recently used images if the cache is over its size.
+        """
+        file = self._file(key)
+        temp_file = file.with_suffix(f".{threading.get_ident()}.tmp")
+        with self._lock:
+            temp_file.write_bytes(image)
+            os.replace(temp_file, file)
+            self._evict()
+
+    def _evict(self) -> None:
+        files = []
+        for file in self.path.glob("*.png"):
+            try:
+                stat = file.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, file))
+        total = sum(size for _, size, _ in files)
+        for _, size, file in sorted(files):
+            if total <= self.max_bytes:
+                break
+            file.unlink(missing_ok=True)
+            total -= size
+
+    def log_stats(self, logger:logging.Logger|None) -> None:
+        """
+        Writes the hit and miss counters accumulated since the cache was opened to the logger.
+        """
+        if logger is not None:
+            logger.info(f"Image cache: {self.hits} hits, {self.misses} misses")
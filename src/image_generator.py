@@ -1,96 +1,313 @@
 import prepare_prompt as pp
-from read_configuration import history_base_values
-from dotenv import load_dotenv
+import helper_functions as hf
+from read_configuration import history_base_values, HistoryConfig
 import logging
 import os
-from typing import Dict, Any
+from typing import Dict, Any, List, Tuple, Callable
 import pickle
-from openai import OpenAI
+import asyncio
+import base64
+from pathlib import Path
+from image_cache import ImageCache
+from image_assets import ImageAssets
+import clients
+import metrics
+import time
 
-openai_api_key = os.getenv('OPENAI_API_KEY')
+# the openai clients are built when the first image is requested and kept warm (see clients)
 model = "dall-e-3"
+size = "1024x1024"
+quality = "standard"
 
-def generate_images_for_history(api_key = openai_api_key,
+def read_cached_image(cache:ImageCache|None, model:str, prompt:str,
+                      assets:ImageAssets|None=None, history:str|None=None,
+                      page_number:int|None=None) -> str|Path|None:
+    """
+    Returns the cached image for the prompt or None if it is not cached.
+    If assets are given the image is written to its file and its path is returned, otherwise
+    the image is returned in base64 format.
+    """
+    if cache is None:
+        return None
+    image = cache.get(ImageCache.make_key(model, size, quality, prompt))
+    if image is None:
+        return None
+    if assets is not None:
+        return assets.save_bytes(history, page_number, image)
+    return base64.b64encode(image).decode("utf-8")
+
+def store_cached_image(cache:ImageCache|None, model:str, prompt:str, image:str|Path) -> None:
+    """
+    Stores the decoded image (a base64 string or the path of the image file) in the cache.
+    """
+    if cache is not None:
+        image_bytes = image.read_bytes() if isinstance(image, Path) else base64.b64decode(image)
+        cache.set(ImageCache.make_key(model, size, quality, prompt), image_bytes)
+
+def image_bytes(image:str|Path) -> int:
+    return image.stat().st_size if isinstance(image, Path) else len(image) * 3 // 4
+
+def save_image(item, response_format:str, assets:ImageAssets|None,
+               history:str, page_number:int) -> str|Path:
+    """
+    Returns the image of an images.generate response item.
+    With assets the image is saved to its file right away (decoded or streamed from the URL) and its
+    path is returned. Without assets the base64 string is returned.
+    """
+    if response_format == "url":
+        if assets is None:
+            raise ValueError("The url response format needs image assets to download the images")
+        return assets.download(history, page_number, item.url)
+    if assets is not None:
+        return assets.save_b64(history, page_number, item.b64_json)
+    return item.b64_json
+
+async def generate_images_concurrently(api_key:str, model:str,
+                                       jobs:List[Tuple[str,int,int,str]],
+                                       max_concurrency:int,
+                                       logger:logging.Logger|None=None,
+                                       cache:ImageCache|None=None,
+                                       on_image:Callable[[str,int,str|Path],None]|None=None,
+                                       assets:ImageAssets|None=None,
+                                       response_format:str="b64_json") -> List[Tuple[str,int,str|Path]]:
+    """
+    Sends every image request at once using AsyncOpenAI. A semaphore caps the number of requests in flight.
+
+    Args:
+        api_key (str|None): The OpenAI API key. Defaults to OPENAI_API_KEY.
+        model (str): The OpenAI model to use for generating images.
+        jobs (List[Tuple[str,int,int,str]]): Tuples (history, j, page_number, prompt) in page order.
+        max_concurrency (int): Maximum number of simultaneous requests.
+        logger (logging.Logger|None, optional): The logger object. Defaults to None.
+        cache (ImageCache|None, optional): The image cache. Cached prompts are not requested. Defaults to None.
+        on_image (Callable[[str,int,str|Path],None]|None, optional): Called with (history, page_number, image)
+            as soon as each image is ready. Defaults to None.
+        assets (ImageAssets|None, optional): Where the images are saved. Defaults to None.
+        response_format (str, optional): "b64_json" or "url". Defaults to "b64_json".
+
+    Returns:
+        List[Tuple[str,int,str|Path]]: Tuples (history, page_number, image) in the same order as the jobs.
+            The image is a base64 string or, with assets, the path of its file.
+    """
+    # the client of this thread is kept warm between calls (see clients.run)
+    client = clients.async_openai_client(api_key)
+    semaphore = asyncio.Semaphore(max(1, max_concurrency))
+
+    parent = metrics.current_parent()
+
+    async def generate(history:str, j:int, page_number:int, prompt:str) -> Tuple[str,int,str|Path]:
+        start = time.perf_counter()
+        image = read_cached_image(cache, model, prompt, assets, history, page_number)
+        cached = image is not None
+        if image is None:
+            async with semaphore:
+                start = time.perf_counter()
+                response = await client.images.generate(
+                    model=model,
+                    prompt=prompt,
+                    response_format=response_format,
+                    size=size,
+                    quality=quality,
+                    n=1,
+                )
+        try:
+            if image is None:
+                # decoding or downloading the image must not block the other requests
+                image = await asyncio.to_thread(save_image, response.data[0], response_format,
+                                                assets, history, page_number)
+                store_cached_image(cache, model, prompt, image)
+            if logger is not None:
+                logger.info(f"Generated image {j} for page {page_number} for history {history}")
+        except Exception as e:
+            metrics.record("image_call", time.perf_counter() - start, status="error", parent=parent,
+                           history=history, page_number=page_number, model=model, error=str(e)[:500])
+            if logger is not None:
+                logger.error(f"Error generating image {j} for history {history}: {e}")
+            raise Exception(f"Error generating image {j} for history {history}: {e}")
+        metrics.record("image_call", time.perf_counter() - start, parent=parent, history=history,
+                       page_number=page_number, model=model, cached=cached, bytes=image_bytes(image))
+        if on_image is not None:
+            on_image(history, page_number, image)
+        return history, page_number, image
+
+    # gather keeps the order of the jobs, the logs are written in completion order
+    return await asyncio.gather(*[generate(*job) for job in jobs])
+
+def generate_images_for_history(api_key:str|None = None,
                                model = model,
                                data:Dict[str,Any]|None=None,
-                               logger:logging.Logger|None=None):
+                               logger:logging.Logger|None=None,
+                               max_concurrency:int|None=None,
+                               cache:ImageCache|None=None,
+                               on_image:Callable[[str,int,str|Path],None]|None=None,
+                               assets:ImageAssets|None=None,
+                               response_format:str="b64_json",
+                               base_dict_values:HistoryConfig|None=None):
     """
     Generates images for the history.
 
     Args:
-        api_key (str): The OpenAI API key.
+        api_key (str|None): The OpenAI API key. Defaults to OPENAI_API_KEY.
         model (str): The OpenAI model to use for generating images.
         data (Dict[str,Any]|None): The history to generate images for.
+        max_concurrency (int|None, optional): If given, all the images are requested concurrently
+            with at most this number of requests in flight. Defaults to None (one request at a time).
+        cache (ImageCache|None, optional): The image cache. Cached prompts are not requested. Defaults to None.
+        on_image (Callable[[str,int,str|Path],None]|None, optional): Called with (history, page_number, image)
+            as soon as each image is ready. Images already in the data are not generated again. Defaults to None.
+        assets (ImageAssets|None, optional): If given, every image is saved to a file as soon as it arrives
+            and the data keeps the path of the file instead of the base64 string. Defaults to None.
+        response_format (str, optional): "b64_json" or "url". The url format needs assets, the images are
+            streamed from the URL to their file. Defaults to "b64_json".
+        base_dict_values (HistoryConfig|None, optional): The configuration. Defaults to None (read from configuration.ini).
 
     Returns:
         Dict[str,Any]: The updated history with image URLs.
 
     """
-    client = OpenAI(api_key=api_key)
-    base_dict_values = history_base_values()
-    number_of_pages = base_dict_values["pages"]
-    base_prompt_template_images = pp.generate_base_prompt_image()
+    if base_dict_values is None:
+        base_dict_values = history_base_values()
+    number_of_pages = base_dict_values.pages
+    base_prompt_template_images = pp.generate_base_prompt_image(base_dict_values)
+    if api_key is None:
+        api_key = hf.openai_api_key()
+    if max_concurrency is not None:
+        jobs = []
+        for i, (key,history) in enumerate(data.items()):
+            for j in range(number_of_pages-1):
+                if f"image_{j}" in history:
+                    continue
+                final_prompt = base_prompt_template_images[i]+history[f"page_{j}"]
+                jobs.append((key, j, j, final_prompt))
+        if not jobs:
+            return data
+        results = clients.run(generate_images_concurrently(api_key, model, jobs, max_concurrency, logger,
+                                                           cache, on_image, assets, response_format))
+        for key, page_number, image in results:
+            data[key][f"image_{page_number}"] = image
+        return data
+
+    client = None
     for i, (key,history) in enumerate(data.items()):
         for j in range(number_of_pages-1):
+            if f"image_{j}" in history:
+                continue
             base_prompt = base_prompt_template_images[i]      
             reference_text = history[f"page_{j}"]
             final_prompt = base_prompt+reference_text
-            response = client.images.generate(
-                model=model,
-                prompt=final_prompt,
-                response_format="b64_json",
-                size="1024x1024",
-                quality="standard",
-                n=1,
-            )
-            try:
-                
-                data[key][f"image_{j}"] = response.data[0].b64_json
-                if logger is not None:
-                    logger.info(f"Generated image {j} for history {key}")
-            except Exception as e:
-                if logger is not None:
-                    logger.error(f"Error generating image {j} for history {key}: {e}")
-                raise Exception(f"Error generating image {j} for history {key}: {e}")
+            with metrics.span("image_call", history=key, page_number=j, model=model) as values:
+                image = read_cached_image(cache, model, final_prompt, assets, key, j)
+                values["cached"] = image is not None
+                if image is None:
+                    if client is None:
+                        client = clients.openai_client(api_key)
+                    response = client.images.generate(
+                        model=model,
+                        prompt=final_prompt,
+                        response_format=response_format,
+                        size=size,
+                        quality=quality,
+                        n=1,
+                    )
+                try:
+                    if image is None:
+                        image = save_image(response.data[0], response_format, assets, key, j)
+                        store_cached_image(cache, model, final_prompt, image)
+                    data[key][f"image_{j}"] = image
+                    values["bytes"] = image_bytes(image)
+                    if logger is not None:
+                        logger.info(f"Generated image {j} for history {key}")
+                    if on_image is not None:
+                        on_image(key, j, image)
+                except Exception as e:
+                    if logger is not None:
+                        logger.error(f"Error generating image {j} for history {key}: {e}")
+                    raise Exception(f"Error generating image {j} for history {key}: {e}")
     return data
-def generate_images_for_history_after_review(api_key = openai_api_key,
+def generate_images_for_history_after_review(api_key:str|None = None,
                                model = model,
                                data:Dict[str,Any]|None=None,
-                               logger:logging.Logger|None=None)->Dict[str,Dict[str,str]]:
+                               logger:logging.Logger|None=None,
+                               max_concurrency:int|None=None,
+                               cache:ImageCache|None=None,
+                               on_image:Callable[[str,int,str|Path],None]|None=None,
+                               assets:ImageAssets|None=None,
+                               response_format:str="b64_json")->Dict[str,Dict[str,str]]:
     """
     Generates images for the history.
 
     Args:
-        api_key (str): The OpenAI API key.
+        api_key (str|None): The OpenAI API key. Defaults to OPENAI_API_KEY.
         model (str): The OpenAI model to use for generating images.
         data (Dict[str,Any]|None): The history to generate images for.
+        max_concurrency (int|None, optional): If given, every prompt_image of every history is requested
+            concurrently with at most this number of requests in flight. Defaults to None (one request at a time).
+        cache (ImageCache|None, optional): The image cache. Cached prompts are not requested. Defaults to None.
+        on_image (Callable[[str,int,str|Path],None]|None, optional): Called with (history, page_number, image)
+            as soon as each image is ready. Images already in the data are not generated again. Defaults to None.
+        assets (ImageAssets|None, optional): If given, every image is saved to a file as soon as it arrives
+            and the data keeps the path of the file instead of the base64 string. Defaults to None.
+        response_format (str, optional): "b64_json" or "url". The url format needs assets, the images are
+            streamed from the URL to their file. Defaults to "b64_json".
 
     Returns:
         Dict[str,Any]: The updated history with image URLs.
 
     """
-    client = OpenAI(api_key=api_key)
+    if api_key is None:
+        api_key = hf.openai_api_key()
+    if max_concurrency is not None:
+        jobs = []
+        for history, elemets in data.items():
+            image_prompts = [(int(k.split('_')[-1].strip()),v) for k,v in elemets.items() if "prompt_image" in k]
+            prompts_sorted = sorted(image_prompts,key=lambda x: x[0])# Ensure the order of the prompts
+            for j,(page_number,prompt) in enumerate(prompts_sorted):
+                if f"image_{page_number}" in elemets:
+                    continue
+                jobs.append((history, j, page_number, prompt))
+        if not jobs:
+            return data
+        results = clients.run(generate_images_concurrently(api_key, model, jobs, max_concurrency, logger,
+                                                           cache, on_image, assets, response_format))
+        for history, page_number, image in results:
+            data[history][f"image_{page_number}"] = image
+        return data
+
+    client = None
     for i, (history,elemets) in enumerate(data.items()):
         image_prompts = [(int(k.split('_')[-1].strip()),v) for k,v in elemets.items() if "prompt_image" in k]
         prompts_sorted = sorted(image_prompts,key=lambda x: x[0])# Ensure the order of the prompts
         for j,(page_number,prompt) in enumerate(prompts_sorted):
-            response = client.images.generate(
-                model=model,
-                prompt=prompt,
-                response_format="b64_json",
-                size="1024x1024",
-                quality="standard",
-                n=1,
-            )
-            try:
-                
-                data[history][f"image_{page_number}"] = response.data[0].b64_json
-                if logger is not None:
-                    logger.info(f"Generated image {j} for page {page_number} for history {history}")
-            except Exception as e:
-                if logger is not None:
-                    logger.error(f"Error generating image {j} for history {history}: {e}")
-                raise Exception(f"Error generating image {j} for history {history}: {e}")
+            if f"image_{page_number}" in elemets:
+                continue
+            with metrics.span("image_call", history=history, page_number=page_number, model=model) as values:
+                image = read_cached_image(cache, model, prompt, assets, history, page_number)
+                values["cached"] = image is not None
+                if image is None:
+                    if client is None:
+                        client = clients.openai_client(api_key)
+                    response = client.images.generate(
+                        model=model,
+                        prompt=prompt,
+                        response_format=response_format,
+                        size=size,
+                        quality=quality,
+                        n=1,
+                    )
+                try:
+                    if image is None:
+                        image = save_image(response.data[0], response_format, assets, history, page_number)
+                        store_cached_image(cache, model, prompt, image)
+                    data[history][f"image_{page_number}"] = image
+                    values["bytes"] = image_bytes(image)
+                    if logger is not None:
+                        logger.info(f"Generated image {j} for page {page_number} for history {history}")
+                    if on_image is not None:
+                        on_image(history, page_number, image)
+                except Exception as e:
+                    if logger is not None:
+                        logger.error(f"Error generating image {j} for history {history}: {e}")
+                    raise Exception(f"Error generating image {j} for history {history}: {e}")
     return data
 if __name__ == "__main__":
     # path = r'C:\proyectos_personales\Cuentos\data\2024-03-24_11-58-45_histories.pkl'
@@ -0,0 +1,146 @@
+from pathlib import Path
+from typing import Dict, List, Tuple
+import hashlib
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import metrics
+
+# tmpfs on Linux, the temporary directory of the system elsewhere
+tmpfs_path = Path("/dev/shm")
+build_folder = "story_teller_latex"
+compiler = "pdflatex"
+compile_timeout = 120
+static_prefixes = (r"\documentclass", r"\usepackage")
+
+def build_root(build_dir:str|Path|None = None) -> Path:
+    """
+    Returns the directory where the formats and the compiles live: `build_dir` if given, else a
+    folder in tmpfs (/dev/shm) when it is writable, else in the temporary directory of the system.
+    """
+    if build_dir:
+        root = Path(build_dir)
+    elif tmpfs_path.is_dir() and os.access(tmpfs_path, os.W_OK):
+        root = tmpfs_path / build_folder
+    else:
+        root = Path(tempfile.gettempdir()) / build_folder
+    root.mkdir(parents=True, exist_ok=True)
+    return root
+
+def split_preamble(tex:str) -> Tuple[List[str], List[str], str]:
+    """
+    Splits a document generated by pylatex in the fixed part of its preamble (document class and packages,
+    the same for every book), the rest of the preamble (title, page style, lengths...) and the body.
+    """
+    header, marker, body = tex.partition("\\begin{document}")
+    if not marker:
+        raise Exception("The document has no \\begin{document}")
+    static, dynamic = [], []
+    for line in header.splitlines():
+        if not line.strip():
+            continue
+        (static if line.lstrip().startswith(static_prefixes) else dynamic).append(line)
+    return static, dynamic, marker + body
+
+def format_name(static:List[str]) -> str:
+    return "storybook-" + hashlib.sha256("\n".join(static).encode("utf-8")).hexdigest()[:12]
+
+_formats: Dict[str, Path|None] = {}
+_formats_lock = threading.Lock()
+
+def ensure_format(static:List[str], root:Path, logger:logging.Logger|None = None) -> str|None:
+    """
+    Dumps the fixed preamble in a format file (mylatexformat) the first time it is seen in this process
+    and returns its name. Later compiles start from the format instead of loading the class and the
+    packages again. Returns None if the format cannot be built, the documents are then compiled as usual.
+    """
+    name = format_name(static)
+    with _formats_lock:
+        if name in _formats:
+            return name if _formats[name] is not None else None
+        format_dir = root / "formats"
+        format_dir.mkdir(parents=True, exist_ok=True)
+        source = format_dir / f"{name}.tex"
+        source.write_text("\n".join(static) + "\n\\begin{document}\n\\end{document}\n", encoding="utf-8")
+        command = [compiler, "-ini", "-interaction=nonstopmode", "-halt-on-error", f"-jobname={name}",
+                   f"&{compiler}", "mylatexformat.ltx", source.name]
+        with metrics.span("latex_format", file=f"{name}.fmt") as values:
+            try:
+                process = subprocess.run(command, cwd=format_dir, capture_output=True, timeout=compile_timeout)
+                built = process.returncode == 0 and (format_dir / f"{name}.fmt").exists()
+            except (OSError, subprocess.TimeoutExpired) as e:
+                process, built = None, False
+                values["error"] = str(e)
+            values["built"] = built
+        if not built:
+            _formats[name] = None
+            if logger is not None:
+                output = process.stdout.decode("utf-8", errors="replace")[-500:] if process is not None else ""
+                logger.warning(f"The LaTeX format {name} could not be built, compiling without it. {output}")
+            return None
+        _formats[name] = format_dir / f"{name}.fmt"
+        if logger is not None:
+            logger.info(f"LaTeX format {name} built in {format_dir}")
+        return name
+
+def compile_tex(tex:str, pdf_path:str|Path, clean:bool = True, build_dir:str|Path|None = None,
+                use_format:bool = True, logger:logging.Logger|None = None) -> Dict[str, float|bool]:
+    """
+    Compiles a document generated by pylatex with pdflatex in its own build directory in tmpfs and
+    copies the PDF (and the log and aux files if `clean` is False) next to `pdf_path`.
+    The working directory of the process is not changed, so several documents can be compiled at once.
+
+    Args:
+        tex (str): The LaTeX code of the document (`Document.dumps()`).
+        pdf_path (str | Path): The path of the PDF to generate.
+        clean (bool, optional): Whether to leave out the auxiliary files (log, aux). Defaults to True.
+        build_dir (str | Path | None, optional): The build directory. Defaults to None (tmpfs).
+        use_format (bool, optional): Whether to start from the precompiled preamble. Defaults to True.
+        logger (logging.Logger | None, optional): The logger object. Defaults to None.
+
+    Returns:
+        Dict[str, float|bool]: Whether the format was used and the pdflatex runs.
+    """
+    if shutil.which(compiler) is None:
+        raise Exception(f"{compiler} not found, install a TeX distribution or use the native PDF backend")
+    pdf_path = Path(pdf_path)
+    root = build_root(build_dir)
+    static, dynamic, body = split_preamble(tex)
+    name = ensure_format(static, root, logger) if use_format else None
+    if name is not None:
+        # with the format, the preamble up to \endofdump is already loaded
+        source = "\n".join(static + [r"\endofdump"] + dynamic) + "\n" + body
+        command = [compiler, f"-fmt={name}"]
+    else:
+        source = "\n".join(static + dynamic) + "\n" + body
+        command = [compiler]
+    job = Path(tempfile.mkdtemp(prefix="job_", dir=root))
+    env = dict(os.environ, TEXFORMATS=f"{root / 'formats'}{os.pathsep}")
+    try:
+        jobname = pdf_path.stem
+        (job / f"{jobname}.tex").write_text(source, encoding="utf-8")
+        command += ["-interaction=nonstopmode", "-halt-on-error", f"-jobname={jobname}", f"{jobname}.tex"]
+        runs = 0
+        while True:
+            runs += 1
+            process = subprocess.run(command, cwd=job, env=env, capture_output=True, timeout=compile_timeout)
+            log_path = job / f"{jobname}.log"
+            log = log_path.read_text(encoding="latin-1") if log_path.exists() else ""
+            if process.returncode != 0 or not (job / f"{jobname}.pdf").exists():
+                raise Exception(f"{compiler} failed for {pdf_path.name}: "
+                                f"{process.stdout.decode('utf-8', errors='replace')[-1000:]}")
+            # same rule as pylatex: compile again while LaTeX asks for it
+            if "Rerun to get" not in log or runs >= 3:
+                break
+        pdf_path.parent.mkdir(parents=True, exist_ok=True)
+        shutil.copyfile(job / f"{jobname}.pdf", pdf_path)
+        if not clean:
+            for suffix in (".log", ".aux"):
+                if (job / f"{jobname}{suffix}").exists():
+                    shutil.copyfile(job / f"{jobname}{suffix}", pdf_path.with_suffix(suffix))
+    finally:
+        shutil.rmtree(job, ignore_errors=True)
+    return {"format": name is not None, "runs": runs}
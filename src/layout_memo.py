@@ -0,0 +1,106 @@
+from pathlib import Path
+from typing import Tuple
+import base64
+import hashlib
+import io
+import logging
+import sqlite3
+import struct
+import threading
+import time
+
+path = Path(__file__).parent.parent / "data" / "layout_memo.sqlite3"
+# Part of every key: change it when the page layout changes (document class, margins, probe...)
+# so the widths fitted for the old layout are not reused
+layout_version = 2
+# How a width was fitted, also part of every key: the single-compile probe is an estimate of the page and
+# can choose another width than the compile loop, so the widths of one method are never used by the other
+fit_methods = ("loop", "probe")
+png_signature = b"\x89PNG\r\n\x1a\n"
+
+def image_size(image:str|Path) -> Tuple[int, int]:
+    """
+    Returns the width and height in pixels of an image of the data, a file (Path) or a base64 string.
+    PNG sizes are read from the header, other formats are opened with Pillow.
+    """
+    if isinstance(image, Path):
+        with open(image, "rb") as f:
+            header = f.read(24)
+    else:
+        header = base64.b64decode(image[:32])
+    if header[:8] == png_signature and header[12:16] == b"IHDR":
+        return struct.unpack(">II", header[16:24])
+    from PIL import Image
+    source = image if isinstance(image, Path) else io.BytesIO(base64.b64decode(image))
+    with Image.open(source) as opened:
+        return opened.size
+
+class LayoutMemo:
+    """
+    On-disk memo of the image widths fitted to the pages, stored in SQLite.
+
+    The width chosen for a page only depends on its text, the size of its image, the font, the title
+    (on the first page), the widths tried and the fit method, so it is keyed by the hash of those and reused by every
+    later book and run with the same page. The rows are a few bytes and are never evicted.
+    """
+    def __init__(self, path:str|Path = path):
+        self.path = Path(path)
+        self.path.parent.mkdir(exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(str(self.path), check_same_thread=False, timeout=30)
+        with self._connection:
+            self._connection.execute(
+                """CREATE TABLE IF NOT EXISTS widths (
+                    key TEXT PRIMARY KEY,
+                    width TEXT NOT NULL,
+                    created REAL NOT NULL,
+                    accessed REAL NOT NULL)""")
+
+    @staticmethod
+    def make_key(text:str, image_size:Tuple[int, int], font:str, widths:Tuple[str, ...],
+                 title:str|None = None, fit:str = "loop") -> str:
+        """
+        Returns the key of a page: the sha256 of the layout version, the fit method (one of `fit_methods`),
+        the font, the candidate widths (the starting width and its steps), the image size, the title of the
+        first page and the text.
+        """
+        if fit not in fit_methods:
+            raise ValueError(f"Unknown fit method {fit!r}, expected one of {fit_methods}")
+        content = (f"{layout_version}\n{fit}\n{font}\n{','.join(widths)}\n{image_size[0]}x{image_size[1]}\n"
+                   f"{title if title is not None else ''}\n{text}").encode("utf-8")
+        return hashlib.sha256(content).hexdigest()
+
+    def get(self, key:str) -> str|None:
+        """
+        Returns the memoized width for the key or None if the page was never fitted.
+        """
+        with self._lock, self._connection:
+            row = self._connection.execute("SELECT width FROM widths WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._connection.execute("UPDATE widths SET accessed = ? WHERE key = ?", (time.time(), key))
+            self.hits += 1
+            return row[0]
+
+    def set(self, key:str, width:str) -> None:
+        now = time.time()
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO widths (key, width, created, accessed) VALUES (?, ?, ?, ?)",
+                (key, width, now, now))
+
+    def log_stats(self, logger:logging.Logger|None) -> None:
+        """
+        Writes the hit and miss counters accumulated since the memo was opened to the logger.
+        """
+        if logger is None:
+            return
+        total = self.hits + self.misses
+        rate = f" ({round(100 * self.hits / total, 1)} % hits)" if total else ""
+        logger.info(f"Layout memo: {self.hits} hits, {self.misses} misses{rate}")
+
+    def close(self) -> None:
+        self._connection.close()
@@ -0,0 +1,101 @@
+from pathlib import Path
+from typing import Any, Dict, Tuple
+import base64
+import io
+import logging
+import re
+import read_configuration as rc
+import metrics
+# Pillow is imported when the first image is converted
+
+# The widest an image is printed: the text width of the books (345 TeX points, see pdf_native.py)
+max_print_width_inches = 345 / 72.27
+# converted files are named <stem>_line_art_t<threshold>_<dpi>dpi.png, so a change of the settings converts again
+suffix = "_line_art"
+converted_pattern = re.compile(r"_line_art_t\d+_\d+dpi\.png$")
+
+def line_art_name(image:Path, threshold:int, dpi:int) -> Path:
+    """
+    The file of the line art version of an image file for the threshold and print resolution.
+    """
+    return image.with_name(f"{image.stem}{suffix}_t{threshold}_{dpi}dpi.png")
+
+def line_art_bytes(image:bytes, threshold:int = 160, dpi:int = 0) -> bytes:
+    """
+    Converts an image to 1-bit line art: grey scale, downsampled to `dpi` at the widest printed width
+    (0 keeps its size) and thresholded to black and white. The result is a bilevel PNG, lossless and
+    usually ten times smaller than the colour image; pdflatex and reportlab embed it as a 1-bit image.
+
+    Args:
+        image (bytes): The bytes of the image (any format Pillow reads).
+        threshold (int, optional): The grey level (0-255) from which a pixel is white. Defaults to 160.
+        dpi (int, optional): The print resolution. Defaults to 0 (no downsampling).
+
+    Returns:
+        bytes: The bytes of the bilevel PNG.
+    """
+    from PIL import Image
+    with Image.open(io.BytesIO(image)) as source:
+        grey = source.convert("L")
+    max_width = round(dpi * max_print_width_inches)
+    if dpi > 0 and grey.width > max_width:
+        # downsample the grey image, before the threshold, so the lines keep their shape
+        grey = grey.resize((max_width, round(grey.height * max_width / grey.width)), Image.LANCZOS)
+    bilevel = grey.point(lambda value: 255 if value >= threshold else 0, mode="1")
+    output = io.BytesIO()
+    bilevel.save(output, format="PNG", optimize=True)
+    return output.getvalue()
+
+def line_art_image(image:str|Path, threshold:int = 160, dpi:int = 0) -> Tuple[str|Path, int, int]:
+    """
+    Converts an image of the data to line art. Images stored as files (Path) are written next to the
+    original, named after the threshold and the resolution (see `line_art_name`); a file already converted
+    with the same settings is reused unless the original is newer. Images in base64 format are returned in base64.
+
+    Returns:
+        Tuple[str|Path, int, int]: The converted image, its size before and after in bytes.
+    """
+    if isinstance(image, Path):
+        target = line_art_name(image, threshold, dpi)
+        if target.exists() and (not image.exists() or target.stat().st_mtime >= image.stat().st_mtime):
+            return target, image.stat().st_size if image.exists() else 0, target.stat().st_size
+        original = image.read_bytes()
+        converted = line_art_bytes(original, threshold, dpi)
+        temp_file = target.with_suffix(".tmp")
+        temp_file.write_bytes(converted)
+        return temp_file.replace(target), len(original), len(converted)
+    original = base64.b64decode(image)
+    converted = line_art_bytes(original, threshold, dpi)
+    return base64.b64encode(converted).decode("ascii"), len(original), len(converted)
+
+def line_art_for_history(data:Dict[str, Dict[str, Any]], values:rc.ImageConfig,
+                         logger:logging.Logger|None = None) -> Dict[str, Dict[str, Any]]:
+    """
+    Replaces every image of the data (image_<page>) with its line art version, between the image
+    generation and the PDF, and logs the bytes saved. Images already converted are left as they are.
+
+    Args:
+        data (Dict[str, Dict[str, Any]]): The data with the images of the histories.
+        values (rc.ImageConfig): The threshold and print resolution.
+        logger (logging.Logger|None, optional): The logger object. Defaults to None.
+
+    Returns:
+        Dict[str, Dict[str, Any]]: The same data with the converted images.
+    """
+    before, after = 0, 0
+    for history, details in data.items():
+        for key in list(details.keys()):
+            image = details[key]
+            if not key.startswith("image_") or (isinstance(image, Path) and converted_pattern.search(image.name)):
+                continue
+            with metrics.span("line_art", history=history, image=key) as span:
+                details[key], image_before, image_after = line_art_image(image, values.line_art_threshold,
+                                                                         values.print_dpi)
+                span["bytes_before"] = image_before
+                span["bytes_after"] = image_after
+            before += image_before
+            after += image_after
+    if logger is not None and before:
+        logger.info(f"Line art images: {round(before / 1024)} KiB -> {round(after / 1024)} KiB "
+                    f"({round(100 * after / before, 1)} %)")
+    return data
@@ -0,0 +1,96 @@
+from pathlib import Path
+import hashlib
+import logging
+import sqlite3
+import threading
+import time
+
+path = Path(__file__).parent.parent / "data" / "llm_cache.sqlite3"
+max_bytes = 256 * 1024 * 1024  # 256MB
+
+class LLMCache:
+    """
+    On-disk cache of LLM completions stored in SQLite.
+
+    Entries are keyed by the hash of the rendered prompt, the model and the temperature.
+    When the stored completions exceed `max_bytes` the least recently used entries are evicted.
+    If `ttl` (seconds) is given, entries older than it are treated as misses.
+    """
+    def __init__(self, path:str|Path = path, max_bytes:int = max_bytes, ttl:float|None = None):
+        self.path = Path(path)
+        self.path.parent.mkdir(exist_ok=True)
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(str(self.path), check_same_thread=False)
+        with self._connection:
+            self._connection.execute(
+                """CREATE TABLE IF NOT EXISTS completions (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    created REAL NOT NULL,
+                    accessed REAL NOT NULL)""")
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS completions_accessed ON completions (accessed)")
+
+    @staticmethod
+    def make_key(prompt:str, model:str, temperature:float) -> str:
+        """
+        Returns the key of a completion: the sha256 of the model, the temperature and the rendered prompt.
+        """
+        content = f"{model}\n{temperature!r}\n{prompt}".encode("utf-8")
+        return hashlib.sha256(content).hexdigest()
+
+    def get(self, key:str) -> str|None:
+        """
+        Returns the cached completion for the key or None if it is missing or expired.
+        """
+        now = time.time()
+        with self._lock, self._connection:
+            row = self._connection.execute(
+                "SELECT value, created FROM completions WHERE key = ?", (key,)).fetchone()
+            if row is not None and self.ttl is not None and now - row[1] > self.ttl:
+                self._connection.execute("DELETE FROM completions WHERE key = ?", (key,))
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self._connection.execute("UPDATE completions SET accessed = ? WHERE key = ?", (now, key))
+            self.hits += 1
+            return row[0]
+
+    def set(self, key:str, value:str) -> None:
+        """
+        Stores a completion and evicts the least recently used entries if the cache is over its size.
+        """
+        now = time.time()
+        size = len(value.encode("utf-8"))
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO completions (key, value, size, created, accessed) VALUES (?, ?, ?, ?, ?)",
+                (key, value, size, now, now))
+            self._evict()
+
+    def _evict(self) -> None:
+        total = self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM completions").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        rows = self._connection.execute("SELECT key, size FROM completions ORDER BY accessed ASC").fetchall()
+        for key, size in rows:
+            if total <= self.max_bytes:
+                break
+            self._connection.execute("DELETE FROM completions WHERE key = ?", (key,))
+            total -= size
+
+    def log_stats(self, logger:logging.Logger|None) -> None:
+        """
+        Writes the hit and miss counters accumulated since the cache was opened to the logger.
+        """
+        if logger is not None:
+            logger.info(f"LLM cache: {self.hits} hits, {self.misses} misses")
+
+    def close(self) -> None:
+        self._connection.close()
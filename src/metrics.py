@@ -0,0 +1,265 @@
+from pathlib import Path
+from typing import Dict, Any, List, Iterator
+from contextlib import contextmanager
+from datetime import datetime as dt
+import json
+import threading
+import time
+
+path = Path(__file__).parent.parent / "data" / "metrics"
+prometheus_prefix = "story_teller"
+
+class MetricsRecorder:
+    """
+    Writes one JSON line per span (a stage, an LLM or image call, a pdflatex compile) to
+    `data/metrics/<identifier>_metrics.jsonl` and keeps totals per span name.
+
+    Every line has the run identifier, the span name, its parent span, the start time, the duration,
+    the status (ok or error) and the attributes given to the span (history, model, tokens, bytes, retries...).
+    When the run finishes a summary line is written and, if `prometheus_path` is given, the totals are
+    written in the Prometheus textfile format.
+    """
+    def __init__(self, identifier:str, path:str|Path = path, prometheus_path:str|Path|None = None):
+        self.identifier = identifier
+        self.path = Path(path) / f"{identifier}_metrics.jsonl"
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.prometheus_path = Path(prometheus_path) if prometheus_path else None
+        self.totals: Dict[str, Dict[str, float]] = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._file = open(self.path, "a", encoding="utf-8")
+
+    def parent(self) -> str|None:
+        stack = getattr(self._local, "stack", None)
+        return stack[-1] if stack else None
+
+    def record(self, name:str, duration:float, status:str = "ok", parent:str|None = None,
+               start:float|None = None, **attributes:Any) -> None:
+        """
+        Records a span that was timed by the caller.
+        """
+        line = {"run": self.identifier, "span": name, "parent": parent,
+                "start": dt.fromtimestamp(start if start is not None else time.time() - duration).isoformat(),
+                "duration_s": round(duration, 6), "status": status}
+        line.update({k: v for k, v in attributes.items() if v is not None})
+        with self._lock:
+            self._file.write(json.dumps(line, ensure_ascii=False, default=str) + "\n")
+            self._file.flush()
+            totals = self.totals.setdefault(name, {"count": 0, "errors": 0, "duration_s": 0.0})
+            totals["count"] += 1
+            totals["errors"] += status != "ok"
+            totals["duration_s"] += duration
+            for key, value in attributes.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool) and key != "page_number":
+                    totals[key] = totals.get(key, 0) + value
+
+    @contextmanager
+    def span(self, name:str, **attributes:Any) -> Iterator[Dict[str, Any]]:
+        """
+        Times the block. The yielded dictionary can be filled with more attributes (tokens, bytes...).
+        """
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        parent = stack[-1] if stack else None
+        stack.append(name)
+        start_time = time.time()
+        start = time.perf_counter()
+        status = "ok"
+        try:
+            yield attributes
+        except BaseException as e:
+            status = "error"
+            attributes["error"] = str(e)[:500]
+            raise
+        finally:
+            stack.pop()
+            self.record(name, time.perf_counter() - start, status=status, parent=parent,
+                        start=start_time, **attributes)
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        with self._lock:
+            return {name: dict(values) for name, values in self.totals.items()}
+
+    def write_prometheus(self) -> None:
+        """
+        Writes the totals in the Prometheus textfile format (for the node_exporter textfile collector).
+        """
+        if self.prometheus_path is None:
+            return
+        lines = [f"# HELP {prometheus_prefix}_span_duration_seconds Time spent in each span.",
+                 f"# TYPE {prometheus_prefix}_span_duration_seconds summary"]
+        summary = self.summary()
+        run = self.identifier
+        for name, values in summary.items():
+            labels = f'run="{run}",span="{name}"'
+            lines.append(f"{prometheus_prefix}_span_duration_seconds_sum{{{labels}}} {values['duration_s']:.6f}")
+            lines.append(f"{prometheus_prefix}_span_duration_seconds_count{{{labels}}} {int(values['count'])}")
+        lines.append(f"# TYPE {prometheus_prefix}_span_errors_total counter")
+        for name, values in summary.items():
+            lines.append(f'{prometheus_prefix}_span_errors_total{{run="{run}",span="{name}"}} {int(values["errors"])}')
+        lines.append(f"# TYPE {prometheus_prefix}_span_value_total counter")
+        for name, values in summary.items():
+            for key, value in values.items():
+                if key in ("count", "errors", "duration_s"):
+                    continue
+                metric = key.replace(".", "_")
+                lines.append(f'{prometheus_prefix}_span_value_total{{run="{run}",span="{name}",value="{metric}"}} {value}')
+        self.prometheus_path.parent.mkdir(parents=True, exist_ok=True)
+        temp_file = self.prometheus_path.with_suffix(self.prometheus_path.suffix + ".tmp")
+        temp_file.write_text("\n".join(lines) + "\n", encoding="utf-8")
+        temp_file.replace(self.prometheus_path)
+
+    def close(self) -> None:
+        with self._lock:
+            self._file.write(json.dumps({"run": self.identifier, "summary": self.totals}, default=str) + "\n")
+            self._file.close()
+        self.write_prometheus()
+
+_recorder: MetricsRecorder|None = None
+_recorder_lock = threading.Lock()
+
+def start_run(identifier:str, path:str|Path = path, prometheus_path:str|Path|None = None) -> MetricsRecorder:
+    """
+    Starts recording the metrics of a run. The spans of every module go to this recorder until `stop_run`.
+    """
+    global _recorder
+    with _recorder_lock:
+        if _recorder is not None:
+            _recorder.close()
+        _recorder = MetricsRecorder(identifier, path, prometheus_path)
+        return _recorder
+
+def stop_run() -> Dict[str, Dict[str, float]]|None:
+    """
+    Closes the current run and returns its totals.
+    """
+    global _recorder
+    with _recorder_lock:
+        recorder, _recorder = _recorder, None
+    if recorder is None:
+        return None
+    summary = recorder.summary()
+    recorder.close()
+    return summary
+
+def recorder() -> MetricsRecorder|None:
+    return _recorder
+
+@contextmanager
+def span(name:str, **attributes:Any) -> Iterator[Dict[str, Any]]:
+    """
+    Times the block in the current run. Without a run it does nothing.
+    """
+    current = _recorder
+    if current is None:
+        yield attributes
+        return
+    with current.span(name, **attributes) as values:
+        yield values
+
+def token_usage(usage:Any, prefix:str = "") -> Dict[str, int]:
+    """
+    Flattens the token usage of an OpenAI response (a dict or an object), including the nested
+    details such as prompt_tokens_details.cached_tokens. The prompt tokens read from the prompt cache
+    of OpenAI are also given as `cached_tokens` (0 when the response does not report them).
+    """
+    if usage is None:
+        return {}
+    if not isinstance(usage, dict):
+        usage = usage.model_dump() if hasattr(usage, "model_dump") else vars(usage)
+    tokens = {}
+    for key, value in usage.items():
+        if isinstance(value, dict) or hasattr(value, "model_dump"):
+            tokens.update(token_usage(value, prefix=f"{prefix}{key}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            tokens[f"{prefix}{key}"] = value
+    if not prefix and "prompt_tokens" in tokens:
+        tokens["cached_tokens"] = tokens.get("prompt_tokens_details.cached_tokens", 0)
+    return tokens
+
+def llm_callbacks(**attributes:Any) -> List[Any]:
+    """
+    LangChain callbacks that record a span per LLM call with its duration, tokens, retries and
+    bytes. The parent span is the span open when the callbacks are created. Without a run it returns [].
+    """
+    current = _recorder
+    if current is None:
+        return []
+    return [_callback_handler_class()(current, current.parent(), attributes)]
+
+_handler_class = None
+
+def _callback_handler_class() -> type:
+    # langchain is only imported when a run records metrics
+    global _handler_class
+    if _handler_class is not None:
+        return _handler_class
+    from langchain_core.callbacks import BaseCallbackHandler
+
+    class MetricsCallbackHandler(BaseCallbackHandler):
+        run_inline = True
+
+        def __init__(self, recorder:MetricsRecorder, parent:str|None, attributes:Dict[str, Any]):
+            self.recorder = recorder
+            self.parent = parent
+            self.attributes = attributes
+            self.calls: Dict[Any, Dict[str, Any]] = {}
+            self._lock = threading.Lock()
+
+        def _start(self, run_id, prompt_bytes:int, model:str|None) -> None:
+            with self._lock:
+                self.calls[run_id] = {"perf": time.perf_counter(), "time": time.time(),
+                                      "prompt_bytes": prompt_bytes, "model": model, "retries": 0}
+
+        def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+            prompt_bytes = sum(len(str(message.content).encode("utf-8")) for batch in messages for message in batch)
+            model = (kwargs.get("invocation_params") or {}).get("model_name") or (kwargs.get("invocation_params") or {}).get("model")
+            self._start(run_id, prompt_bytes, model)
+
+        def on_llm_start(self, serialized, prompts, *, run_id, **kwargs):
+            self._start(run_id, sum(len(prompt.encode("utf-8")) for prompt in prompts), None)
+
+        def on_retry(self, retry_state, *, run_id, **kwargs):
+            with self._lock:
+                if run_id in self.calls:
+                    self.calls[run_id]["retries"] += 1
+
+        def _end(self, run_id, status:str, **attributes) -> None:
+            with self._lock:
+                call = self.calls.pop(run_id, None)
+            if call is None:
+                return
+            self.recorder.record("llm_call", time.perf_counter() - call["perf"], status=status, parent=self.parent,
+                                 start=call["time"], model=call["model"], retries=call["retries"],
+                                 prompt_bytes=call["prompt_bytes"], **self.attributes, **attributes)
+
+        def on_llm_end(self, response, *, run_id, **kwargs):
+            llm_output = response.llm_output or {}
+            completion_bytes = sum(len(generation.text.encode("utf-8"))
+                                   for generations in response.generations for generation in generations)
+            self._end(run_id, "ok", completion_bytes=completion_bytes,
+                      **token_usage(llm_output.get("token_usage")))
+
+        def on_llm_error(self, error, *, run_id, **kwargs):
+            self._end(run_id, "error", error=str(error)[:500])
+
+    _handler_class = MetricsCallbackHandler
+    return _handler_class
+
+def record(name:str, duration:float, status:str = "ok", parent:str|None = None,
+           start:float|None = None, **attributes:Any) -> None:
+    """
+    Records a span timed by the caller in the current run (for code where a `with` block does not fit,
+    such as coroutines sharing a thread). Without a run it does nothing.
+    """
+    current = _recorder
+    if current is not None:
+        current.record(name, duration, status=status, parent=parent, start=start, **attributes)
+
+def current_parent() -> str|None:
+    """
+    The span open in this thread, to be used as the parent of spans recorded with `record`.
+    """
+    current = _recorder
+    return current.parent() if current is not None else None
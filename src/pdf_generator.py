@@ -1,14 +1,107 @@
 import pickle
 import helper_functions as hf
-from pylatex import Document, Command, NoEscape, Figure, NewPage
-from pylatex.utils import bold
-from read_configuration import history_base_values
+from read_configuration import history_base_values, HistoryConfig
 from pathlib import Path
 from datetime import datetime as dt
 import pickle
-from typing import List, Dict
+from typing import Callable, List, Dict, TYPE_CHECKING
 import time
 import logging
+import re
+import glob
+import threading
+import metrics
+import latex_build
+from layout_memo import LayoutMemo, image_size
+if TYPE_CHECKING:
+    from pylatex import Document
+# pylatex is imported by the functions that build the documents
+
+fit_attempts = 5
+fit_step = 0.05
+# font of the pages (document class option and size of the text), part of the layout memo keys
+page_font = r"article 16pt \Huge"
+fit_probe_pattern = re.compile(r"FITPROBE (\d+) (\d+) ([\d.]+)pt ([\d.]+)pt")
+# pylatex changes the working directory of the process while it compiles
+compile_lock = threading.Lock()
+
+def compile_document(doc: "Document", clean: bool = True, kind: str = "book",
+                     precompiled_format: bool = True, build_dir: str | None = None,
+                     logger: logging.Logger | None = None) -> None:
+    """
+    Compiles the document with pdflatex. Every compile is recorded as a `pdflatex` span.
+
+    With `precompiled_format` the document is compiled in its own build directory in tmpfs starting from a
+    format file with the class and packages already loaded (see `latex_build`), and several documents can
+    be compiled at once. Otherwise pylatex compiles it next to its path, one document at a time, so documents
+    can be generated from several threads.
+
+    Args:
+        doc (Document): The document to compile.
+        clean (bool, optional): Whether to remove the auxiliary files (log, aux). Defaults to True.
+        kind (str, optional): What the compile is for (book, fit_probe, fit_page), recorded in the metrics.
+            Defaults to "book".
+        precompiled_format (bool, optional): Whether to use the precompiled preamble and the tmpfs build
+            directory. Defaults to True.
+        build_dir (str | None, optional): The build directory. Defaults to None (tmpfs).
+        logger (logging.Logger | None, optional): The logger object. Defaults to None.
+
+    Returns:
+        None
+    """
+    pdf_path = Path(f"{doc.default_filepath}.pdf")
+    if precompiled_format:
+        with metrics.span("pdflatex", kind=kind, file=pdf_path.name) as values:
+            values.update(latex_build.compile_tex(doc.dumps(), pdf_path, clean=clean, build_dir=build_dir,
+                                                  logger=logger))
+            values["bytes"] = pdf_path.stat().st_size
+        return
+    wait = time.perf_counter()
+    with compile_lock:
+        with metrics.span("pdflatex", kind=kind, file=pdf_path.name,
+                          lock_wait_s=round(time.perf_counter() - wait, 6)) as values:
+            doc.generate_pdf(clean=clean, clean_tex=True, compiler='pdflatex')
+            values["bytes"] = pdf_path.stat().st_size if pdf_path.exists() else None
+
+def image_file(image_str: str | Path, image_path: Path) -> str:
+    """
+    Returns the file of an image of the data.
+    Images stored as files (Path) are used directly, images in base64 format are decoded to image_path.
+
+    Args:
+        image_str (str | Path): The image data in base64 format or the path of the image file.
+        image_path (Path): The path to save the image file if it is in base64 format.
+
+    Returns:
+        str: The absolute path of the image file.
+    """
+    if isinstance(image_str, Path):
+        return str(image_str.resolve())
+    image_path = str(image_path.resolve())
+    hf.convert_base64_to_jpg(image_str, image_path)
+    return image_path
+
+def temp_image_path(path: str | Path, image_key: str) -> Path:
+    """
+    Returns the file where the image `image_key` in base64 format of the document at `path` is decoded.
+    It is named after the document, so the documents of several histories can be built at the same time.
+
+    Args:
+        path (str | Path): The path of the document.
+        image_key (str): The image key.
+
+    Returns:
+        Path: The path of the temporary image file.
+    """
+    return Path(__file__).parent.parent / "images" / f"temp_{Path(path).name}_{image_key}.png"
+
+def delete_temp_images(path: str | Path) -> None:
+    """
+    Deletes the temporary image files of the document at `path` (see `temp_image_path`).
+    """
+    pattern = f"temp_{glob.escape(Path(path).name)}_image_*.png"
+    for image_path in (Path(__file__).parent.parent / "images").glob(pattern):
+        hf.delete_image(image_path)
 
 def add_image(doc, image_str, image_path: str, width: str = '0.75') -> None:
     """
@@ -16,19 +109,19 @@ def add_image(doc, image_str, image_path: str, width: str = '0.75') -> None:
 
     Args:
         doc (Document): The PDF document to add the image to.
-        image_str (str): The image data in base64 format.
-        image_path (str): The path to save the image file.
+        image_str (str | Path): The image data in base64 format or the path of the image file.
+        image_path (str): The path to save the image file if it is in base64 format.
         width (str, optional): The width of the image in the document. Defaults to '0.75'.
 
     Returns:
         None
     """
-    image_path = str(image_path.resolve())   
-    hf.convert_base64_to_jpg(image_str, image_path)
+    from pylatex import Figure, NoEscape
+    image_path = image_file(image_str, image_path)
     with doc.create(Figure(position='h!')) as figure:
         figure.add_image(image_path, width=NoEscape(rf'{width}\textwidth'))
     #hf.delete_image(image_path)
-def set_up_document(path:str, type:str = 'article',points:str = '16pt')->Document:
+def set_up_document(path:str, type:str = 'article',points:str = '16pt')->"Document":
     """
     Sets up a document with the specified path, type, and font size.
 
@@ -40,6 +133,7 @@ def set_up_document(path:str, type:str = 'article',points:str = '16pt')->Documen
     Returns:
         Document: The initialized document object.
     """
+    from pylatex import Document
     doc = Document(default_filepath = path,
         documentclass=type,
         page_numbers=False,
@@ -56,6 +150,7 @@ def set_up_title(doc, title:str)->None:
     Returns:
         None
     """
+    from pylatex import Command, NoEscape
     doc.preamble.append(Command('title', title))
     doc.preamble.append(NoEscape(r'\usepackage{titling}'))
     doc.preamble.append(NoEscape(r'\pretitle{\begin{center}\Huge\bfseries}'))
@@ -78,10 +173,11 @@ def set_up_first_page(data: Dict[str, Dict[str, str]], path: str, title: str, hi
     Returns:
         doc: The configured document object.
     """
+    from pylatex import NoEscape
     doc = set_up_document(path, type='article', points='16pt')
     
     set_up_title(doc, title)
-    image_path = Path(__file__).parent.parent / "images" / "temp_image_0.jpg"
+    image_path = temp_image_path(path, "image_0")
     if "image_0" in data[history].keys(): 
         image_src = data[history]['image_0']
         add_image(doc, image_src, image_path, width=width)
@@ -90,7 +186,7 @@ def set_up_first_page(data: Dict[str, Dict[str, str]], path: str, title: str, hi
         doc.append(NoEscape(data[history]['page_0']))
     return doc
 
-def set_up_middle_page(data: Dict[str, Dict[str, str]], path: str, doc: str | None, history: str, image_key: str, current_page: str, width: str = '0.75') -> Document:
+def set_up_middle_page(data: Dict[str, Dict[str, str]], path: str, doc: str | None, history: str, image_key: str, current_page: str, width: str = '0.75') -> "Document":
     """
     Set up the middle page of the document.
 
@@ -106,11 +202,12 @@ def set_up_middle_page(data: Dict[str, Dict[str, str]], path: str, doc: str | No
     Returns:
         Document: The modified document object.
     """
+    from pylatex import NoEscape
     if doc is None:
         doc = set_up_document(path, type='article', points='16pt')
     
     if image_key in data[history].keys():
-        image_path = Path(__file__).parent.parent / "images" / f"temp_{image_key}.jpg"
+        image_path = temp_image_path(path, image_key)
         image_url = data[history][image_key]
         add_image(doc, image_url, image_path, width=width)
     
@@ -122,7 +219,8 @@ def set_up_middle_page(data: Dict[str, Dict[str, str]], path: str, doc: str | No
     return doc
 
 
-def number_of_pages_in_first_page(data: Dict[str, Dict[str, str]], path: str, title: str, history: str, width: str = '0.75') -> str:
+def number_of_pages_in_first_page(data: Dict[str, Dict[str, str]], path: str, title: str, history: str, width: str = '0.75',
+                                  precompiled_format: bool = True, build_dir: str | None = None) -> str:
     """
     Calculates the number of pages in the first page of a PDF document.
     The function adjusts the width of the first page to fit the content.
@@ -132,26 +230,27 @@ def number_of_pages_in_first_page(data: Dict[str, Dict[str, str]], path: str, ti
         title (str): The title of the PDF document.
         history (str): The history of the PDF document.
         width (str, optional): The width of the first page. Defaults to '0.75'.
+        precompiled_format (bool, optional): Whether to compile with the precompiled preamble. Defaults to True.
+        build_dir (str | None, optional): The build directory of the compiles. Defaults to None (tmpfs).
 
     Returns:
-        str: The updated width of the first page.
+        str: The updated width of the first page. The smallest width tried if none fits.
 
     """
-    for _ in range(5):
+    for width in candidate_widths(width):
         doc = set_up_first_page(data, path, title, history, width)
-        doc.generate_pdf(clean_tex=True, compiler='pdflatex')
+        compile_document(doc, kind="fit_page", precompiled_format=precompiled_format, build_dir=build_dir)
         count_path = Path(path).with_suffix('.pdf')
         number_of_pages = hf.count_number_of_pages(count_path)
-        if number_of_pages > 1:
-            width = str(float(width) - 0.05)
-            count_path.unlink()
-        else:
-            count_path.unlink()
-            return width
+        count_path.unlink()
+        if number_of_pages == 1:
+            break
+    return width
 
 def number_of_pages_in_middle_page(data: Dict[str, Dict[str, str]], path: str,
                                    history: str, image_key: str, current_page: str,
-                                   width: str = '0.75') -> str:
+                                   width: str = '0.75', precompiled_format: bool = True,
+                                   build_dir: str | None = None) -> str:
     """
     Calculates the number of pages in the middle page of a PDF document.
     The function adjusts the width of the middle page to fit the content.
@@ -162,28 +261,213 @@ def number_of_pages_in_middle_page(data: Dict[str, Dict[str, str]], path: str,
         image_key (str): The key for the image.
         current_page (str): The current page of the document.
         width (str, optional): The width of the page. Defaults to '0.75'.
+        precompiled_format (bool, optional): Whether to compile with the precompiled preamble. Defaults to True.
+        build_dir (str | None, optional): The build directory of the compiles. Defaults to None (tmpfs).
 
     Returns:
-        str: The updated width of the page.
+        str: The updated width of the page. The smallest width tried if none fits.
 
     """
-    for _ in range(5):
+    for width in candidate_widths(width):
         doc = set_up_middle_page(data, path, None, history, image_key, current_page, width)
-        doc.generate_pdf(clean_tex=True, compiler='pdflatex')
+        compile_document(doc, kind="fit_page", precompiled_format=precompiled_format, build_dir=build_dir)
         count_path = Path(path).with_suffix('.pdf')
         number_of_pages = hf.count_number_of_pages(count_path)
-        if number_of_pages > 1:
-            width = str(float(width) - 0.05)
-            count_path.unlink()
-        else:
-            count_path.unlink()
-            return width
-    
+        count_path.unlink()
+        if number_of_pages == 1:
+            break
+    return width
+
+def candidate_widths(width: str = '0.75', attempts: int = fit_attempts) -> List[str]:
+    """
+    Returns the widths tried by the fitting loop, in order, with the same arithmetic as the loop.
+
+    Args:
+        width (str, optional): The starting width. Defaults to '0.75'.
+        attempts (int, optional): The number of widths to try. Defaults to fit_attempts.
+
+    Returns:
+        List[str]: The candidate widths, from the largest to the smallest.
+    """
+    widths = [width]
+    for _ in range(attempts - 1):
+        widths.append(str(float(widths[-1]) - fit_step))
+    return widths
+
+def add_fit_probe(doc: "Document", page_number: int, image_path: str | None, text: str | None,
+                  widths: List[str]) -> None:
+    """
+    Appends the LaTeX code that measures one page of the book.
+    For every candidate width the image, the in-text float separation and the \Huge text are
+    typeset in a box and its height is written to the log together with the height left on the page.
+
+    Args:
+        doc (Document): The probe document.
+        page_number (int): The number of the page being measured.
+        image_path (str | None): The path of the image of the page. None if the page has no image.
+        text (str | None): The text of the page.
+        widths (List[str]): The candidate widths.
+
+    Returns:
+        None
+    """
+    from pylatex import NoEscape
+    # the page builder has to see the material already on the page (the title) before reading \pagetotal
+    doc.append(NoEscape(r'\par\penalty10000'))
+    doc.append(NoEscape(r'\ifdim\pagegoal=\maxdimen\setlength\fitavail{\textheight}'
+                        r'\else\setlength\fitavail{\pagegoal}\addtolength\fitavail{-\pagetotal}\fi'))
+    for index, width in enumerate(widths):
+        box = r'\setbox\fitbox\vbox{'
+        if image_path is not None:
+            box += (r'\vskip\intextsep\nointerlineskip'
+                    rf'\hbox to\hsize{{\hss\includegraphics[width={width}\textwidth]{{{image_path}}}\hss}}'
+                    r'\vskip\intextsep')
+        box += r'\Huge ' + (text or '') + r'\par}'
+        doc.append(NoEscape(box))
+        doc.append(NoEscape(rf'\typeout{{FITPROBE {page_number} {index} \the\fitavail\space'
+                            r'\the\dimexpr\ht\fitbox+\dp\fitbox\relax}'))
+    doc.append(NoEscape(r'\clearpage'))
+
+def page_layout_key(data: Dict[str, Dict[str, str]], history: str, page_number: int, title: str,
+                    width: str = '0.75', fit: str = 'loop') -> str:
+    """
+    Returns the layout memo key of a page with an image: its text, the size of its image, the font,
+    the widths tried from `width`, the fit method and, on the first page, the title above the image.
+
+    Args:
+        data (Dict[str, Dict[str, str]]): A dictionary containing data for the PDF document.
+        history (str): The history key.
+        page_number (int): The number of the page.
+        title (str): The title of the history.
+        width (str, optional): The starting width. Defaults to '0.75'.
+        fit (str, optional): 'loop' for the widths of the compile loop, 'probe' for the widths of
+            `fit_widths_single_compile`. Defaults to 'loop'.
+
+    Returns:
+        str: The key of the page.
+    """
+    return LayoutMemo.make_key(text=data[history].get(f'page_{page_number}') or '',
+                               image_size=image_size(data[history][f'image_{page_number}']),
+                               font=page_font, widths=tuple(candidate_widths(width)),
+                               title=title if page_number == 0 else None, fit=fit)
+
+def memoized_width(layout_memo: LayoutMemo | None, data: Dict[str, Dict[str, str]], history: str,
+                   page_number: int, title: str, fit: Callable[[], str | None]) -> str | None:
+    """
+    Returns the width of a page from the layout memo, or fits it with `fit` (one compile per width tried)
+    and stores it. Without a memo, or for a page without an image, `fit` is always called.
+    """
+    if layout_memo is None or f'image_{page_number}' not in data[history].keys():
+        return fit()
+    key = page_layout_key(data, history, page_number, title, fit='loop')
+    width = layout_memo.get(key)
+    if width is None:
+        width = fit()
+        if width is not None:
+            layout_memo.set(key, width)
+    return width
+
+def fit_widths_single_compile(data: Dict[str, Dict[str, str]], path: str, title: str, history: str,
+                              number_of_pages: int, width: str = '0.75',
+                              logger: logging.Logger | None = None,
+                              precompiled_format: bool = True, build_dir: str | None = None,
+                              layout_memo: LayoutMemo | None = None) -> Dict[int, str]:
+    """
+    Finds, with a single pdflatex compile, the largest image width that fits each page of a history.
+    The widths tried are the same as in `number_of_pages_in_first_page` and `number_of_pages_in_middle_page`,
+    but instead of compiling the page once per width, the remaining page height and the height of the
+    image plus the text are measured by LaTeX for every width in one probe document.
+
+    The probe is an estimate of the page: the image and the text are typeset in a box, so the placement of
+    the `h!` float (it can be moved to the next page instead of breaking the text) and the indentation of the
+    first line of the paragraph are not measured. It is not the default of `generate_pdf` until
+    `tests/test_pdf_fit.py`, which runs it and the compile loop on the same pages, passes with pdflatex.
+
+    Args:
+        data (Dict[str, Dict[str, str]]): A dictionary containing data for the PDF document.
+        path (str): The path of the probe document. The files of the probe are deleted afterwards.
+        title (str): The title of the history.
+        history (str): The history key.
+        number_of_pages (int): The number of pages of the book.
+        width (str, optional): The starting width. Defaults to '0.75'.
+        logger (logging.Logger | None, optional): The logger object. Defaults to None.
+        precompiled_format (bool, optional): Whether to compile with the precompiled preamble. Defaults to True.
+        build_dir (str | None, optional): The build directory of the compile. Defaults to None (tmpfs).
+        layout_memo (LayoutMemo | None, optional): The memo of the fitted widths. Pages found in it are not
+            measured and the measured ones are added to it, under keys of their own: the widths of the compile
+            loop are not reused by the probe, nor the other way round. Defaults to None.
+
+    Returns:
+        Dict[int, str]: The width for each page with an image. Pages without a fitting width get the smallest one,
+            as in the compile loop.
+    """
+    from pylatex import NoEscape, Package
+    widths = candidate_widths(width)
+    fitted = {j: width for j in range(number_of_pages - 1)}
+    # the last page has no image, its width is never used
+    pages_to_measure = [j for j in range(number_of_pages - 1) if f'image_{j}' in data[history].keys()]
+    keys = {}
+    if layout_memo is not None:
+        keys = {j: page_layout_key(data, history, j, title, width, fit='probe') for j in pages_to_measure}
+        for j, key in keys.items():
+            memoized = layout_memo.get(key)
+            if memoized is not None:
+                fitted[j] = memoized
+                pages_to_measure.remove(j)
+                if logger is not None:
+                    logger.info(f"Fitted width for page {j} of {history}: {memoized} (layout memo)")
+    if not pages_to_measure:
+        return fitted
+
+    doc = set_up_document(path, type='article', points='16pt')
+    doc.packages.append(Package('graphicx'))
+    doc.preamble.append(NoEscape(r'\newsavebox\fitbox'))
+    doc.preamble.append(NoEscape(r'\newlength\fitavail'))
+    set_up_title(doc, title)
+    if 0 not in pages_to_measure:
+        doc.append(NoEscape(r'\clearpage'))
+    for j in pages_to_measure:
+        image_key = f'image_{j}'
+        image_path = image_file(data[history][image_key], temp_image_path(path, image_key))
+        add_fit_probe(doc, j, image_path, data[history].get(f'page_{j}'), widths)
+
+    try:
+        compile_document(doc, clean=False, kind="fit_probe", precompiled_format=precompiled_format,
+                         build_dir=build_dir, logger=logger)
+        log = Path(path).with_suffix('.log').read_text(encoding='latin-1')
+    finally:
+        for suffix in ('.pdf', '.log', '.aux'):
+            hf.delete_image(Path(path).with_suffix(suffix))
+        delete_temp_images(path)
+
+    measures = {}
+    for match in fit_probe_pattern.finditer(log):
+        page_number, index = int(match.group(1)), int(match.group(2))
+        measures[(page_number, index)] = (float(match.group(3)), float(match.group(4)))
+    for j in pages_to_measure:
+        fitted[j] = widths[-1]
+        for index, candidate in enumerate(widths):
+            if (j, index) not in measures:
+                raise Exception(f"Page {j} of {history} was not measured by the probe compile")
+            available, needed = measures[(j, index)]
+            if needed <= available:
+                fitted[j] = candidate
+                break
+        if j in keys:
+            layout_memo.set(keys[j], fitted[j])
+        if logger is not None:
+            logger.info(f"Fitted width for page {j} of {history}: {fitted[j]}")
+    return fitted
 
 
 def generate_pdf(data: Dict[str, Dict[str, str]], test_mode: bool = False,
                  logger:logging.Logger|None = None,
-                 identifier:str|None = None) -> None:
+                 identifier:str|None = None,
+                 single_compile_fit:bool = False,
+                 base_dict_values:HistoryConfig|None = None,
+                 precompiled_format:bool = True,
+                 build_dir:str|None = None,
+                 layout_memo:LayoutMemo|None = None) -> None:
     """
     Generate a PDF document based on the provided data.
 
@@ -193,17 +477,28 @@ def generate_pdf(data: Dict[str, Dict[str, str]], test_mode: bool = False,
             details for each history.
         test_mode (bool, optional): A flag indicating whether the PDF should be generated in test mode.
             Defaults to False.
+        single_compile_fit (bool, optional): If True the image widths of every page are found with one
+            probe compile per history (`fit_widths_single_compile`, an estimate of the page). If False every
+            page is compiled once per width tried. Defaults to False.
+        base_dict_values (HistoryConfig|None, optional): The configuration. Defaults to None (read from configuration.ini).
+        precompiled_format (bool, optional): If True every compile starts from a format file with the preamble
+            already loaded and runs in its own tmpfs build directory (`compile_document`). Defaults to True.
+        build_dir (str|None, optional): The build directory of the compiles. Defaults to None (tmpfs).
+        layout_memo (LayoutMemo|None, optional): The memo of the fitted widths, checked before any page is
+            measured. Defaults to None.
 
     Returns:
         None
     """
-    base_dict_values = history_base_values()
-    numeber_of_pages = base_dict_values["pages"]
-    number_of_questions = base_dict_values["questions"]
+    from pylatex import NoEscape, NewPage
+    if base_dict_values is None:
+        base_dict_values = history_base_values()
+    numeber_of_pages = base_dict_values.pages
+    number_of_questions = base_dict_values.questions
 
     #language
     reference_languages = ['catalan', 'spanish', 'english', 'french', 'german', 'italian', 'portuguese']
-    language = base_dict_values["language"].lower()
+    language = base_dict_values.language.lower()
     if language not in reference_languages:
         language = hf.calculate_levenshtein_distance(reference_languages, language)
 
@@ -223,9 +518,20 @@ def generate_pdf(data: Dict[str, Dict[str, str]], test_mode: bool = False,
                     path_moke = Path(__file__).parent.parent / "stories"
 
                 path = Path.joinpath(path, f'{now}_story_{history}')
-                path_moke = Path.joinpath(path_moke, f'moke_page')
+                path_moke = Path.joinpath(path_moke, f'{now}_moke_page_{history}')
                 title = data[history]["title"]
-                width = number_of_pages_in_first_page(data, path, title, history)
+                if single_compile_fit:
+                    path_fit = Path.joinpath(path.parent, f'{now}_fit_{history}')
+                    fitted_widths = fit_widths_single_compile(data, path_fit, title, history,
+                                                              numeber_of_pages, logger=logger,
+                                                              precompiled_format=precompiled_format,
+                                                              build_dir=build_dir, layout_memo=layout_memo)
+                    width = fitted_widths[0]
+                else:
+                    width = memoized_width(layout_memo, data, history, 0, title,
+                                           lambda: number_of_pages_in_first_page(data, path, title, history,
+                                                                                 precompiled_format=precompiled_format,
+                                                                                 build_dir=build_dir))
                 if logger is not None:
                     logger.info(f"The width of the first page is {width}")
                 doc = set_up_first_page(data, path, title, history, width)
@@ -234,9 +540,15 @@ def generate_pdf(data: Dict[str, Dict[str, str]], test_mode: bool = False,
                 doc.append(NewPage())
                 image_key = f'image_{j}'
                 current_page = f'page_{j}'
-                width = number_of_pages_in_middle_page(data = data, path = path_moke,
-                                                       history=history, image_key= image_key,
-                                                       current_page=current_page, width= '0.75')
+                if single_compile_fit:
+                    width = fitted_widths[j]
+                else:
+                    width = memoized_width(layout_memo, data, history, j, title,
+                                           lambda: number_of_pages_in_middle_page(data = data, path = path_moke,
+                                                           history=history, image_key= image_key,
+                                                           current_page=current_page, width= '0.75',
+                                                           precompiled_format=precompiled_format,
+                                                           build_dir=build_dir))
                 if logger is not None:
                     logger.info(f"The width of the page {j} is {width}")
                 doc = set_up_middle_page(data = data, path = path_moke, 
@@ -265,15 +577,19 @@ def generate_pdf(data: Dict[str, Dict[str, str]], test_mode: bool = False,
                             if logger is not None:
                                 logger.info(f"Added question {k} to the document {history}")
         try:
-            doc.generate_pdf(clean_tex=True, compiler='pdflatex')
+            compile_document(doc, precompiled_format=precompiled_format, build_dir=build_dir, logger=logger)
             if logger is not None:
                 logger.info(f"Generated PDF for history {history}")
         except Exception as e:
             if logger is not None:
                 logger.error(f"Error generating PDF for history {history}: {e}")
             raise Exception(f"Error generating PDF for history {history}: {e}")
-        # sleep 1 second to avoid errors
-        time.sleep(1)
+        finally:
+            delete_temp_images(path)
+            delete_temp_images(path_moke)
+        # sleep 1 second to avoid errors (pylatex compiles in the directory of the document)
+        if not precompiled_format:
+            time.sleep(1)
 
             
     
@@ -0,0 +1,207 @@
+"""
+Draws the books with reportlab instead of pdflatex: the page size, margins, font size, leading, figure
+spacing and image widths follow the LaTeX documents of `pdf_generator`, but the text is set in the Times
+fonts of the PDF standard, not in the Latin Modern of the LaTeX books (lmodern ships no TrueType font that
+reportlab could register). Times is narrower, so a page can hold a little more text and fit a wider image
+than the same page compiled with pdflatex, and the line breaks differ.
+"""
+from pathlib import Path
+from typing import Dict, List, Tuple, TYPE_CHECKING
+from datetime import datetime as dt
+from xml.sax.saxutils import escape
+from read_configuration import history_base_values, HistoryConfig
+from pdf_generator import candidate_widths
+import base64
+import io
+import logging
+import re
+import metrics
+if TYPE_CHECKING:
+    from reportlab.lib.styles import ParagraphStyle
+    from reportlab.platypus import Flowable
+# reportlab is imported when a book is drawn
+# The folders of the books, stories/ and out_put_test/ (test_mode), are created in it
+root_path = Path(__file__).parent.parent
+
+# Same page as the pylatex documents (article class on letter paper, no geometry package).
+# Lengths in PDF points (1/72 in); TeX points are 1/72.27 in.
+tex_pt = 72 / 72.27
+page_width, page_height = 612.0, 792.0
+text_width = 345 * tex_pt
+text_height = 550 * tex_pt
+left_margin = (page_width - text_width) / 2
+top_margin = 125.97 * tex_pt
+# \Huge in a 10pt document, in Times instead of Latin Modern (see above)
+font = "Times-Roman"
+bold_font = "Times-Bold"
+font_size = 24.88 * tex_pt
+leading = 30 * tex_pt
+paragraph_indent = 15 * tex_pt
+# space above and below a [h!] figure (\intextsep)
+figure_space = 12 * tex_pt
+# \maketitle with titling: 2em before the title and author, date and 1.5em after it
+title_space_before = 20 * tex_pt
+title_space_after = 59 * tex_pt
+# \underline{\hspace{10cm}} of the answers
+answer_line_width = 10 / 2.54 * 72
+
+def image_source(image: str | Path) -> str | io.BytesIO:
+    """
+    Returns what reportlab opens for an image of the data, a file (Path) or a base64 string:
+    the path of the file or a new buffer with the decoded bytes.
+    """
+    if isinstance(image, Path):
+        return str(image)
+    return io.BytesIO(base64.b64decode(image))
+
+def image_reader(image: str | Path):
+    """
+    Returns a reportlab ImageReader for an image of the data, to read its size.
+    """
+    from reportlab.lib.utils import ImageReader
+    return ImageReader(image_source(image))
+
+def styles() -> Tuple["ParagraphStyle", "ParagraphStyle"]:
+    from reportlab.lib.enums import TA_JUSTIFY, TA_CENTER
+    from reportlab.lib.styles import ParagraphStyle
+    text_style = ParagraphStyle("huge", fontName=font, fontSize=font_size, leading=leading,
+                                alignment=TA_JUSTIFY, firstLineIndent=paragraph_indent)
+    title_style = ParagraphStyle("title", fontName=bold_font, fontSize=font_size, leading=leading,
+                                 alignment=TA_CENTER)
+    return text_style, title_style
+
+def paragraphs(text: str, style) -> List["Flowable"]:
+    """
+    Splits the text in paragraphs (blank lines, as in LaTeX) and escapes it for reportlab.
+    """
+    from reportlab.platypus import Paragraph
+    blocks = [block.strip() for block in re.split(r"\n\s*\n", text) if block.strip()]
+    return [Paragraph(escape(" ".join(block.split())), style) for block in blocks]
+
+def height(flowables: List["Flowable"]) -> float:
+    """
+    Exact height of the flowables in the text width, as reportlab lays them out.
+    """
+    return sum(flowable.wrap(text_width, page_height)[1] for flowable in flowables)
+
+def fit_width(image, text_flowables: List["Flowable"], available: float, width: str = '0.75') -> str:
+    """
+    Returns the largest candidate width (the same candidates as the LaTeX backend) with which the image
+    and the text of the page fit in the available height. If none fits the smallest one is returned.
+    """
+    image_width, image_height = image.getSize()
+    text_height_needed = height(text_flowables)
+    widths = candidate_widths(width)
+    for candidate in widths:
+        scaled_height = float(candidate) * text_width * image_height / image_width
+        if scaled_height + 2 * figure_space + text_height_needed <= available:
+            return candidate
+    return widths[-1]
+
+def image_flowables(image: str | Path, size: Tuple[int, int], width: str) -> List["Flowable"]:
+    """
+    The image of a page (a file or a base64 string of the data) at the fitted width, with the space
+    of a LaTeX figure above and below. reportlab's Image takes a filename or a file-like object.
+    """
+    from reportlab.platypus import Image, Spacer
+    image_width, image_height = size
+    drawn_width = float(width) * text_width
+    drawn = Image(image_source(image), width=drawn_width, height=drawn_width * image_height / image_width)
+    drawn.hAlign = "CENTER"
+    return [Spacer(1, figure_space), drawn, Spacer(1, figure_space)]
+
+def book_flowables(details: Dict[str, str], number_of_pages: int, number_of_questions: int,
+                   logger: logging.Logger | None = None, history: str = "") -> List["Flowable"]:
+    """
+    Builds the pages of one book: title, image and text of the first page, image and text of the
+    middle pages, and text and questions with their answer lines on the last page.
+    """
+    from reportlab.lib import colors
+    from reportlab.platypus import PageBreak, Spacer
+    from reportlab.platypus.flowables import HRFlowable
+    text_style, title_style = styles()
+    story = []
+    for j in range(number_of_pages):
+        page_text = paragraphs(details.get(f"page_{j}", ""), text_style)
+        if j == 0:
+            title = paragraphs(details.get("title", ""), title_style)
+            header = [Spacer(1, title_space_before)] + title + [Spacer(1, title_space_after)]
+            story.extend(header)
+            available = text_height - height(header)
+        else:
+            story.append(PageBreak())
+            available = text_height
+        if j != number_of_pages - 1:
+            image_key = f"image_{j}"
+            if image_key in details:
+                reader = image_reader(details[image_key])
+                width = fit_width(reader, page_text, available)
+                if logger is not None:
+                    logger.info(f"The width of the page {j} is {width}")
+                story.extend(image_flowables(details[image_key], reader.getSize(), width))
+            story.extend(page_text)
+            continue
+        story.extend(page_text)
+        for k in range(number_of_questions):
+            question = details.get(f"question_{k}")
+            if question is None:
+                continue
+            story.append(Spacer(1, leading))
+            story.extend(paragraphs(question, text_style))
+            story.append(HRFlowable(width=answer_line_width, thickness=0.4, color=colors.black,
+                                    hAlign="LEFT", spaceBefore=leading * 0.8, spaceAfter=0))
+            if logger is not None:
+                logger.info(f"Added question {k} to the document {history}")
+    return story
+
+def generate_pdf(data: Dict[str, Dict[str, str]], test_mode: bool = False,
+                 logger: logging.Logger | None = None,
+                 identifier: str | None = None,
+                 base_dict_values: HistoryConfig | None = None,
+                 **kwargs) -> None:
+    """
+    Generate a PDF document for every history drawing it directly with reportlab, without pdflatex.
+    Same interface and file names as `pdf_generator.generate_pdf`: the pages have the size, margins and
+    font size of the LaTeX books and the image widths are fitted measuring the text exactly.
+
+    Args:
+        data (Dict[str, Dict[str, str]]): A dictionary containing the data for generating the PDF.
+            The keys represent the history names, and the values are dictionaries containing the
+            details for each history.
+        test_mode (bool, optional): A flag indicating whether the PDF should be generated in test mode.
+            Defaults to False.
+        logger (logging.Logger | None, optional): The logger object. Defaults to None.
+        identifier (str | None, optional): The prefix of the files. Defaults to the current time.
+        base_dict_values (HistoryConfig | None, optional): The configuration. Defaults to None (read from configuration.ini).
+        **kwargs: The options of the LaTeX backend (single_compile_fit, precompiled_format...), ignored.
+
+    Returns:
+        None
+    """
+    from reportlab.platypus import BaseDocTemplate, Frame, PageTemplate
+    if base_dict_values is None:
+        base_dict_values = history_base_values()
+    number_of_pages = base_dict_values.pages
+    number_of_questions = base_dict_values.questions
+    folder = "out_put_test" if test_mode else "stories"
+    path = root_path / folder
+    path.mkdir(exist_ok=True)
+    for history, details in data.items():
+        now = identifier if identifier is not None else dt.now().strftime("%Y-%m-%d_%H-%M-%S")
+        pdf_path = path / f"{now}_story_{history}.pdf"
+        with metrics.span("render", backend="native", file=pdf_path.name) as values:
+            try:
+                doc = BaseDocTemplate(str(pdf_path), pagesize=(page_width, page_height),
+                                      title=details.get("title", ""))
+                # the text block of the LaTeX page, without the default padding of reportlab frames
+                frame = Frame(left_margin, page_height - top_margin - text_height, text_width, text_height,
+                              leftPadding=0, rightPadding=0, topPadding=0, bottomPadding=0)
+                doc.addPageTemplates([PageTemplate(id="page", frames=[frame])])
+                doc.build(book_flowables(details, number_of_pages, number_of_questions, logger, history))
+                values["bytes"] = pdf_path.stat().st_size
+                if logger is not None:
+                    logger.info(f"Generated PDF for history {history}")
+            except Exception as e:
+                if logger is not None:
+                    logger.error(f"Error generating PDF for history {history}: {e}")
+                raise Exception(f"Error generating PDF for history {history}: {e}")
@@ -0,0 +1,438 @@
+from pathlib import Path
+from typing import Dict, Any, Callable, TYPE_CHECKING
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import replace
+import logging
+import read_configuration as rc
+import helper_functions as hf
+import prepare_prompt as pp
+import history_generator as hg
+import image_generator as ig
+import pdf_generator as pg
+import line_art
+from llm_cache import LLMCache
+from image_cache import ImageCache
+from layout_memo import LayoutMemo
+from story_index import StoryIndex
+from checkpoint import Checkpoint
+from image_assets import ImageAssets
+import threading
+import metrics
+import clients
+if TYPE_CHECKING:
+    from batch_api import BatchCollector
+
+number_of_candidates = 4
+
+def open_llm_cache(cache_values:rc.CacheConfig) -> LLMCache|None:
+    """
+    Opens the LLM cache if any stage uses it.
+    """
+    stages = ("llm_cache_candidates", "llm_cache_review", "llm_cache_image_prompts")
+    if not any(getattr(cache_values, stage) for stage in stages):
+        return None
+    return LLMCache(max_bytes=cache_values.llm_cache_max_bytes, ttl=cache_values.llm_cache_ttl)
+
+def open_image_cache(cache_values:rc.CacheConfig) -> ImageCache|None:
+    """
+    Opens the image cache if it is enabled.
+    """
+    if not cache_values.image_cache:
+        return None
+    return ImageCache(max_bytes=cache_values.image_cache_max_bytes)
+
+def open_layout_memo(cache_values:rc.CacheConfig) -> LayoutMemo|None:
+    """
+    Opens the layout memo if it is enabled.
+    """
+    if not cache_values.layout_memo:
+        return None
+    return LayoutMemo()
+
+def open_story_index(index_values:rc.StoryIndexConfig, logger:logging.Logger|None = None) -> StoryIndex|None:
+    """
+    Opens the index of the previous stories if it is enabled and adds the stories of the archive not indexed yet.
+    """
+    if not index_values.enabled:
+        return None
+    story_index = StoryIndex(top_k=index_values.top_k, summary_words=index_values.summary_words)
+    story_index.add_archive(logger=logger)
+    return story_index
+
+def open_batch_collector(configuration:rc.Configuration,
+                         logger:logging.Logger|None = None) -> "BatchCollector|None":
+    """
+    Starts the collector of the Batch API requests if the offline bulk mode is enabled.
+    """
+    if not configuration.batch_api.enabled:
+        return None
+    from batch_api import BatchCollector
+    return BatchCollector(hf.openai_api_key(), configuration.batch_api, logger=logger)
+
+def open_metrics(identifier:str, metrics_values:rc.MetricsConfig) -> metrics.MetricsRecorder|None:
+    """
+    Starts recording the metrics of the run if they are enabled.
+    """
+    if not metrics_values.enabled:
+        return None
+    return metrics.start_run(identifier, prometheus_path=metrics_values.prometheus_textfile)
+
+def close_metrics(logger:logging.Logger|None = None) -> None:
+    """
+    Closes the metrics of the run and logs the totals of every span.
+    """
+    current = metrics.recorder()
+    summary = metrics.stop_run()
+    if summary is None or logger is None:
+        return
+    for name, values in summary.items():
+        logger.info(f"Metrics {name}: " + ", ".join(f"{k}={round(v, 3)}" for k, v in values.items()))
+    for name in ("llm_call", "batch_api"):
+        values = summary.get(name, {})
+        if values.get("prompt_tokens"):
+            logger.info(f"Prompt cache ({name}): {int(values.get('cached_tokens', 0))} of "
+                        f"{int(values['prompt_tokens'])} prompt tokens cached "
+                        f"({round(100 * values.get('cached_tokens', 0) / values['prompt_tokens'], 1)} %)")
+    logger.info(f"Metrics saved in {current.path}")
+
+class JobCancelled(Exception):
+    """
+    Raised between two stages when the run was cancelled.
+    """
+
+def pdf_renderer(backend:str = "latex") -> Callable[..., None]:
+    """
+    Returns the generate_pdf function of the backend: pdf_generator (pylatex and pdflatex) or
+    pdf_native (reportlab). Both take the same arguments and write the same files.
+    """
+    if backend == "native":
+        import pdf_native
+        return pdf_native.generate_pdf
+    return pg.generate_pdf
+
+def with_batch_api(configuration:rc.Configuration, batch_api:bool) -> rc.Configuration:
+    """
+    Returns the configuration with the Batch API enabled for this run if `batch_api` is set.
+    """
+    if not batch_api:
+        return configuration
+    return replace(configuration, batch_api=replace(configuration.batch_api, enabled=True))
+
+def with_pdf_backend(configuration:rc.Configuration, pdf_backend:str|None) -> rc.Configuration:
+    """
+    Returns the configuration with the PDF backend chosen for this run, if any.
+    """
+    if pdf_backend is None:
+        return configuration
+    if pdf_backend not in rc.pdf_backends:
+        raise ValueError(f"The PDF backend must be one of {', '.join(rc.pdf_backends)}, not {pdf_backend}")
+    return replace(configuration, execution=replace(configuration.execution, pdf_backend=pdf_backend))
+
+class EarlyImages:
+    """
+    Requests the image of a page as soon as its prompt is streamed (see `hg.make_prompt_images_after_review`),
+    while the LLM is still writing the prompts of the next pages. `collect` adds the images to the data;
+    an image that failed is left out so the images stage requests it again.
+    """
+    def __init__(self, history:str, image_model:str, max_workers:int|None,
+                 logger:logging.Logger|None = None,
+                 image_cache:ImageCache|None = None,
+                 assets:ImageAssets|None = None,
+                 response_format:str = "b64_json"):
+        self.history = history
+        self.image_model = image_model
+        self.logger = logger
+        self.image_cache = image_cache
+        self.assets = assets
+        self.response_format = response_format
+        self.executor = ThreadPoolExecutor(max_workers=max(1, max_workers or 1))
+        self.futures = {}
+
+    def on_field(self, history:str, key:str, value:Any) -> None:
+        if not key.startswith("prompt_image_") or not isinstance(value, str):
+            return
+        page_number = int(key.split("_")[-1])
+        if self.logger is not None:
+            self.logger.info(f"Prompt of image {page_number} of {self.history} streamed, requesting the image")
+        self.futures[page_number] = self.executor.submit(
+            ig.generate_images_for_history_after_review, data={self.history: {key: value}},
+            model=self.image_model, logger=self.logger, cache=self.image_cache, assets=self.assets,
+            response_format=self.response_format)
+
+    def collect(self, data:Dict[str, Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+        for page_number, future in sorted(self.futures.items()):
+            prompt_key = f"prompt_image_{page_number}"
+            try:
+                result = future.result()[self.history]
+            except Exception as e:
+                if self.logger is not None:
+                    self.logger.warning(f"Early image {page_number} of {self.history} failed: {e}")
+                continue
+            # only used if the parsed prompt is the streamed one
+            if data[self.history].get(prompt_key) == result[prompt_key]:
+                data[self.history][f"image_{page_number}"] = result[f"image_{page_number}"]
+        return data
+
+    def close(self) -> None:
+        self.executor.shutdown(wait=True)
+
+def history_values(base_dict_values:rc.HistoryConfig, index:int) -> rc.HistoryConfig:
+    """
+    Returns the configuration of the child at `index` alone, so its history can run through the stages on its own.
+    """
+    return replace(base_dict_values,
+                   names=(base_dict_values.names[index],),
+                   birthdays=base_dict_values.birthdays[index:index + 1],
+                   ages=base_dict_values.ages[index:index + 1])
+
+def rename_history(data:Dict[str, Dict[str, Any]], history:str) -> Dict[str, Dict[str, Any]]:
+    """
+    The stages key the only history of a one-child run as history_0; this gives it the key of its child.
+    """
+    return {history: details for details in data.values()}
+
+def check_history(data:Dict[str, Dict[str, Any]], stage:str, history:str) -> None:
+    for details in data.values():
+        if "error" in details:
+            raise Exception(f"Error generating {stage} for history {history}: {details['error']}")
+
+def run_history(history:str, identifier:str, configuration:rc.Configuration,
+                base_dict_values:rc.HistoryConfig,
+                logger:logging.Logger|None = None,
+                checkpoint:Checkpoint|None = None,
+                concurrent:bool = False,
+                llm_cache:LLMCache|None = None,
+                image_cache:ImageCache|None = None,
+                assets:ImageAssets|None = None,
+                image_model:str = ig.model,
+                verbose:bool = True,
+                cancel:threading.Event|None = None,
+                layout_memo:LayoutMemo|None = None,
+                batch:"BatchCollector|None" = None,
+                story_index:StoryIndex|None = None) -> Dict[str, Any]:
+    """
+    Moves one history through every stage: candidate stories, review, image prompts, images and PDF.
+
+    Args:
+        history (str): The key of the history (history_<index of the child>).
+        identifier (str): The identifier of the run. It prefixes the PDF files.
+        configuration (rc.Configuration): The configuration of the run.
+        base_dict_values (rc.HistoryConfig): The values of this child only (see `history_values`).
+        logger (logging.Logger|None, optional): The logger object. Defaults to None.
+        checkpoint (Checkpoint|None, optional): The checkpoint of the run. Defaults to None.
+        concurrent (bool, optional): Flag indicating whether to send the requests of the history concurrently. Defaults to False.
+        llm_cache (LLMCache|None, optional): The LLM cache. Defaults to None.
+        image_cache (ImageCache|None, optional): The image cache. Defaults to None.
+        assets (ImageAssets|None, optional): Where the images are saved. Defaults to None.
+        image_model (str, optional): The image model. Defaults to "dall-e-3".
+        verbose (bool, optional): Flag indicating whether to print the stages. Defaults to True.
+        cancel (threading.Event|None, optional): When it is set the history stops before its next stage. Defaults to None.
+        layout_memo (LayoutMemo|None, optional): The memo of the image widths of the pages. Defaults to None.
+        batch (BatchCollector|None, optional): Sends the LLM requests through the Batch API. Defaults to None.
+        story_index (StoryIndex|None, optional): The index of the previous stories, shown to the review.
+            The reviewed story is added to it. Defaults to None.
+
+    Returns:
+        Dict[str, Any]: The details of the history, with the paths of its images.
+
+    Raises:
+        JobCancelled: If `cancel` is set before a stage.
+    """
+    execution_values = configuration.execution
+    cache_values = configuration.cache
+    llm_concurrency = execution_values.llm_concurrency if concurrent else None
+    image_concurrency = execution_values.image_concurrency if concurrent else None
+
+    def stage(message:str) -> None:
+        if cancel is not None and cancel.is_set():
+            raise JobCancelled(f"{identifier} {history} cancelled")
+        if verbose:
+            print(f"{history}: {message}")
+
+    def load(name:str) -> Dict[str, Dict[str, Any]]|None:
+        if checkpoint is None:
+            return None
+        details = checkpoint.load_history_stage(name, history)
+        return None if details is None else {history: details}
+
+    def save(name:str, data:Dict[str, Dict[str, Any]]) -> None:
+        if checkpoint is not None:
+            checkpoint.save_history_stage(name, history, data[history])
+
+    data = load("image_prompts")
+    if data is None:
+        data = load("review")
+        if data is None:
+            data = load("candidates")
+            if data is None:
+                output_parser, output_prompts = pp.generate_prompts_for_chain(number_of_candidates, base_dict_values)
+                stage("Generating multiple stories...")
+                with metrics.span("candidates", history=history, identifier=identifier):
+                    data = hg.llm_call_chain_for_history_generation(logger=logger,
+                                                                    parser=output_parser,
+                                                                    prompts=output_prompts,
+                                                                    max_concurrency=llm_concurrency,
+                                                                    cache=llm_cache if cache_values.llm_cache_candidates else None,
+                                                                    batch=batch)
+                data = rename_history(data, history)
+                check_history(data, "candidates", history)
+                save("candidates", data)
+
+            stage("Reviewing best story...")
+            with metrics.span("review", history=history, identifier=identifier):
+                data = hg.make_review(data, logger=logger, base_dict_values=base_dict_values,
+                                      max_concurrency=llm_concurrency,
+                                      cache=llm_cache if cache_values.llm_cache_review else None,
+                                      batch=batch, story_index=story_index)
+            data = rename_history(data, history)
+            check_history(data, "review", history)
+            save("review", data)
+            if story_index is not None:
+                story_index.add_history(f"{identifier}/{history}", data[history])
+
+        stage("Generating prompts to produce images...")
+        early_images = None
+        # the answers of a batch are not streamed
+        if execution_values.llm_streaming and batch is None:
+            early_images = EarlyImages(history, image_model, image_concurrency, logger=logger,
+                                       image_cache=image_cache, assets=assets,
+                                       response_format=execution_values.image_response_format)
+        # the image prompts are matched to the history by position, as history_0
+        try:
+            with metrics.span("image_prompts", history=history, identifier=identifier):
+                data = hg.make_prompt_images_after_review(rename_history(data, "history_0"), logger=logger,
+                                                   base_dict_values=base_dict_values,
+                                                   max_concurrency=llm_concurrency,
+                                                   cache=llm_cache if cache_values.llm_cache_image_prompts else None,
+                                                   on_field=early_images.on_field if early_images is not None else None,
+                                                   batch=batch)
+            data = rename_history(data, history)
+            if early_images is not None:
+                with metrics.span("early_images", history=history, identifier=identifier):
+                    data = early_images.collect(data)
+        finally:
+            if early_images is not None:
+                early_images.close()
+        save("image_prompts", data)
+
+    stage("Generating images...")
+    if checkpoint is not None:
+        checkpoint.load_images(data)
+    with metrics.span("images", history=history, identifier=identifier):
+        data = ig.generate_images_for_history_after_review(data=data, model=image_model, logger=logger,
+                                                           max_concurrency=image_concurrency, cache=image_cache,
+                                                           assets=assets,
+                                                           response_format=execution_values.image_response_format)
+    if configuration.images.line_art:
+        data = line_art.line_art_for_history(data, configuration.images, logger=logger)
+
+    if checkpoint is not None and checkpoint.has_pdf(history):
+        if logger is not None:
+            logger.info(f"PDF for history {history} already generated")
+        return data[history]
+    stage("Generating PDF...")
+    with metrics.span("pdf", history=history, identifier=identifier):
+        pdf_renderer(execution_values.pdf_backend)(data, logger=logger, identifier=identifier,
+                                                   base_dict_values=base_dict_values,
+                                                   precompiled_format=execution_values.latex_format,
+                                                   build_dir=execution_values.latex_build_dir,
+                                                   layout_memo=layout_memo)
+    if checkpoint is not None:
+        checkpoint.mark_pdf(history)
+    return data[history]
+
+def run_review_pipeline(identifier:str, configuration:rc.Configuration,
+                        base_dict_values:rc.HistoryConfig|None = None,
+                        logger:logging.Logger|None = None,
+                        checkpoint:Checkpoint|None = None,
+                        concurrent:bool = False,
+                        llm_cache:LLMCache|None = None,
+                        image_cache:ImageCache|None = None,
+                        image_model:str = ig.model,
+                        verbose:bool = True,
+                        cancel:threading.Event|None = None,
+                        layout_memo:LayoutMemo|None = None,
+                        batch:"BatchCollector|None" = None,
+                        story_index:StoryIndex|None = None) -> Dict[str, Dict[str, Any]]:
+    """
+    Generates candidate stories, reviews the best one, generates the image prompts, the images and the PDFs.
+
+    Every history (one per child) moves through the stages on its own (`run_history`): with `concurrent`
+    the histories run at the same time, so a fast history reaches its PDF without waiting for the
+    others and the latencies of the stages overlap; otherwise they run one after the other. A single history
+    runs in the calling thread, so the clients of a long-lived worker thread stay warm (see `clients`); the
+    pool threads of several histories close their event loop and async clients when their history ends.
+    With a checkpoint every stage of every history is saved as soon as it is done and the stages,
+    images and PDFs already in the checkpoint are loaded instead of generated again.
+
+    Args:
+        identifier (str): The identifier of the run. It prefixes the PDF files.
+        configuration (rc.Configuration): The configuration of the run.
+        base_dict_values (rc.HistoryConfig|None, optional): The history values. Defaults to configuration.history.
+        logger (logging.Logger|None, optional): The logger object. Defaults to None.
+        checkpoint (Checkpoint|None, optional): The checkpoint of the run. Defaults to None.
+        concurrent (bool, optional): Flag indicating whether to send the requests concurrently. Defaults to False.
+        llm_cache (LLMCache|None, optional): The LLM cache, used by the stages enabled in the configuration. Defaults to None.
+        image_cache (ImageCache|None, optional): The image cache. Defaults to None.
+        image_model (str, optional): The image model. Defaults to "dall-e-3".
+        verbose (bool, optional): Flag indicating whether to print the stages. Defaults to True.
+        cancel (threading.Event|None, optional): When it is set the histories stop before their next stage. Defaults to None.
+        layout_memo (LayoutMemo|None, optional): The memo of the image widths of the pages. Defaults to None.
+        batch (BatchCollector|None, optional): Sends the LLM requests through the Batch API. The histories
+            run at the same time so their requests go in the same batches. Defaults to None.
+        story_index (StoryIndex|None, optional): The index of the previous stories, shown to the reviews. Defaults to None.
+
+    Returns:
+        Dict[str, Dict[str, Any]]: The data of the histories, with the paths of their images.
+
+    Raises:
+        Exception: The first error of a history, once every other history has finished.
+    """
+    if base_dict_values is None:
+        base_dict_values = configuration.history
+    histories = [f"history_{i}" for i in range(len(base_dict_values.names))]
+    if checkpoint is not None:
+        assets = ImageAssets(checkpoint.images_path)
+    else:
+        assets = ImageAssets(Path(__file__).parent.parent / "images" / identifier)
+
+    data = {}
+    errors = []
+
+    def run(i:int, history:str) -> Dict[str, Any]:
+        return run_history(history, identifier, configuration, history_values(base_dict_values, i), logger,
+                           checkpoint, concurrent, llm_cache, image_cache, assets, image_model, verbose, cancel,
+                           layout_memo, batch, story_index)
+
+    def run_worker(i:int, history:str) -> Dict[str, Any]:
+        # the event loop and the async clients a pool thread builds are closed with its task
+        try:
+            return run(i, history)
+        finally:
+            clients.close_thread_clients()
+
+    try:
+        if len(histories) == 1:
+            try:
+                data[histories[0]] = run(0, histories[0])
+            except Exception as e:
+                if logger is not None:
+                    logger.error(f"Error in history {histories[0]}: {e}")
+                errors.append(e)
+        else:
+            parallel = concurrent or batch is not None
+            with ThreadPoolExecutor(max_workers=len(histories) if parallel else 1) as executor:
+                futures = {executor.submit(run_worker, i, history): history for i, history in enumerate(histories)}
+                for future in as_completed(futures):
+                    history = futures[future]
+                    try:
+                        data[history] = future.result()
+                    except Exception as e:
+                        if logger is not None:
+                            logger.error(f"Error in history {history}: {e}")
+                        errors.append(e)
+    finally:
+        assets.close()
+    if errors:
+        raise errors[0]
+    return {history: data[history] for history in histories}
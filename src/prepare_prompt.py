@@ -1,73 +1,126 @@
-from langchain.output_parsers import ResponseSchema, StructuredOutputParser
-from langchain.prompts import PromptTemplate
 import helper_functions as hf
-from read_configuration import history_base_values
+from read_configuration import history_base_values, HistoryConfig
 from pathlib import Path
+from functools import lru_cache
 import random
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Tuple, TYPE_CHECKING
+if TYPE_CHECKING:
+    from langchain.output_parsers import ResponseSchema, StructuredOutputParser
+    from langchain.prompts import PromptTemplate
+# langchain is imported when the first parser or template is built
 
 
 
+# Every LLM prompt starts with the instructions of its stage, which are the same for every book, followed by
+# the format instructions of the answer (the same for every book with the same pages and questions); the
+# child, the topic and the story texts only come at the end. OpenAI caches the longest prefix already seen
+# from 1024 tokens on, so the requests of a stage can share a cached prefix once their prompts are that long;
+# the `cached_tokens` reported by every call are recorded as they come (see `metrics`).
+story_instructions = """
+    Eres el mejor contador de historias del mundo. Tu propósito es escribir una historia para el niño o la niña
+    cuyos datos se indican al final. La historia tratará sobre el tema indicado, será del género indicado y estará
+    escrita en el idioma indicado. Si se indica una lección de moral, la historia debe enseñarla.
+    Adaptarás el lenguaje y la complejidad de la historia a la edad indicada. La historia debe ser entretenida y educativa.
+    La historia debe tener un inicio, un nudo y un desenlace. La historia debe ser original y creativa.
+    La historia tendrá el número de páginas indicado y cada página tendrá como máximo el número de palabras indicado.
+    Si decides introducir al niño o la niña en la historia, su nombre debe ser el indicado con independencia del
+    idioma en el que escribas la historia.
+    Después de escribir la historia, deberás escribir un título corto para la historia.
+    Si se indica un número de preguntas, después de escribir la historia añadirás esas preguntas sobre la historia.
+    Las preguntas deben estar enfocadas a la comprensión de la historia y siempre deben tener en cuenta la edad indicada.
+    """
+
+chain_instructions = """
+    Eres el mejor contador de historias del mundo. Tu propósito es escribir varias historias para el niño o la niña
+    cuyos datos se indican al final. Las historias tratarán sobre el tema indicado, serán del género indicado y estarán
+    escritas en el idioma indicado. Si se indica una lección de moral, las historias deben enseñarla.
+    Adaptarás el lenguaje y la complejidad de las historias a la edad indicada. Las historias deben ser entretenidas
+    y educativas. Las historias deben tener un inicio, un nudo y un desenlace. Las historias deben ser originales y creativas.
+    Las historias tendrán el número de páginas indicado y cada página tendrá como máximo el número de palabras indicado.
+    Si decides introducir al niño o la niña en la historia, su nombre debe ser el indicado con independencia del
+    idioma en el que escribas la historia. Pero no debe ser el protagonista de todas las historias.
+    Escribirás el número de historias indicado.
+    Después de escribir las historias razonarás paso a paso cuál es la mejor historia para el niño o la niña. Teniendo en cuenta
+    la claridad, la coherencia, la originalidad y la creatividad de las historias.
+    Por último, deberás dar el número de la mejor historia. La numeración empieza desde 0.
+    """
+
+review_instructions = """
+    Eres un experto revisando historias. Tus revisiones son muy importantes para mejorar las historias.
+    Escribirás tu razonamiento y tu historia revisada en el idioma indicado al final.
+    Si se incluyen ejemplos de historias que has revisado, tendrás en cuenta esas historias para asegurar la variedad
+    en el vocabulario y el contenido de las historias. También evitarás repeticiones de palabras, frases y nombres
+    de personajes.
+    Revisarás la historia para asegurar su calidad y adecuación a la edad indicada.
+    Procura que la historia sea entretenida y educativa. La revisión será razonada y paso a paso.
+    Es importante que en tu revisión cuentes el número de palabras en cada página.
+    Después de revisar la historia reescribirás las páginas que consideres necesarias y te asegurarás de que
+    cada página tenga el número de palabras indicado.
+    También añadirás un título apropiado para la historia.
+    Si se indica un número de preguntas, después de escribir la historia añadirás esas preguntas sobre la historia.
+    Las preguntas deben estar enfocadas a la comprensión de la historia y siempre deben tener en cuenta la edad indicada.
+    """
+
+image_prompt_instructions = """
+    Eres un experto ilustrador de cuentos infantiles. Tu propósito es ilustrar la historia que se te presenta al final.
+    La historia tendrá el número de imágenes indicado. Cada imagen debe estar relacionada con el texto de la página.
+    Y a la vez ser consistente con el argumento de la historia. Las imágenes deben ser sencillas y fáciles de entender.
+    Cada página debe tener una imagen a excepción de la última página. La última página no tendrá imagen.
+    Las imágenes deben ser de líneas simples y fáciles de colorear. Las imágenes deben ser originales y creativas.
+    En un primer paso razonarás cómo deben ser las imágenes para cada página y tu razonamiento será paso a paso.
+    Después describirás las imágenes que dibujarás para cada página.
+    Por último proporcionarás el prompt adecuado para que una IA pueda dibujar las imágenes atendiendo a las especificaciones
+    que has dado. Es importante que el prompt sea claro, conciso y que mantenga la coherencia con el texto y las diferentes imágenes.
+    Recuerda que las imágenes deben ser fáciles de colorear y de entender, por lo que el prompt debe mencionar que se trata de una imagen
+    para colorear y que debe ser sencilla y fácil de entender.
+    """
+
 def base_prompt_template(child_name:str, number_of_years_child:int, topic:str,
                          include_moral_values:bool, moral_value:str, story_genere:str,
                          language:str, pages:int, words_per_page:int,
                          questions:int) -> str:
     """
-    Generate a prompt for the story generator
+    Generate the details of a story for the story generator (the end of its prompt, after `story_instructions`)
     """
-    if include_moral_values:
-        moral = f""" 
-        y enseñar una lección de moral acerca de "{moral_value}"
-        """
-    else:
-        moral = ""
-
     base_prompt_template = f"""
-    Eres el mejor contador de historias del mundo. Tu propósito es es escribir una historia para {child_name}.
-    La historia debe tratar sobre el tema "{topic}" {moral}".
-    La historia debe ser de género "{story_genere}". Y debe estar escrita en el idioma "{language}".
-    Deberás tener en cuenta que la edad de {child_name} es {number_of_years_child} años. Adaptrás el lenguaje y
-    la complejidad de la historia a su edad. La historia debe ser entretenida y educativa. La hsitória debe tener
-    un inicio, un nudo y un desenlace. La historia debe ser original y creativa. La historia debe tener {pages} páginas.
-    Cada página debe tener un máximo de {words_per_page} palabras. Si decides introducir a {child_name} en la historia,
-    su nombre debe ser "{child_name}" con independencia del leguaje con el que escribas la historia.
-    Después de escribir la historia, deberás escribir un título corto para la historia. 
+    Datos de la historia:
+    Nombre: "{child_name}"
+    Edad: {number_of_years_child} años
+    Tema: "{topic}"
+    """
+    if include_moral_values:
+        base_prompt_template += f"""Lección de moral: "{moral_value}"
+    """
+    base_prompt_template += f"""Género: "{story_genere}"
+    Idioma: "{language}"
+    Páginas: {pages}
+    Palabras por página: {words_per_page}
     """
     if questions > 0:
-        base_prompt_template += f"""
-        Después de escribir la historia, deberás añadir {questions} preguntas sobre la historia.
-        Las preguntas deben estar enfocadas a la comprensión de la historia y siempre deben tener en cuenta que
-        la edad de {child_name} es {number_of_years_child} años.
-        """
+        base_prompt_template += f"""Preguntas: {questions}
+    """
     return base_prompt_template
 
 def base_prompt_template_for_chain(child_name:str, number_of_years_child:int, topic:str,
                          include_moral_values:bool, moral_value:str, story_genere:str,
                          language:str, pages:int, words_per_page:int, number_of_histories:int) -> str:
     """
-    Generate a prompt for the story generator
+    Generate the details of the stories for the story generator (the end of its prompt, after `chain_instructions`)
     """
-    if include_moral_values:
-        moral = f""" 
-        y enseñar una lección de moral acerca de "{moral_value}"
-        """
-    else:
-        moral = ""
-
     base_prompt_template = f"""
-    Eres el mejor contador de historias del mundo. Tu propósito es es escribir una historias para {child_name}.
-    Las historias deben tratar sobre el tema "{topic}" {moral}".
-    Las historias deben ser de género "{story_genere}". Y deben estar escritas en el idioma "{language}".
-    Deberás tener en cuenta que la edad de {child_name} es {number_of_years_child} años. Adaptrás el lenguaje y
-    la complejidad de las historias a su edad. Las historias deben ser entretenidas y educativas. Las hsitorias deben tener
-    un inicio, un nudo y un desenlace. Las historias deben ser originales y creativas. Las historias deben tener {pages} páginas.
-    Cada página debe tener un máximo de {words_per_page} palabras. Si decides introducir a {child_name} en la historia,
-    su nombre debe ser "{child_name}" con independencia del leguaje con el que escribas la historia. Pero {child_name}
-    no debe ser el protagonista de todas las historias.
-    Escribirás un total de {number_of_histories} historias.
-    Después de escribir las historias razonarás paso a paso cuál es la mejor historia para {child_name}. Teniendo en cuenta
-    la claridad, la coherencia, la originalidad y la creatividad de las historias.
-    Por último, deberás dar el número de la mejor historia para {child_name}. La numeración empieza desde 0.
+    Datos de las historias:
+    Nombre: "{child_name}"
+    Edad: {number_of_years_child} años
+    Tema: "{topic}"
+    """
+    if include_moral_values:
+        base_prompt_template += f"""Lección de moral: "{moral_value}"
+    """
+    base_prompt_template += f"""Género: "{story_genere}"
+    Idioma: "{language}"
+    Páginas: {pages}
+    Palabras por página: {words_per_page}
+    Número de historias: {number_of_histories}
     """
     return base_prompt_template
 
@@ -75,39 +128,26 @@ def review_best_history_template(text:str,language:str, number_of_years_child:in
                                  number_of_words:int, questions:int,
                                  other_histories:str|None = None) -> str:
     """
-    Generate a prompt for the review story generator
+    Generate the details of the review (the end of its prompt, after `review_instructions`)
     """
     review_prompt = f"""
-    Eres un experto revisando historias y hablas en {language}. Tus revisiones son muy importantes para mejorar las historias.
-    Cuando escribas tu historia revisada lo harás en el idioma "{language}". Cuando escribas tus
-    raznomien
+    Datos de la revisión:
+    Idioma: "{language}"
+    Edad: {number_of_years_child} años
+    Palabras por página: entre {number_of_words-5} y {number_of_words+5}
+    """
+    if questions > 0:
+        review_prompt += f"""Preguntas: {questions}
     """
     if other_histories is not None:
         review_prompt += f"""
-        Estos son ejemplos de historias que has revisado:
-        {other_histories}
-
-
-        Para tu revisión de la historia, tendrás en cuenta las historias anteriores para asegurar la variedad en el vocabulario y el contenido de las historias.
-        También evitarás repeticiones de palabras, frases y nombres de personajes. 
-        """
-    review_prompt += f"""
-    Revisarás la historia para asegurar su calidad y adecuación a la edad de {number_of_years_child} años.
-    Procura que la historia sea entretenida y educativa. La revisión será razonada y paso a paso.
-    Es importante que en tu revisión cuentes el número de palabras en cada página. 
-    Despues de revisar la historia reescribirás las páginas que consideres necesarias y te asegurarás de que
-    cada página tenga entre {number_of_words-5} palabras y {number_of_words+5}.
-    También añadirás un título apropiado para la historia. 
-    El Texto a revisar es el siguiente:
-    {text} 
+    Estos son ejemplos de historias que has revisado:
+    {other_histories}
     """
-    if questions > 0:
-        review_prompt += f"""
-        Después de escribir la historia, deberás añadir {questions} preguntas sobre la historia.
-        Las preguntas deben estar enfocadas a la comprensión de la historia y siempre deben tener en cuenta que
-        la edad de la persona es {number_of_years_child} años.
-        """
     review_prompt += f"""
+    El Texto a revisar es el siguiente:
+    {text}
+
     Recuerda escribir todo en el idioma "{language}".
     """
     return review_prompt
@@ -127,92 +167,90 @@ def base_prompt_template_image(child_name:str, number_of_years_child:int) -> str
     return base_prompt_template
 
 def base_prompt_to_produce_image_prompt(text:str, number_of_pages:int,):
+    """
+    Generate the details of the image prompts (the end of the prompt, after `image_prompt_instructions`)
+    """
     base_prompt_template = f"""
-    Eres un experto ilustrador de cuentos infantiles. Tu propósito es ilustrar la historia que se te presenta.
-    La historia tendrá {number_of_pages-1} imágenes. Cáda imagen debe estar relacionada con el texto de la página.
-    Y la vez ser consitente con el argumento de la historia. Las imágenes deben ser sencillas y fáciles de entender.
-    Cáda página debe tener una imagen a excepción de la última página. La última página no tendrá imagen.
-    Las imágenes deben ser de lineas simples y fáciles de colorear. Las imágenes deben ser originales y creativas.
+    Número de imágenes: {number_of_pages-1}
     El cuento sobre el que basarás las imágenes es el siguiente:
     {text}
-    
-    En un primer paso razonarás como deben de ser las imágenes para cada página y tu razonamiento será paso a paso.
-    Después descrinirás las imágenes que dibujarás para cada página.
-    Por último proporcinarás el prompt adecuado para que una IA pueda dibujar las imágenes atendiendo a las especificaciones
-    que has dado. Es importante que el prompt sea claro, conciso y que mantenga la coherencia con el texto y las diferentes imágenes.
-    Recuerda que las imágenes deben ser fáciles de colorear y de entender, por lo que el prompt debe mencionar que se trata de una imagen
-    para colorear y que debe ser sencilla y fácil de entender.
     """
     return base_prompt_template
 
-def generate_base_prompt() -> str:
+def generate_base_prompt(base_dict_values:HistoryConfig|None = None) -> List[str]:
     """
     Generate a prompt for the story generator
     """
-    base_dict_values = history_base_values()
+    if base_dict_values is None:
+        base_dict_values = history_base_values()
     prompts = []
-    for i, name in enumerate(base_dict_values["names"]):
+    for i, name in enumerate(base_dict_values.names):
         prompt = base_prompt_template(child_name=name,
-                                      number_of_years_child=base_dict_values["number_of_years"][i], 
-                                      topic=random.choice(base_dict_values["topics"]),
-                                      include_moral_values=base_dict_values["include_moral_values"],
-                                      moral_value=random.choice(base_dict_values["moral_values"]),
-                                      story_genere=random.choice(base_dict_values["story_genere"]),
-                                      language=base_dict_values["language"],
-                                      pages=base_dict_values["pages"],
-                                      words_per_page=base_dict_values["words_per_page"],
-                                      questions=base_dict_values["questions"])
+                                      number_of_years_child=base_dict_values.number_of_years[i], 
+                                      topic=random.choice(base_dict_values.topics),
+                                      include_moral_values=base_dict_values.include_moral_values,
+                                      moral_value=random.choice(base_dict_values.moral_values),
+                                      story_genere=random.choice(base_dict_values.story_genere),
+                                      language=base_dict_values.language,
+                                      pages=base_dict_values.pages,
+                                      words_per_page=base_dict_values.words_per_page,
+                                      questions=base_dict_values.questions)
         
         prompts.append(prompt)
     return prompts
-def generate_base_prompt_for_chain(number_of_histories:int, base_dict_values:Dict[str,Any]|None = None) -> List[str]:
+def generate_base_prompt_for_chain(number_of_histories:int, base_dict_values:HistoryConfig|None = None) -> List[str]:
     """
     Generate a prompt for the story generator
+    The topic, moral value and genre are drawn at random, so with several of them the prompt (and its
+    LLM cache key) changes from one run to the next.
     """
     if base_dict_values is None:
         base_dict_values = history_base_values()
     prompts = []
-    for i, name in enumerate(base_dict_values["names"]):
+    for i, name in enumerate(base_dict_values.names):
         prompt = base_prompt_template_for_chain(child_name=name,
-                                      number_of_years_child=base_dict_values["number_of_years"][i], 
-                                      topic=random.choice(base_dict_values["topics"]),
-                                      include_moral_values=base_dict_values["include_moral_values"],
-                                      moral_value=random.choice(base_dict_values["moral_values"]),
-                                      story_genere=random.choice(base_dict_values["story_genere"]),
-                                      language=base_dict_values["language"],
-                                      pages=base_dict_values["pages"],
-                                      words_per_page=base_dict_values["words_per_page"],
+                                      number_of_years_child=base_dict_values.number_of_years[i], 
+                                      topic=random.choice(base_dict_values.topics),
+                                      include_moral_values=base_dict_values.include_moral_values,
+                                      moral_value=random.choice(base_dict_values.moral_values),
+                                      story_genere=random.choice(base_dict_values.story_genere),
+                                      language=base_dict_values.language,
+                                      pages=base_dict_values.pages,
+                                      words_per_page=base_dict_values.words_per_page,
                                       number_of_histories=number_of_histories)
         
         prompts.append(prompt)
     return prompts
 def generate_base_prompt_review(data:Dict[str,str],
-                                base_dict_values:Dict[str,Any]|None = None,
-                                other_histories:str|None = None) -> List[str]:
+                                base_dict_values:HistoryConfig|None = None,
+                                other_histories:str|List[str|None]|None = None) -> List[str]:
     """
-    Generate a prompt for the review story generator
+    Generate a prompt for the review story generator.
+    `other_histories` is the same for every story or a list with the other histories of each story.
     """
     if base_dict_values is None:
         base_dict_values = history_base_values()
     prompts = []
     for i, (k, text) in enumerate(data.items()):
         prompt = review_best_history_template(text=text,
-                                                language=base_dict_values["language"],
-                                               number_of_years_child=base_dict_values["number_of_years"][i],
-                                               number_of_words=base_dict_values["words_per_page"],
-                                               questions=base_dict_values["questions"],
-                                               other_histories=other_histories)
+                                                language=base_dict_values.language,
+                                               number_of_years_child=base_dict_values.number_of_years[i],
+                                               number_of_words=base_dict_values.words_per_page,
+                                               questions=base_dict_values.questions,
+                                               other_histories=other_histories[i] if isinstance(other_histories, list)
+                                                               else other_histories)
         prompts.append(prompt)
     return prompts
     
-def generate_base_prompt_image() -> str:
+def generate_base_prompt_image(base_dict_values:HistoryConfig|None = None) -> List[str]:
     """
     Generate a prompt for the story generator
     """
-    base_dict_values = history_base_values()
+    if base_dict_values is None:
+        base_dict_values = history_base_values()
     prompts = []
-    for i, name in enumerate(base_dict_values["names"]):
-        prompt = base_prompt_template_image(name, base_dict_values["number_of_years"][i])
+    for i, name in enumerate(base_dict_values.names):
+        prompt = base_prompt_template_image(name, base_dict_values.number_of_years[i])
         prompts.append(prompt)
     return prompts
 
@@ -234,13 +272,14 @@ def generate_base_prompt_to_produce_image_prompt(data:Dict[str,Dict[str,str]]) -
         prompts.append(prompt)
     return prompts
 
-def prepare_answer_format() -> ResponseSchema:
-    """
-    Prepare the answer format for the story generator
-    """
-    base_dict_values = history_base_values()
-    number_of_pages = base_dict_values["pages"]
-    questions = base_dict_values["questions"]
+# Parsers, format instructions and prompt skeletons only depend on the stage and the shape of the answer
+# (pages, questions, number of candidates), so each one is built once and shared by every prompt: the
+# `*_parser` builders return the parser with its format instructions.
+# The static part (instructions and format instructions) goes first and the details of the book last.
+prompt_skeleton = "{instructions}\n{format_instructions}\n{base_prompt}\n{question}"
+@lru_cache(maxsize=None)
+def story_parser(number_of_pages:int, questions:int) -> Tuple["StructuredOutputParser", str]:
+    from langchain.output_parsers import ResponseSchema, StructuredOutputParser
     response_schemas = []
     for i in range(number_of_pages):
         response_schemas.append(ResponseSchema(name=f"page_{i}",
@@ -252,12 +291,11 @@ def prepare_answer_format() -> ResponseSchema:
             response_schemas.append(ResponseSchema(name=f"question_{i}",
                                                    description=f"add question {i} about the story"))
     output_parser = StructuredOutputParser.from_response_schemas(response_schemas)
-    return output_parser
+    return output_parser, output_parser.get_format_instructions()
 
-def prepare_answer_format_for_chain(number_of_histories:int) -> ResponseSchema:
-    """
-    Prepare the answer format for the story generator
-    """
+@lru_cache(maxsize=None)
+def chain_parser(number_of_histories:int) -> Tuple["StructuredOutputParser", str]:
+    from langchain.output_parsers import ResponseSchema, StructuredOutputParser
     response_schemas = []
     for i in range(number_of_histories):
         response_schemas.append(ResponseSchema(name=f"history_{i}",
@@ -268,16 +306,11 @@ def prepare_answer_format_for_chain(number_of_histories:int) -> ResponseSchema:
                                              description="add the number of the best history",
                                              type="int"))
     output_parser = StructuredOutputParser.from_response_schemas(response_schemas)
-    return output_parser
-    
-def prepare_answer_format_review(base_dict_values:Dict[str,str]|None = None) -> List[ResponseSchema]:
-    """
-    Prepare the answer format for the story generator
-    """
-    if base_dict_values is None:
-        base_dict_values = history_base_values()
-    number_of_pages = base_dict_values["pages"]
-    questions = base_dict_values["questions"]
+    return output_parser, output_parser.get_format_instructions()
+
+@lru_cache(maxsize=None)
+def review_parser(number_of_pages:int, questions:int) -> Tuple["StructuredOutputParser", str]:
+    from langchain.output_parsers import ResponseSchema, StructuredOutputParser
     response_schemas = [
         ResponseSchema(name="reasoning",
                         description="add reasoning for the reviewed history"),
@@ -292,14 +325,11 @@ def prepare_answer_format_review(base_dict_values:Dict[str,str]|None = None) ->
             response_schemas.append(ResponseSchema(name=f"question_{i}",
                                                    description=f"add question {i} about the story"))
     output_parser = StructuredOutputParser.from_response_schemas(response_schemas)
-    return output_parser
-def prepare_answer_format_to_prompt_image(base_dict_values:Dict[str,Any]|None  = None) -> ResponseSchema:
-    """
-    Prepare the answer format for the story generator
-    """
-    if base_dict_values is None:
-        base_dict_values = history_base_values()
-    number_of_pages = base_dict_values["pages"]
+    return output_parser, output_parser.get_format_instructions()
+
+@lru_cache(maxsize=None)
+def image_prompt_parser(number_of_pages:int) -> Tuple["StructuredOutputParser", str]:
+    from langchain.output_parsers import ResponseSchema, StructuredOutputParser
     number_of_images = number_of_pages - 1
     response_schemas = [
         ResponseSchema(name="reasoning",
@@ -311,44 +341,89 @@ def prepare_answer_format_to_prompt_image(base_dict_values:Dict[str,Any]|None  =
         response_schemas.append(ResponseSchema(name=f"prompt_image_{i}",
                                                   description=f"add prompt for to create the image {i} of the story"))
     output_parser = StructuredOutputParser.from_response_schemas(response_schemas)
-    return output_parser
+    return output_parser, output_parser.get_format_instructions()
+
+@lru_cache(maxsize=None)
+def prompt_template_skeleton(format_instructions:str, instructions:str = "") -> "PromptTemplate":
+    """
+    The template shared by every prompt of a stage with the same format instructions.
+    Only the base prompt (the details of the book) and the question are filled in per prompt.
+    """
+    from langchain.prompts import PromptTemplate
+    return PromptTemplate(
+        template=prompt_skeleton,
+        input_variables=["base_prompt", "question"],
+        partial_variables={"instructions": instructions, "format_instructions": format_instructions},
+    )
+
+def prepare_answer_format(base_dict_values:HistoryConfig|None = None) -> Tuple["StructuredOutputParser", str]:
+    """
+    Prepare the answer format for the story generator: the parser and its format instructions
+    """
+    if base_dict_values is None:
+        base_dict_values = history_base_values()
+    return story_parser(base_dict_values.pages, base_dict_values.questions)
+
+def prepare_answer_format_for_chain(number_of_histories:int) -> Tuple["StructuredOutputParser", str]:
+    """
+    Prepare the answer format for the story generator
+    """
+    return chain_parser(number_of_histories)
+    
+def prepare_answer_format_review(base_dict_values:HistoryConfig|None = None) -> Tuple["StructuredOutputParser", str]:
+    """
+    Prepare the answer format for the story generator
+    """
+    if base_dict_values is None:
+        base_dict_values = history_base_values()
+    return review_parser(base_dict_values.pages, base_dict_values.questions)
+
+def prepare_answer_format_to_prompt_image(base_dict_values:HistoryConfig|None  = None) -> Tuple["StructuredOutputParser", str]:
+    """
+    Prepare the answer format for the story generator
+    """
+    if base_dict_values is None:
+        base_dict_values = history_base_values()
+    return image_prompt_parser(base_dict_values.pages)
+
+def render_prompts(base_prompts:List[str], format_instructions:str,
+                   instructions:str = "") -> List["PromptTemplate"]:
+    """
+    Fills the base prompts in the shared skeleton of the stage: its instructions and the format
+    instructions of its parser first, so every prompt of the stage starts with the same text.
+    """
+    skeleton = prompt_template_skeleton(format_instructions, instructions)
+    return [skeleton.partial(base_prompt=base_prompt) for base_prompt in base_prompts]
 
 def generate_prompts(base_prompts:List[str]|None = None,
-                     output_parser:List[ResponseSchema]|None = None) -> PromptTemplate:
+                     output_parser:"StructuredOutputParser|None" = None,
+                     base_dict_values:HistoryConfig|None = None,
+                     instructions:str|None = None,
+                     format_instructions:str|None = None) -> "PromptTemplate":
     """
-    Prepare the prompt for the story generator
+    Prepare the prompt for the story generator.
+    `instructions` is the static part of the stage, `story_instructions` by default.
+    `format_instructions` are the ones returned with the parser by its builder, computed from the parser if not given.
     """
     if base_prompts is None and output_parser is None:
-        base_prompts = generate_base_prompt()
-        output_parser = prepare_answer_format()
+        base_prompts = generate_base_prompt(base_dict_values)
+        output_parser, format_instructions = prepare_answer_format(base_dict_values)
+    if instructions is None:
+        instructions = story_instructions
+    if format_instructions is None:
+        format_instructions = output_parser.get_format_instructions()
 
-    format_instructions = output_parser.get_format_instructions()
-    output_prompts = []
-    for base_prompt in base_prompts: 
-        prompt = PromptTemplate(
-            template=f"{base_prompt} "+"\n{format_instructions}\n{question}",
-            input_variables=["question"],
-            partial_variables={"format_instructions": format_instructions},
-        )
-        output_prompts.append(prompt)
+    output_prompts = render_prompts(base_prompts, format_instructions, instructions)
     return output_parser, output_prompts
 
-def generate_prompts_for_chain(number_of_histories:int,base_dict_values:Dict[str,Any]|None = None) -> PromptTemplate:
+def generate_prompts_for_chain(number_of_histories:int,base_dict_values:HistoryConfig|None = None) -> "PromptTemplate":
     """
     Prepare the prompt for the story generator
     """
     base_promts = generate_base_prompt_for_chain(number_of_histories, base_dict_values=base_dict_values)
-    output_parser = prepare_answer_format_for_chain(number_of_histories)
+    output_parser, format_instructions = prepare_answer_format_for_chain(number_of_histories)
 
-    format_instructions = output_parser.get_format_instructions()
-    output_prompts = []
-    for base_prompt in base_promts: 
-        prompt = PromptTemplate(
-            template=f"{base_prompt} "+"\n{format_instructions}\n{question}",
-            input_variables=["question"],
-            partial_variables={"format_instructions": format_instructions},
-        )
-        output_prompts.append(prompt)
+    output_prompts = render_prompts(base_promts, format_instructions, chain_instructions)
     return output_parser, output_prompts
 
 if __name__ == "__main__":
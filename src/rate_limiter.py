@@ -0,0 +1,411 @@
+from typing import Dict, List, Mapping, Tuple
+import asyncio
+import json
+import random
+import re
+import threading
+import time
+import httpx
+import read_configuration as rc
+import metrics
+# imported by transport.py when the first client is built
+
+# tokens counted for the answer of a chat request without max_tokens
+completion_token_estimate = 1024
+characters_per_token = 4
+# multiplicative decrease of the concurrency after a 429
+concurrency_decrease = 0.5
+duration_pattern = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+duration_units = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+def parse_duration(value:str|None) -> float|None:
+    """
+    Returns the seconds of a duration of the rate limit headers ("1s", "6m0s", "20ms" or "0.5").
+    """
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = duration_pattern.findall(value)
+    if not parts:
+        return None
+    return sum(float(number) * duration_units[unit] for number, unit in parts)
+
+def endpoint_kind(path:str) -> str|None:
+    if path.endswith("/chat/completions"):
+        return "chat"
+    if path.endswith(("/images/generations", "/images/edits", "/images/variations")):
+        return "images"
+    return None
+
+def estimate_tokens(request:httpx.Request) -> int:
+    """
+    The tokens a chat request counts against the tokens per minute: the prompt (from its length)
+    and the answer (max_tokens or `completion_token_estimate`).
+    """
+    try:
+        body = json.loads(request.content or b"{}")
+    except ValueError:
+        return completion_token_estimate
+    characters = sum(len(str(message.get("content", ""))) for message in body.get("messages", []))
+    return characters // characters_per_token + int(body.get("max_tokens") or completion_token_estimate)
+
+class Bucket:
+    """
+    Token bucket refilled continuously at `limit` per minute. A limit of 0 means no limit until
+    the rate limit headers give one.
+    """
+    def __init__(self, limit:float = 0):
+        self.limit = limit
+        self.level = float(limit)
+        self.updated = time.monotonic()
+
+    def _refill(self, now:float) -> None:
+        if self.limit > 0:
+            self.level = min(self.limit, self.level + (now - self.updated) * self.limit / 60)
+        self.updated = now
+
+    def wait(self, amount:float, now:float) -> float:
+        """
+        Seconds until `amount` is available (0 if it is available now).
+        """
+        self._refill(now)
+        if self.limit <= 0:
+            return 0.0
+        amount = min(amount, self.limit)
+        return 0.0 if self.level >= amount else (amount - self.level) * 60 / self.limit
+
+    def take(self, amount:float) -> None:
+        if self.limit > 0:
+            self.level -= min(amount, self.limit)
+
+    def update(self, limit:float|None, remaining:float|None, now:float) -> None:
+        """
+        Follows the limit and the remaining budget reported by the server.
+        """
+        self._refill(now)
+        if limit is not None and limit > 0:
+            if self.limit <= 0:
+                # the first limit known: the budget starts full
+                self.level = limit
+            self.limit = limit
+        if remaining is not None and self.limit > 0:
+            self.level = min(self.level, remaining)
+
+class EndpointLimiter:
+    """
+    The limits of one endpoint (chat or images) shared by every client of the process: requests and tokens
+    per minute (from the configuration, then from the x-ratelimit-* headers of every response) and the
+    number of requests in flight, adjusted with AIMD: +1/concurrency after every success, halved after
+    every 429. A 429 also pauses every request of the endpoint for its backoff.
+
+    A request waiting for a slot sleeps until a slot is freed or the concurrency grows (a condition for
+    the threads, a future of its event loop for the coroutines); one waiting for budget or for the end of
+    a pause sleeps for the time left.
+    """
+    def __init__(self, name:str, requests_per_minute:float, tokens_per_minute:float, max_concurrency:int):
+        self.name = name
+        self.requests = Bucket(requests_per_minute)
+        self.tokens = Bucket(tokens_per_minute)
+        self.max_concurrency = max_concurrency
+        self.concurrency = float(max_concurrency)
+        self.in_flight = 0
+        self.blocked_until = 0.0
+        self.rate_limited = 0
+        self._lock = threading.Lock()
+        self._slot_freed = threading.Condition(self._lock)
+        self._async_waiters: List[Tuple[asyncio.AbstractEventLoop, asyncio.Future]] = []
+
+    def try_acquire(self, tokens:int) -> float|None:
+        """
+        Takes a slot and the budget of a request and returns 0. Otherwise returns the seconds to wait
+        before trying again, or None if the request has to wait for a free slot.
+        """
+        with self._lock:
+            return self._try_acquire_locked(tokens)
+
+    def _try_acquire_locked(self, tokens:int) -> float|None:
+        now = time.monotonic()
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        if self.in_flight >= int(self.concurrency):
+            return None
+        wait = max(self.requests.wait(1, now), self.tokens.wait(tokens, now))
+        if wait > 0:
+            return wait
+        self.requests.take(1)
+        self.tokens.take(tokens)
+        self.in_flight += 1
+        return 0.0
+
+    def acquire(self, tokens:int) -> float:
+        """
+        Waits for a slot and the budget of a request and takes them. Returns the seconds waited.
+        """
+        start = time.monotonic()
+        waited = False
+        with self._slot_freed:
+            while (wait := self._try_acquire_locked(tokens)) != 0:
+                waited = True
+                self._slot_freed.wait(wait)
+        return time.monotonic() - start if waited else 0.0
+
+    async def acquire_async(self, tokens:int) -> float:
+        """
+        The same as `acquire` without blocking the event loop. Returns the seconds waited.
+        """
+        start = time.monotonic()
+        waited = False
+        while True:
+            slot_freed = None
+            with self._lock:
+                wait = self._try_acquire_locked(tokens)
+                if wait == 0:
+                    return time.monotonic() - start if waited else 0.0
+                if wait is None:
+                    loop = asyncio.get_running_loop()
+                    slot_freed = loop.create_future()
+                    self._async_waiters.append((loop, slot_freed))
+            waited = True
+            if slot_freed is None:
+                await asyncio.sleep(wait)
+            else:
+                await slot_freed
+
+    def _notify_locked(self) -> None:
+        # wakes every request waiting for a slot, of any thread or event loop
+        self._slot_freed.notify_all()
+        waiters, self._async_waiters = self._async_waiters, []
+        for loop, slot_freed in waiters:
+            try:
+                loop.call_soon_threadsafe(_wake, slot_freed)
+            except RuntimeError:
+                # the event loop of the waiter is closed
+                pass
+
+    def release(self) -> None:
+        with self._lock:
+            self.in_flight -= 1
+            self._notify_locked()
+
+    def on_response(self, status_code:int, headers:Mapping[str, str]) -> None:
+        with self._lock:
+            now = time.monotonic()
+            self.requests.update(_header_float(headers, "x-ratelimit-limit-requests"),
+                                 _header_float(headers, "x-ratelimit-remaining-requests"), now)
+            self.tokens.update(_header_float(headers, "x-ratelimit-limit-tokens"),
+                               _header_float(headers, "x-ratelimit-remaining-tokens"), now)
+            if status_code == 429:
+                self.concurrency = max(1.0, self.concurrency * concurrency_decrease)
+                self.rate_limited += 1
+            elif status_code < 400:
+                concurrency = int(self.concurrency)
+                self.concurrency = min(self.max_concurrency, self.concurrency + 1 / self.concurrency)
+                if int(self.concurrency) > concurrency:
+                    self._notify_locked()
+
+    def block(self, seconds:float) -> None:
+        with self._lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+def _wake(slot_freed:asyncio.Future) -> None:
+    if not slot_freed.done():
+        slot_freed.set_result(None)
+
+def _header_float(headers:Mapping[str, str], name:str) -> float|None:
+    value = headers.get(name)
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+class RateLimiter:
+    """
+    The process-wide limiter of the OpenAI requests, one `EndpointLimiter` for the chat completions and
+    one for the images. Other requests (image downloads) are not limited.
+    """
+    def __init__(self, values:rc.RateLimitConfig):
+        self.values = values
+        self.endpoints: Dict[str, EndpointLimiter] = {
+            "chat": EndpointLimiter("chat", values.chat_rpm, values.chat_tpm, values.max_concurrency),
+            "images": EndpointLimiter("images", values.images_rpm, 0, values.max_concurrency),
+        }
+
+    def endpoint(self, request:httpx.Request) -> Tuple[EndpointLimiter|None, int]:
+        kind = endpoint_kind(request.url.path)
+        if kind is None:
+            return None, 0
+        return self.endpoints[kind], estimate_tokens(request) if kind == "chat" else 0
+
+    def backoff(self, attempt:int, headers:Mapping[str, str]) -> float:
+        """
+        Seconds to wait before retrying after a 429: exponential backoff with jitter, never less than
+        the retry-after or reset headers of the response.
+        """
+        retry_after = _header_float(headers, "retry-after-ms")
+        retry_after = retry_after / 1000 if retry_after is not None else parse_duration(headers.get("retry-after"))
+        if retry_after is None:
+            resets = [parse_duration(headers.get(f"x-ratelimit-reset-{name}")) for name in ("requests", "tokens")]
+            retry_after = max([reset for reset in resets if reset is not None], default=0.0)
+        cap = min(self.values.backoff_max, self.values.backoff_base * 2 ** attempt)
+        return max(retry_after, random.uniform(cap / 2, cap))
+
+    def retryable(self, response:httpx.Response, attempt:int) -> bool:
+        # a 429 for an exhausted quota does not go away by waiting
+        return attempt < self.values.max_retries and b"insufficient_quota" not in response.content
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        return {name: {"concurrency": round(endpoint.concurrency, 2), "in_flight": endpoint.in_flight,
+                       "requests_per_minute": endpoint.requests.limit, "tokens_per_minute": endpoint.tokens.limit,
+                       "rate_limited": endpoint.rate_limited}
+                for name, endpoint in self.endpoints.items()}
+
+def _give_up(response:httpx.Response) -> httpx.Response:
+    # the retries are done here, the OpenAI client must not retry the 429 again
+    response.headers["x-should-retry"] = "false"
+    return response
+
+class ReleasingStream(httpx.SyncByteStream):
+    """
+    The body of a response, which frees the slot of its request when it is closed (for streamed answers
+    the request is in flight until the last chunk).
+    """
+    def __init__(self, stream:httpx.SyncByteStream, endpoint:EndpointLimiter):
+        self.stream = stream
+        self.endpoint = endpoint
+        self.released = False
+
+    def __iter__(self):
+        yield from self.stream
+
+    def close(self) -> None:
+        try:
+            self.stream.close()
+        finally:
+            if not self.released:
+                self.released = True
+                self.endpoint.release()
+
+class AsyncReleasingStream(httpx.AsyncByteStream):
+    def __init__(self, stream:httpx.AsyncByteStream, endpoint:EndpointLimiter):
+        self.stream = stream
+        self.endpoint = endpoint
+        self.released = False
+
+    async def __aiter__(self):
+        async for chunk in self.stream:
+            yield chunk
+
+    async def aclose(self) -> None:
+        try:
+            await self.stream.aclose()
+        finally:
+            if not self.released:
+                self.released = True
+                self.endpoint.release()
+
+class RateLimitedTransport(httpx.BaseTransport):
+    """
+    Sends the requests of the sync client through the limiter: waits for a slot and budget, follows
+    the rate limit headers and retries the 429 answers after their backoff.
+    """
+    def __init__(self, transport:httpx.BaseTransport, limiter:RateLimiter):
+        self.transport = transport
+        self.limiter = limiter
+
+    def handle_request(self, request:httpx.Request) -> httpx.Response:
+        endpoint, tokens = self.limiter.endpoint(request)
+        if endpoint is None:
+            return self.transport.handle_request(request)
+        attempt = 0
+        while True:
+            waited = endpoint.acquire(tokens)
+            if waited:
+                metrics.record("rate_limit_wait", waited, parent=metrics.current_parent(),
+                               endpoint=endpoint.name, attempt=attempt)
+            try:
+                response = self.transport.handle_request(request)
+            except BaseException:
+                endpoint.release()
+                raise
+            endpoint.on_response(response.status_code, response.headers)
+            if response.status_code != 429:
+                return httpx.Response(response.status_code, headers=response.headers,
+                                      stream=ReleasingStream(response.stream, endpoint),
+                                      extensions=response.extensions)
+            try:
+                response.read()
+            finally:
+                response.close()
+                endpoint.release()
+            if not self.limiter.retryable(response, attempt):
+                return _give_up(response)
+            delay = self.limiter.backoff(attempt, response.headers)
+            endpoint.block(delay)
+            metrics.record("rate_limited", delay, parent=metrics.current_parent(),
+                           endpoint=endpoint.name, attempt=attempt)
+            attempt += 1
+
+    def close(self) -> None:
+        self.transport.close()
+
+class AsyncRateLimitedTransport(httpx.AsyncBaseTransport):
+    """
+    The same as `RateLimitedTransport` for the async clients. The waits do not block the event loop.
+    """
+    def __init__(self, transport:httpx.AsyncBaseTransport, limiter:RateLimiter):
+        self.transport = transport
+        self.limiter = limiter
+
+    async def handle_async_request(self, request:httpx.Request) -> httpx.Response:
+        endpoint, tokens = self.limiter.endpoint(request)
+        if endpoint is None:
+            return await self.transport.handle_async_request(request)
+        attempt = 0
+        while True:
+            waited = await endpoint.acquire_async(tokens)
+            if waited:
+                metrics.record("rate_limit_wait", waited, parent=metrics.current_parent(),
+                               endpoint=endpoint.name, attempt=attempt)
+            try:
+                response = await self.transport.handle_async_request(request)
+            except BaseException:
+                endpoint.release()
+                raise
+            endpoint.on_response(response.status_code, response.headers)
+            if response.status_code != 429:
+                return httpx.Response(response.status_code, headers=response.headers,
+                                      stream=AsyncReleasingStream(response.stream, endpoint),
+                                      extensions=response.extensions)
+            try:
+                await response.aread()
+            finally:
+                await response.aclose()
+                endpoint.release()
+            if not self.limiter.retryable(response, attempt):
+                return _give_up(response)
+            delay = self.limiter.backoff(attempt, response.headers)
+            endpoint.block(delay)
+            metrics.record("rate_limited", delay, parent=metrics.current_parent(),
+                           endpoint=endpoint.name, attempt=attempt)
+            attempt += 1
+
+    async def aclose(self) -> None:
+        await self.transport.aclose()
+
+_limiter: RateLimiter|None = None
+_limiter_lock = threading.Lock()
+
+def limiter(values:rc.RateLimitConfig) -> RateLimiter:
+    """
+    The limiter of the process, built the first time with `values`. Every client shares it, so the
+    limits hold for the sum of the requests of every thread.
+    """
+    global _limiter
+    with _limiter_lock:
+        if _limiter is None:
+            _limiter = RateLimiter(values)
+        return _limiter
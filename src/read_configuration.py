@@ -1,42 +1,350 @@
-from typing import Dict, Any
+from typing import Dict, Any, Tuple
 from pathlib import Path
+from dataclasses import dataclass, asdict
 import helper_functions as hf
 import configparser
+import threading
 
-def history_base_values(path:str|None = None) -> Dict[str, Any]:
+default_path = Path(__file__).parent.parent / "configuration.ini"
+pdf_backends = ("latex", "native")
+
+@dataclass(frozen=True, slots=True)
+class HistoryConfig:
     """
-    Read the base values for the history generator from the configuration file.
+    Base values for the history generator. The ages are computed from the birthdays every time they are
+    read (`number_of_years`), so a configuration kept by a long-running process does not go stale.
+    """
+    names: Tuple[str, ...]
+    birthdays: Tuple[str, ...]
+    topics: Tuple[str, ...]
+    include_moral_values: bool
+    moral_values: Tuple[str, ...]
+    story_genere: Tuple[str, ...]
+    language: str
+    pages: int
+    words_per_page: int
+    questions: int
+    # ages given directly instead of birthdays (the rows of a manifest)
+    ages: Tuple[int, ...] = ()
+
+    @property
+    def number_of_years(self) -> Tuple[int, ...]:
+        if self.ages:
+            return self.ages
+        return tuple(hf.calculate_number_of_years(date) for date in self.birthdays)
+
+    def __getitem__(self, key:str) -> Any:
+        # kept so code written for the old dictionary keeps working
+        return getattr(self, key)
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {**asdict(self), "number_of_years": self.number_of_years}
+
+@dataclass(frozen=True, slots=True)
+class ExecutionConfig:
+    """
+    Values that only change how the requests are sent.
+    """
+    image_concurrency: int = 4
+    llm_concurrency: int = 4
+    image_response_format: str = "b64_json"
+    batch_concurrency: int = 2
+    pdf_backend: str = "latex"
+    latex_format: bool = True
+    latex_build_dir: str | None = None
+    llm_streaming: bool = False
+
+@dataclass(frozen=True, slots=True)
+class ImageConfig:
+    """
+    Values of the post-processing of the images before the PDF (see line_art.py).
+    """
+    line_art: bool = False
+    line_art_threshold: int = 160
+    print_dpi: int = 300
+
+@dataclass(frozen=True, slots=True)
+class CacheConfig:
+    """
+    Values of the on-disk caches. They are all disabled by default.
+    """
+    llm_cache_candidates: bool = False
+    llm_cache_review: bool = False
+    llm_cache_image_prompts: bool = False
+    llm_cache_max_bytes: int = 256 * 1024 * 1024
+    llm_cache_ttl: float | None = None
+    image_cache: bool = False
+    image_cache_max_bytes: int = 1024 * 1024 * 1024
+    layout_memo: bool = False
+
+@dataclass(frozen=True, slots=True)
+class StoryIndexConfig:
+    """
+    Values of the index of the previous stories shown to the review (see story_index.py).
+    """
+    enabled: bool = False
+    top_k: int = 3
+    summary_words: int = 30
+
+@dataclass(frozen=True, slots=True)
+class MetricsConfig:
+    """
+    Values of the metrics of the runs (see metrics.py). Disabled by default.
+    """
+    enabled: bool = False
+    prometheus_textfile: str | None = None
+
+@dataclass(frozen=True, slots=True)
+class TransportConfig:
+    """
+    Values of the HTTP client shared by every OpenAI request and image download (see transport.py).
+    """
+    http2: bool = True
+    max_connections: int = 100
+    max_keepalive_connections: int = 20
+    keepalive_expiry: float = 30.0
+    timeout: float = 600.0
+    connect_timeout: float = 10.0
+
+@dataclass(frozen=True, slots=True)
+class RateLimitConfig:
+    """
+    Values of the process-wide rate limiter of the OpenAI requests (see rate_limiter.py).
+    The limits per minute are 0 until the rate limit headers of the answers give them. Disabled by default,
+    the requests are then retried by the OpenAI client as usual.
+    """
+    enabled: bool = False
+    chat_rpm: int = 0
+    chat_tpm: int = 0
+    images_rpm: int = 0
+    max_concurrency: int = 32
+    max_retries: int = 6
+    backoff_base: float = 1.0
+    backoff_max: float = 60.0
+
+@dataclass(frozen=True, slots=True)
+class BatchApiConfig:
+    """
+    Values of the offline mode that sends the LLM requests through the OpenAI Batch API (see batch_api.py).
+    """
+    enabled: bool = False
+    completion_window: str = "24h"
+    poll_seconds: float = 30.0
+    gather_seconds: float = 5.0
+
+@dataclass(frozen=True, slots=True)
+class ServiceConfig:
+    """
+    Values of the generation service (see service.py).
+    """
+    host: str = "127.0.0.1"
+    port: int = 8080
+    workers: int = 2
+    queue_size: int = 16
+
+@dataclass(frozen=True, slots=True)
+class Configuration:
+    """
+    Every section of the configuration file, read once. `mtime` is the modification time of the file
+    when it was read; `load_configuration` reads the file again only if it changes.
+    """
+    history: HistoryConfig
+    execution: ExecutionConfig
+    images: ImageConfig
+    cache: CacheConfig
+    story_index: StoryIndexConfig
+    metrics: MetricsConfig
+    transport: TransportConfig
+    rate_limit: RateLimitConfig
+    batch_api: BatchApiConfig
+    service: ServiceConfig
+    path: str
+    mtime: int
+
+_configurations: Dict[str, Configuration] = {}
+_lock = threading.Lock()
+
+def _split(value:str) -> Tuple[str, ...]:
+    return tuple(i.strip() for i in value.split(","))
+
+def _read_history(config:configparser.ConfigParser) -> HistoryConfig:
+    return HistoryConfig(
+        names=tuple(i.lower().capitalize() for i in _split(config["childs"]["NAMES"])),
+        birthdays=_split(config["childs"]["BIRTHDAYS"]),
+        topics=tuple(i.lower() for i in _split(config["history"]["TOPICS"])),
+        include_moral_values=config["history"]["INCLUDE_MORAL_VALUES"].strip().lower() == "true",
+        moral_values=tuple(i.lower() for i in _split(config["history"]["MORAL_VALUES"])),
+        story_genere=tuple(i.lower() for i in _split(config["history"]["STORY_GENERE"])),
+        language=config["book"]["LANGUAGE"].strip().lower().capitalize(),
+        pages=int(config["book"]["PAGES"]),
+        words_per_page=int(config["book"]["WORDS_PER_PAGE"]),
+        questions=int(config["activity"]["QUESTIONS"]),
+    )
+
+def _read_execution(config:configparser.ConfigParser) -> ExecutionConfig:
+    # missing values fall back to the defaults so older configuration files keep working
+    if not config.has_section("execution"):
+        config.add_section("execution")
+    execution = config["execution"]
+    image_response_format = execution.get("IMAGE_RESPONSE_FORMAT", fallback="b64_json").strip().lower()
+    if image_response_format not in ("b64_json", "url"):
+        raise ValueError(f"IMAGE_RESPONSE_FORMAT must be b64_json or url, not {image_response_format}")
+    pdf_backend = execution.get("PDF_BACKEND", fallback="latex").strip().lower()
+    if pdf_backend not in pdf_backends:
+        raise ValueError(f"PDF_BACKEND must be one of {', '.join(pdf_backends)}, not {pdf_backend}")
+    return ExecutionConfig(
+        image_concurrency=max(1, execution.getint("IMAGE_CONCURRENCY", fallback=4)),
+        llm_concurrency=max(1, execution.getint("LLM_CONCURRENCY", fallback=4)),
+        image_response_format=image_response_format,
+        batch_concurrency=max(1, execution.getint("BATCH_CONCURRENCY", fallback=2)),
+        pdf_backend=pdf_backend,
+        latex_format=execution.getboolean("LATEX_FORMAT", fallback=True),
+        latex_build_dir=execution.get("LATEX_BUILD_DIR", fallback="").strip() or None,
+        llm_streaming=execution.getboolean("LLM_STREAMING", fallback=False),
+    )
+
+def _read_images(config:configparser.ConfigParser) -> ImageConfig:
+    if not config.has_section("images"):
+        config.add_section("images")
+    images = config["images"]
+    return ImageConfig(
+        line_art=images.getboolean("LINE_ART", fallback=False),
+        line_art_threshold=min(255, max(0, images.getint("LINE_ART_THRESHOLD", fallback=160))),
+        print_dpi=max(0, images.getint("PRINT_DPI", fallback=300)),
+    )
+
+def _read_cache(config:configparser.ConfigParser) -> CacheConfig:
+    if not config.has_section("cache"):
+        config.add_section("cache")
+    cache = config["cache"]
+    llm_cache_ttl_hours = cache.getfloat("LLM_CACHE_TTL_HOURS", fallback=0)
+    return CacheConfig(
+        llm_cache_candidates=cache.getboolean("LLM_CACHE_CANDIDATES", fallback=False),
+        llm_cache_review=cache.getboolean("LLM_CACHE_REVIEW", fallback=False),
+        llm_cache_image_prompts=cache.getboolean("LLM_CACHE_IMAGE_PROMPTS", fallback=False),
+        llm_cache_max_bytes=int(cache.getfloat("LLM_CACHE_MAX_MB", fallback=256) * 1024 * 1024),
+        llm_cache_ttl=llm_cache_ttl_hours * 3600 if llm_cache_ttl_hours > 0 else None,
+        image_cache=cache.getboolean("IMAGE_CACHE", fallback=False),
+        image_cache_max_bytes=int(cache.getfloat("IMAGE_CACHE_MAX_MB", fallback=1024) * 1024 * 1024),
+        layout_memo=cache.getboolean("LAYOUT_MEMO", fallback=False),
+    )
+
+def _read_story_index(config:configparser.ConfigParser) -> StoryIndexConfig:
+    if not config.has_section("story_index"):
+        config.add_section("story_index")
+    story_index = config["story_index"]
+    return StoryIndexConfig(
+        enabled=story_index.getboolean("ENABLED", fallback=False),
+        top_k=max(0, story_index.getint("TOP_K", fallback=3)),
+        summary_words=max(1, story_index.getint("SUMMARY_WORDS", fallback=30)),
+    )
+
+def _read_metrics(config:configparser.ConfigParser) -> MetricsConfig:
+    if not config.has_section("metrics"):
+        config.add_section("metrics")
+    metrics = config["metrics"]
+    return MetricsConfig(
+        enabled=metrics.getboolean("ENABLED", fallback=False),
+        prometheus_textfile=metrics.get("PROMETHEUS_TEXTFILE", fallback="").strip() or None,
+    )
+
+def _read_transport(config:configparser.ConfigParser) -> TransportConfig:
+    if not config.has_section("transport"):
+        config.add_section("transport")
+    transport = config["transport"]
+    return TransportConfig(
+        http2=transport.getboolean("HTTP2", fallback=True),
+        max_connections=max(1, transport.getint("MAX_CONNECTIONS", fallback=100)),
+        max_keepalive_connections=max(0, transport.getint("MAX_KEEPALIVE_CONNECTIONS", fallback=20)),
+        keepalive_expiry=transport.getfloat("KEEPALIVE_EXPIRY", fallback=30.0),
+        timeout=transport.getfloat("TIMEOUT", fallback=600.0),
+        connect_timeout=transport.getfloat("CONNECT_TIMEOUT", fallback=10.0),
+    )
+
+def _read_rate_limit(config:configparser.ConfigParser) -> RateLimitConfig:
+    if not config.has_section("rate_limit"):
+        config.add_section("rate_limit")
+    rate_limit = config["rate_limit"]
+    return RateLimitConfig(
+        enabled=rate_limit.getboolean("ENABLED", fallback=False),
+        chat_rpm=max(0, rate_limit.getint("CHAT_RPM", fallback=0)),
+        chat_tpm=max(0, rate_limit.getint("CHAT_TPM", fallback=0)),
+        images_rpm=max(0, rate_limit.getint("IMAGES_RPM", fallback=0)),
+        max_concurrency=max(1, rate_limit.getint("MAX_CONCURRENCY", fallback=32)),
+        max_retries=max(0, rate_limit.getint("MAX_RETRIES", fallback=6)),
+        backoff_base=rate_limit.getfloat("BACKOFF_BASE", fallback=1.0),
+        backoff_max=rate_limit.getfloat("BACKOFF_MAX", fallback=60.0),
+    )
+
+def _read_batch_api(config:configparser.ConfigParser) -> BatchApiConfig:
+    if not config.has_section("batch_api"):
+        config.add_section("batch_api")
+    batch_api = config["batch_api"]
+    return BatchApiConfig(
+        enabled=batch_api.getboolean("ENABLED", fallback=False),
+        completion_window=batch_api.get("COMPLETION_WINDOW", fallback="24h").strip() or "24h",
+        poll_seconds=max(0.1, batch_api.getfloat("POLL_SECONDS", fallback=30.0)),
+        gather_seconds=max(0.0, batch_api.getfloat("GATHER_SECONDS", fallback=5.0)),
+    )
+
+def _read_service(config:configparser.ConfigParser) -> ServiceConfig:
+    if not config.has_section("service"):
+        config.add_section("service")
+    service = config["service"]
+    return ServiceConfig(
+        host=service.get("HOST", fallback="127.0.0.1").strip() or "127.0.0.1",
+        port=service.getint("PORT", fallback=8080),
+        workers=max(1, service.getint("WORKERS", fallback=2)),
+        queue_size=max(1, service.getint("QUEUE_SIZE", fallback=16)),
+    )
+
+def load_configuration(path:str|None = None) -> Configuration:
+    """
+    Read the configuration file once and return it as an immutable object.
+    Later calls return the same object until the modification time of the file changes.
     """
-    config = configparser.ConfigParser()
     if not path:
-        path = Path(__file__).parent.parent / "configuration.ini"
-    if not Path(path).exists():
+        path = default_path
+    path = Path(path)
+    if not path.exists():
         raise FileNotFoundError(f"File {path} not found")
-    config.read(path)
-    names = [i.strip().lower().capitalize() for i in config["childs"]["NAMES"].split(",")]
-    birthdays = [i.strip() for i in config["childs"]["BIRTHDAYS"].split(",")]
-    number_of_years = [ hf.calculate_number_of_years(date) for date in birthdays]
-    topics = [i.strip().lower() for i in config["history"]["TOPICS"].split(",")]
-    include_moral_values = config["history"]["INCLUDE_MORAL_VALUES"].strip().lower() == "true"
-    moral_values = [i.strip().lower() for i in config["history"]["MORAL_VALUES"].split(",")]
-    story_genere = [i.strip().lower() for i in config["history"]["STORY_GENERE"].split(",")]
-    language = config["book"]["LANGUAGE"].strip().lower().capitalize()
-    pages = int(config["book"]["PAGES"])
-    words_per_page = int(config["book"]["WORDS_PER_PAGE"])
-    questions = int(config["activity"]["QUESTIONS"])
-
-    out_put = {
-        "names": names,
-        "birthdays": birthdays,
-        "number_of_years": number_of_years,
-        "topics": topics,
-        "include_moral_values": include_moral_values,
-        "moral_values": moral_values,
-        "story_genere": story_genere,
-        "language": language,
-        "pages": pages,
-        "words_per_page": words_per_page,
-        "questions": questions
-    }
-
-    return out_put
+    key = str(path.resolve())
+    mtime = path.stat().st_mtime_ns
+    with _lock:
+        configuration = _configurations.get(key)
+        if configuration is not None and configuration.mtime == mtime:
+            return configuration
+        config = configparser.ConfigParser()
+        config.read(path)
+        configuration = Configuration(history=_read_history(config),
+                                      execution=_read_execution(config),
+                                      images=_read_images(config),
+                                      cache=_read_cache(config),
+                                      story_index=_read_story_index(config),
+                                      metrics=_read_metrics(config),
+                                      transport=_read_transport(config),
+                                      rate_limit=_read_rate_limit(config),
+                                      batch_api=_read_batch_api(config),
+                                      service=_read_service(config),
+                                      path=key,
+                                      mtime=mtime)
+        _configurations[key] = configuration
+        return configuration
+
+def history_base_values(path:str|None = None) -> HistoryConfig:
+    """
+    Read the base values for the history generator from the configuration file.
+    """
+    return load_configuration(path).history
+
+def execution_values(path:str|None = None) -> ExecutionConfig:
+    """
+    Read the execution values (concurrency, response format...) from the configuration file.
+    """
+    return load_configuration(path).execution
+
+def cache_values(path:str|None = None) -> CacheConfig:
+    """
+    Read the cache values from the configuration file.
+    """
+    return load_configuration(path).cache
@@ -0,0 +1,299 @@
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from pathlib import Path
+from typing import Dict, Any, List
+from collections import OrderedDict
+from dataclasses import dataclass, field
+import itertools
+import json
+import logging
+import queue
+import threading
+import time
+import read_configuration as rc
+import helper_functions as hf
+import clients
+import transport
+from checkpoint import Checkpoint
+from batch_runner import row_configuration, row_identifier
+from pipeline import (open_llm_cache, open_image_cache, open_layout_memo, open_story_index, open_metrics, close_metrics,
+                      run_review_pipeline, pdf_renderer, history_values, number_of_candidates, JobCancelled)
+
+stories_path = Path(__file__).parent.parent / "stories"
+# finished jobs kept to be polled, the oldest are forgotten first
+finished_jobs = 1000
+max_body_bytes = 1024 * 1024
+retry_after_seconds = 30
+
+@dataclass(slots=True)
+class Job:
+    """
+    A book requested to the service. `status` is queued, running, done, failed or cancelled.
+    """
+    id: str
+    row: Dict[str, Any]
+    base_dict_values: rc.HistoryConfig
+    status: str = "queued"
+    error: str | None = None
+    submitted: float = field(default_factory=time.time)
+    started: float | None = None
+    finished: float | None = None
+    pdfs: List[str] = field(default_factory=list)
+    cancel: threading.Event = field(default_factory=threading.Event)
+
+    def to_dict(self) -> Dict[str, Any]:
+        values = {"id": self.id, "status": self.status, "row": self.row, "submitted": self.submitted,
+                  "started": self.started, "finished": self.finished, "pdfs": self.pdfs}
+        if self.error is not None:
+            values["error"] = self.error
+        if self.cancel.is_set() and self.status == "running":
+            values["cancelling"] = True
+        return values
+
+class StoryService:
+    """
+    Generates books in a long-lived process. The modules, the configuration, the caches, the prompt
+    parsers and the LaTeX format are loaded once, and every worker thread keeps its OpenAI and ChatOpenAI
+    clients (see `clients`) between books, so a book only pays for its own requests.
+
+    Jobs wait in a bounded queue: when it is full `submit` raises `queue.Full` (429 in the HTTP API), which
+    bounds the memory used and the requests in flight. A queued job is cancelled at once, a running job
+    stops before its next stage.
+    """
+    def __init__(self, configuration:rc.Configuration, service_id:str,
+                 logger:logging.Logger|None = None,
+                 concurrent:bool = False,
+                 save_data:bool = False):
+        self.configuration = configuration
+        self.service_id = service_id
+        self.logger = logger
+        self.concurrent = concurrent
+        self.save_data = save_data
+        self.queue: queue.Queue = queue.Queue(maxsize=configuration.service.queue_size)
+        self.jobs: "OrderedDict[str, Job]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._counter = itertools.count()
+        self._workers: List[threading.Thread] = []
+        self._running = 0
+        self.llm_cache = None
+        self.image_cache = None
+        self.layout_memo = None
+        self.story_index = None
+
+    def warm_up(self) -> None:
+        """
+        Loads what every book needs before the first job arrives: the API key, the prompt parsers and
+        templates of the configured book shape and the modules of the PDF backend.
+        """
+        import prepare_prompt as pp
+        hf.openai_api_key()
+        base_dict_values = history_values(self.configuration.history, 0)
+        pp.generate_prompts_for_chain(number_of_candidates, base_dict_values)
+        pp.review_parser(base_dict_values.pages, base_dict_values.questions)
+        pp.image_prompt_parser(base_dict_values.pages)
+        pdf_renderer(self.configuration.execution.pdf_backend)
+
+    def start(self) -> "StoryService":
+        self.llm_cache = open_llm_cache(self.configuration.cache)
+        self.image_cache = open_image_cache(self.configuration.cache)
+        self.layout_memo = open_layout_memo(self.configuration.cache)
+        self.story_index = open_story_index(self.configuration.story_index, self.logger)
+        # the spans of every job go to the metrics of the service, tagged with the identifier of the job
+        open_metrics(self.service_id, self.configuration.metrics)
+        self.warm_up()
+        for i in range(self.configuration.service.workers):
+            worker = threading.Thread(target=self._work, name=f"story-worker-{i}", daemon=True)
+            worker.start()
+            self._workers.append(worker)
+        if self.logger is not None:
+            self.logger.info(f"Service {self.service_id}: {len(self._workers)} workers, "
+                             f"queue of {self.queue.maxsize} jobs")
+        return self
+
+    def stop(self) -> None:
+        """
+        Cancels the queued jobs, waits for the running ones and closes the caches and the metrics.
+        """
+        with self._lock:
+            for job in self.jobs.values():
+                if job.status == "queued":
+                    job.cancel.set()
+        for _ in self._workers:
+            self.queue.put(None)
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+        close_metrics(self.logger)
+        if self.llm_cache is not None:
+            self.llm_cache.log_stats(self.logger)
+            self.llm_cache.close()
+        if self.image_cache is not None:
+            self.image_cache.log_stats(self.logger)
+        if self.layout_memo is not None:
+            self.layout_memo.log_stats(self.logger)
+            self.layout_memo.close()
+        if self.story_index is not None:
+            self.story_index.log_stats(self.logger)
+            self.story_index.close()
+
+    def submit(self, row:Dict[str, Any]) -> Job:
+        """
+        Queues a book. The row has the fields of a manifest row (see batch_runner.read_manifest).
+
+        Raises:
+            ValueError: If the row is not valid.
+            queue.Full: If the queue is full.
+        """
+        base_dict_values = row_configuration(row, self.configuration.history)
+        job = Job(id=row_identifier(self.service_id, next(self._counter), row), row=row,
+                  base_dict_values=base_dict_values)
+        with self._lock:
+            self.queue.put_nowait(job)
+            self.jobs[job.id] = job
+            self._forget_finished()
+        if self.logger is not None:
+            self.logger.info(f"Job {job.id} queued")
+        return job
+
+    def get(self, job_id:str) -> Job|None:
+        with self._lock:
+            return self.jobs.get(job_id)
+
+    def cancel(self, job_id:str) -> Job|None:
+        with self._lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return None
+            if job.status in ("queued", "running"):
+                job.cancel.set()
+            if job.status == "queued":
+                # the worker that takes it from the queue skips it
+                job.status = "cancelled"
+                job.finished = time.time()
+        return job
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            statuses = {}
+            for job in self.jobs.values():
+                statuses[job.status] = statuses.get(job.status, 0) + 1
+            return {"service": self.service_id, "workers": len(self._workers), "running": self._running,
+                    "queued": self.queue.qsize(), "queue_size": self.queue.maxsize, "jobs": statuses,
+                    "rate_limit": transport.rate_limit_stats()}
+
+    def _forget_finished(self) -> None:
+        finished = [job_id for job_id, job in self.jobs.items() if job.finished is not None]
+        for job_id in finished[:max(0, len(finished) - finished_jobs)]:
+            del self.jobs[job_id]
+
+    def _work(self) -> None:
+        try:
+            while True:
+                job = self.queue.get()
+                if job is None:
+                    return
+                with self._lock:
+                    if job.cancel.is_set():
+                        job.status = "cancelled"
+                        job.finished = job.finished or time.time()
+                        continue
+                    job.status = "running"
+                    job.started = time.time()
+                    self._running += 1
+                self._run(job)
+        finally:
+            clients.close_thread_clients()
+
+    def _run(self, job:Job) -> None:
+        checkpoint = Checkpoint(job.id, logger=self.logger) if self.save_data else None
+        status, error = "done", None
+        try:
+            run_review_pipeline(job.id, self.configuration, base_dict_values=job.base_dict_values,
+                                logger=self.logger, checkpoint=checkpoint, concurrent=self.concurrent,
+                                llm_cache=self.llm_cache, image_cache=self.image_cache, verbose=False,
+                                cancel=job.cancel, layout_memo=self.layout_memo,
+                                story_index=self.story_index)
+        except JobCancelled:
+            status = "cancelled"
+        except Exception as e:
+            if self.logger is not None:
+                self.logger.error(f"Error generating job {job.id}: {e}")
+            status, error = "failed", str(e)
+        with self._lock:
+            job.status = status
+            job.error = error
+            job.finished = time.time()
+            job.pdfs = sorted(str(path) for path in stories_path.glob(f"{job.id}_story_*.pdf"))
+            self._running -= 1
+        if self.logger is not None:
+            self.logger.info(f"Job {job.id} {status} in {round(job.finished - job.started, 3)} s")
+
+def make_server(service:StoryService, host:str, port:int) -> ThreadingHTTPServer:
+    """
+    The HTTP/JSON API of the service:
+
+    - `POST /jobs` with a manifest row queues a book: 202 with the job, 400 if the row is not valid and
+      429 (with Retry-After) if the queue is full.
+    - `GET /jobs` lists the jobs and `GET /jobs/<id>` returns one, with its status and its PDFs.
+    - `DELETE /jobs/<id>` cancels a job.
+    - `GET /health` returns the workers, the queue and the jobs per status.
+    """
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            if service.logger is not None:
+                service.logger.debug(format % args)
+
+        def send_json(self, status:int, payload:Any, headers:Dict[str, str]|None = None) -> None:
+            data = json.dumps(payload, ensure_ascii=False, default=str).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def job_id(self) -> str|None:
+            parts = self.path.rstrip("/").split("/")
+            return parts[2] if len(parts) == 3 and parts[1] == "jobs" else None
+
+        def do_POST(self):
+            if self.path.rstrip("/") != "/jobs":
+                return self.send_json(404, {"error": f"Unknown path {self.path}"})
+            length = int(self.headers.get("Content-Length", 0))
+            if length > max_body_bytes:
+                return self.send_json(413, {"error": "The request is too large"})
+            try:
+                row = json.loads(self.rfile.read(length) or b"{}")
+                if not isinstance(row, dict):
+                    raise ValueError("The body must be a JSON object")
+                job = service.submit(row)
+            except queue.Full:
+                return self.send_json(429, {"error": "The queue is full, try again later"},
+                                      {"Retry-After": str(retry_after_seconds)})
+            except (ValueError, TypeError) as e:
+                return self.send_json(400, {"error": str(e)})
+            self.send_json(202, job.to_dict(), {"Location": f"/jobs/{job.id}"})
+
+        def do_GET(self):
+            if self.path.rstrip("/") == "/health":
+                return self.send_json(200, service.stats())
+            if self.path.rstrip("/") == "/jobs":
+                with service._lock:
+                    jobs = [{"id": job.id, "status": job.status} for job in service.jobs.values()]
+                return self.send_json(200, jobs)
+            job = service.get(self.job_id() or "")
+            if job is None:
+                return self.send_json(404, {"error": f"Unknown job {self.path}"})
+            self.send_json(200, job.to_dict())
+
+        def do_DELETE(self):
+            job = service.cancel(self.job_id() or "")
+            if job is None:
+                return self.send_json(404, {"error": f"Unknown job {self.path}"})
+            self.send_json(200, job.to_dict())
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    return server
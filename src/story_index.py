@@ -0,0 +1,266 @@
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Tuple
+from collections import Counter
+import hashlib
+import heapq
+import logging
+import math
+import pickle
+import re
+import sqlite3
+import threading
+import time
+
+path = Path(__file__).parent.parent / "data" / "story_index.sqlite3"
+data_path = Path(__file__).parent.parent / "data"
+stories_path = Path(__file__).parent.parent / "stories"
+top_k = 3
+summary_words = 30
+# BM25 parameters of the ranking
+k1 = 1.2
+b = 0.75
+# only the rarest words of a story are looked up, so a query reads a bounded number of postings
+max_query_terms = 48
+# words in more than this share of the stories (articles, pronouns...) do not tell stories apart
+max_document_frequency = 0.5
+# words of four or more letters, in any language
+word_pattern = re.compile(r"[^\W\d_]{4,}")
+name_pattern = re.compile(r"[^\W\d_][^\W\d_'’-]*")
+sentence_ends = ".!?¡¿:;«»\"“”—–-\n"
+
+def terms(text:str) -> Counter:
+    """
+    Returns the number of times every word of the text appears, lowercased.
+    """
+    return Counter(word_pattern.findall(text.lower()))
+
+def character_names(text:str, limit:int = 4) -> List[str]:
+    """
+    Returns the capitalized words that appear more than once in the middle of a sentence,
+    most frequent first: usually the names of the characters.
+    """
+    names = Counter()
+    for match in name_pattern.finditer(text):
+        word = match.group()
+        if not word[0].isupper() or len(word) < 3:
+            continue
+        before = text[:match.start()].rstrip()
+        if not before or before[-1] in sentence_ends:
+            continue
+        names[word] += 1
+    return [name for name, count in names.most_common(limit) if count > 1]
+
+def summarize(text:str, title:str|None = None, words:int = summary_words) -> str:
+    """
+    Returns a short extractive summary of a story: its title, its first words and its characters.
+    """
+    opening = text.split()
+    summary = " ".join(opening[:words]) + ("..." if len(opening) > words else "")
+    if title:
+        summary = f"{title}: {summary}"
+    names = character_names(text)
+    if names:
+        summary += f" Personajes: {', '.join(names)}."
+    return summary
+
+def story_text(details:Dict[str, Any]) -> Tuple[str, str|None]:
+    """
+    Returns the text of the pages (page_0, page_1...) and the title of the details of a history.
+    """
+    pages = sorted((k for k in details if k.startswith("page_") and k[5:].isdigit()), key=lambda k: int(k[5:]))
+    return "\n".join(str(details[k]) for k in pages), details.get("title")
+
+class StoryIndex:
+    """
+    Local index of the stories already generated, stored in SQLite, to show the review the most
+    similar previous stories so it avoids their vocabulary, plots and character names.
+
+    Every story is kept as a short summary (see `summarize`) and its words in an inverted index.
+    A new story is compared with the previous ones by TF-IDF (BM25 weighting) reading only the postings
+    of its rarest words, and only the summaries of the `top_k` most similar stories go in the prompt,
+    so the prompt has the same size with ten or with tens of thousands of books in the archive.
+    Stories are keyed by `<identifier>/<history>`, the same story is only indexed once.
+    """
+    def __init__(self, path:str|Path = path, top_k:int = top_k, summary_words:int = summary_words):
+        self.path = Path(path)
+        self.path.parent.mkdir(exist_ok=True)
+        self.top_k = top_k
+        self.summary_words = summary_words
+        self.queries = 0
+        self.added = 0
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(str(self.path), check_same_thread=False, timeout=30)
+        with self._connection:
+            self._connection.execute(
+                """CREATE TABLE IF NOT EXISTS stories (
+                    id INTEGER PRIMARY KEY,
+                    key TEXT UNIQUE NOT NULL,
+                    digest TEXT UNIQUE NOT NULL,
+                    summary TEXT NOT NULL,
+                    length INTEGER NOT NULL,
+                    created REAL NOT NULL)""")
+            self._connection.execute(
+                """CREATE TABLE IF NOT EXISTS postings (
+                    term TEXT NOT NULL,
+                    story INTEGER NOT NULL,
+                    count INTEGER NOT NULL)""")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS postings_term ON postings (term)")
+            self._connection.execute(
+                """CREATE TABLE IF NOT EXISTS terms (
+                    term TEXT PRIMARY KEY,
+                    frequency INTEGER NOT NULL)""")
+            self._connection.execute(
+                """CREATE TABLE IF NOT EXISTS sources (
+                    path TEXT PRIMARY KEY,
+                    mtime REAL NOT NULL)""")
+
+    def add(self, key:str, text:str, title:str|None = None) -> bool:
+        """
+        Adds a story to the index. Returns False if the key or the same text is already indexed.
+        """
+        counts = terms(text)
+        if not counts:
+            return False
+        digest = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        summary = summarize(text, title, self.summary_words)
+        with self._lock, self._connection:
+            try:
+                cursor = self._connection.execute(
+                    "INSERT INTO stories (key, digest, summary, length, created) VALUES (?, ?, ?, ?, ?)",
+                    (key, digest, summary, sum(counts.values()), time.time()))
+            except sqlite3.IntegrityError:
+                return False
+            story = cursor.lastrowid
+            self._connection.executemany("INSERT INTO postings (term, story, count) VALUES (?, ?, ?)",
+                                         [(term, story, count) for term, count in counts.items()])
+            self._connection.executemany(
+                """INSERT INTO terms (term, frequency) VALUES (?, 1)
+                   ON CONFLICT(term) DO UPDATE SET frequency = frequency + 1""",
+                [(term,) for term in counts])
+            self.added += 1
+        return True
+
+    def add_history(self, key:str, details:Dict[str, Any]) -> bool:
+        """
+        Adds the story of the details of a history (its pages and title).
+        """
+        text, title = story_text(details)
+        return self.add(key, text, title)
+
+    def similar(self, text:str, k:int|None = None) -> List[Tuple[float, str]]:
+        """
+        Returns the score and the summary of the `k` previous stories most similar to the text, best first.
+        """
+        k = self.top_k if k is None else k
+        counts = terms(text)
+        if k <= 0 or not counts:
+            return []
+        with self._lock:
+            self.queries += 1
+            total, average_length = self._connection.execute(
+                "SELECT COUNT(*), AVG(length) FROM stories").fetchone()
+            if not total:
+                return []
+            frequencies = {}
+            for chunk in range(0, len(counts), 500):
+                selected = list(counts)[chunk:chunk + 500]
+                frequencies.update(self._connection.execute(
+                    f"SELECT term, frequency FROM terms WHERE term IN ({','.join('?' * len(selected))})",
+                    selected).fetchall())
+            limit = max(1, max_document_frequency * total) if total > 1 else 1
+            query = heapq.nsmallest(max_query_terms,
+                                    (term for term in frequencies if frequencies[term] <= limit),
+                                    key=lambda term: frequencies[term])
+            scores = Counter()
+            for term in query:
+                idf = math.log(1 + (total - frequencies[term] + 0.5) / (frequencies[term] + 0.5))
+                rows = self._connection.execute(
+                    """SELECT postings.story, postings.count, stories.length FROM postings
+                       JOIN stories ON stories.id = postings.story WHERE postings.term = ?""", (term,))
+                for story, count, length in rows:
+                    scores[story] += idf * count * (k1 + 1) / (count + k1 * (1 - b + b * length / average_length))
+            best = scores.most_common(k)
+            if not best:
+                return []
+            summaries = dict(self._connection.execute(
+                f"SELECT id, summary FROM stories WHERE id IN ({','.join('?' * len(best))})",
+                [story for story, _ in best]).fetchall())
+        return [(score, summaries[story]) for story, score in best]
+
+    def other_histories(self, text:str, k:int|None = None) -> str|None:
+        """
+        Returns the summaries of the previous stories most similar to the text, one per line,
+        as the `other_histories` of the review prompt, or None if there are none.
+        """
+        similar = self.similar(text, k)
+        if not similar:
+            return None
+        return "\n".join(f"- {summary}" for _, summary in similar)
+
+    def _sources(self, data_path:Path, stories_path:Path) -> Iterator[Tuple[Path, str]]:
+        # the reviewed stories of the checkpoints and of the saved runs come before the PDFs,
+        # whose text also has the questions
+        for file in sorted(data_path.glob("*/*.pkl")):
+            if not file.stem.startswith("candidates"):
+                yield file, file.parent.name
+        for file in sorted(data_path.glob("*_data.pkl")):
+            yield file, file.stem[:-len("_data")]
+        for file in sorted(stories_path.glob("*_story_*.pdf")):
+            yield file, file.stem.split("_story_")[0]
+
+    def _read_source(self, file:Path, identifier:str) -> List[Tuple[str, str, str|None]]:
+        if file.suffix == ".pdf":
+            import PyPDF2
+            with open(file, "rb") as f:
+                reader = PyPDF2.PdfReader(f)
+                text = "\n".join(page.extract_text() or "" for page in reader.pages)
+            return [(f"{identifier}/{file.stem.split('_story_')[-1]}", text, None)]
+        with open(file, "rb") as f:
+            data = pickle.load(f)
+        stories = []
+        for history, details in data.items() if isinstance(data, dict) else ():
+            if isinstance(details, dict) and "page_0" in details:
+                text, title = story_text(details)
+                stories.append((f"{identifier}/{history}", text, title))
+        return stories
+
+    def add_archive(self, data_path:str|Path = data_path, stories_path:str|Path = stories_path,
+                    logger:logging.Logger|None = None) -> int:
+        """
+        Adds the stories of the runs saved in `data/` (checkpoints and saved data) and of the PDFs
+        in `stories/`. Files already read are skipped unless they changed. Returns the number of stories added.
+        """
+        with self._lock:
+            known = dict(self._connection.execute("SELECT path, mtime FROM sources").fetchall())
+        added = 0
+        for file, identifier in self._sources(Path(data_path), Path(stories_path)):
+            mtime = file.stat().st_mtime
+            if known.get(str(file)) == mtime:
+                continue
+            try:
+                stories = self._read_source(file, identifier)
+            except Exception as e:
+                if logger is not None:
+                    logger.warning(f"Story index: {file.name} not read: {e}")
+                stories = []
+            for key, text, title in stories:
+                added += self.add(key, text, title)
+            with self._lock, self._connection:
+                self._connection.execute("INSERT OR REPLACE INTO sources (path, mtime) VALUES (?, ?)",
+                                         (str(file), mtime))
+        if logger is not None and added:
+            logger.info(f"Story index: {added} stories added from the archive")
+        return added
+
+    def log_stats(self, logger:logging.Logger|None) -> None:
+        """
+        Writes the size of the index and the stories added and looked up since it was opened to the logger.
+        """
+        if logger is None:
+            return
+        with self._lock:
+            total = self._connection.execute("SELECT COUNT(*) FROM stories").fetchone()[0]
+        logger.info(f"Story index: {total} stories, {self.added} added, {self.queries} lookups")
+
+    def close(self) -> None:
+        self._connection.close()
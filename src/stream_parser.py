@@ -0,0 +1,106 @@
+from typing import Any, Dict, List, Tuple
+import json
+
+class JsonFieldStream:
+    """
+    Incremental parser of the JSON object of an LLM answer (the ```json block asked by the
+    StructuredOutputParser format instructions). The answer is fed chunk by chunk while it is streamed and
+    every top-level field is returned as soon as its value is complete, so a page or an image prompt can be
+    used before the model has written the next ones.
+
+    The text before the first `{` (a fence or a sentence) is skipped. The complete answer is still parsed
+    by the StructuredOutputParser, the fields returned here are only an early copy of its values.
+    """
+    def __init__(self):
+        self.text = ""
+        self.fields: Dict[str, Any] = {}
+        self._i = 0
+        self._state = "start"
+        self._token_start = 0
+        self._escape = False
+        self._in_string = False
+        self._depth = 0
+        self._key = None
+
+    @property
+    def done(self) -> bool:
+        return self._state == "done"
+
+    def _emit(self, raw:str) -> Tuple[str, Any]:
+        try:
+            value = json.loads(raw)
+        except ValueError:
+            value = raw
+        self.fields[self._key] = value
+        self._state = "key"
+        return self._key, value
+
+    def feed(self, chunk:str) -> List[Tuple[str, Any]]:
+        """
+        Adds a chunk of the answer and returns the (key, value) of the fields completed by it.
+        """
+        self.text += chunk
+        text = self.text
+        completed = []
+        while self._i < len(text) and self._state != "done":
+            c = text[self._i]
+            state = self._state
+            if state == "start":
+                if c == "{":
+                    self._state = "key"
+            elif state == "key":
+                if c == '"':
+                    self._state = "key_string"
+                    self._token_start = self._i
+                elif c == "}":
+                    self._state = "done"
+            elif state in ("key_string", "value_string"):
+                if self._escape:
+                    self._escape = False
+                elif c == "\\":
+                    self._escape = True
+                elif c == '"':
+                    raw = text[self._token_start:self._i + 1]
+                    if state == "key_string":
+                        self._key = json.loads(raw)
+                        self._state = "colon"
+                    else:
+                        completed.append(self._emit(raw))
+            elif state == "colon":
+                if c == ":":
+                    self._state = "value"
+            elif state == "value":
+                if c == '"':
+                    self._state = "value_string"
+                    self._token_start = self._i
+                elif c in "{[":
+                    self._state = "value_nested"
+                    self._token_start = self._i
+                    self._depth = 1
+                    self._in_string = False
+                elif not c.isspace():
+                    self._state = "value_scalar"
+                    self._token_start = self._i
+            elif state == "value_nested":
+                if self._in_string:
+                    if self._escape:
+                        self._escape = False
+                    elif c == "\\":
+                        self._escape = True
+                    elif c == '"':
+                        self._in_string = False
+                elif c == '"':
+                    self._in_string = True
+                elif c in "{[":
+                    self._depth += 1
+                elif c in "}]":
+                    self._depth -= 1
+                    if self._depth == 0:
+                        completed.append(self._emit(text[self._token_start:self._i + 1]))
+            elif state == "value_scalar":
+                if c in ",}" or c.isspace():
+                    completed.append(self._emit(text[self._token_start:self._i]))
+                    if c == "}":
+                        self._state = "done"
+            self._i += 1
+        return completed
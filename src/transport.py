@@ -0,0 +1,155 @@
+from typing import Any, Dict, TYPE_CHECKING
+import importlib.util
+import threading
+import time
+import read_configuration as rc
+import metrics
+if TYPE_CHECKING:
+    import asyncio
+    import httpx
+# httpx is imported when the first client is built
+
+_client: "httpx.Client|None" = None
+_client_lock = threading.Lock()
+_local = threading.local()
+_values: rc.TransportConfig|None = None
+_rate_limit_values: rc.RateLimitConfig|None = None
+_limiter = None
+
+def configure(values:rc.TransportConfig, rate_limit_values:rc.RateLimitConfig|None = None) -> None:
+    """
+    Sets the values of the clients built from now on. Without it the [transport] and [rate_limit] sections
+    of configuration.ini are read when the first client is built.
+    """
+    global _values, _rate_limit_values
+    _values = values
+    _rate_limit_values = rate_limit_values
+
+def transport_values() -> rc.TransportConfig:
+    return _values if _values is not None else rc.load_configuration().transport
+
+def rate_limit_values() -> rc.RateLimitConfig:
+    return _rate_limit_values if _rate_limit_values is not None else rc.load_configuration().rate_limit
+
+def http2_available() -> bool:
+    # HTTP/2 needs the h2 package (httpx[http2])
+    return importlib.util.find_spec("h2") is not None
+
+def rate_limit_stats() -> Dict[str, Dict[str, float]]|None:
+    """
+    The concurrency, limits and 429s of every endpoint of the rate limiter, None before the first client.
+    """
+    return _limiter.stats() if _limiter is not None else None
+
+def _client_options(values:rc.TransportConfig, asynchronous:bool = False) -> Dict[str, Any]:
+    import httpx
+    http2 = values.http2 and http2_available()
+    limits = httpx.Limits(max_connections=values.max_connections,
+                          max_keepalive_connections=values.max_keepalive_connections,
+                          keepalive_expiry=values.keepalive_expiry)
+    options = {"timeout": httpx.Timeout(values.timeout, connect=values.connect_timeout), "follow_redirects": True}
+    limit_values = rate_limit_values()
+    if not limit_values.enabled:
+        options.update(http2=http2, limits=limits)
+        return options
+    # the OpenAI requests wait for the process-wide rate limiter (see rate_limiter.py)
+    import rate_limiter
+    global _limiter
+    shared = _limiter = rate_limiter.limiter(limit_values)
+    if asynchronous:
+        options["transport"] = rate_limiter.AsyncRateLimitedTransport(
+            httpx.AsyncHTTPTransport(http2=http2, limits=limits), shared)
+    else:
+        options["transport"] = rate_limiter.RateLimitedTransport(httpx.HTTPTransport(http2=http2, limits=limits),
+                                                                 shared)
+    return options
+
+class RequestTrace:
+    """
+    Follows one request through httpcore (the `trace` extension) to know whether it opened a new
+    connection or reused a pooled one, and records it as an `http_request` span.
+    """
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.start_time = time.time()
+        self.parent = metrics.current_parent()
+        self.new_connection = False
+        self.tls = False
+
+    def event(self, name:str) -> None:
+        if name == "connection.connect_tcp.started":
+            self.new_connection = True
+        elif name == "connection.start_tls.started":
+            self.tls = True
+
+    def __call__(self, name:str, info:Dict[str, Any]) -> None:
+        self.event(name)
+
+    def record(self, response:"httpx.Response", status:str = "ok") -> None:
+        metrics.record("http_request", time.perf_counter() - self.start, status=status, parent=self.parent,
+                       start=self.start_time, host=response.request.url.host, status_code=response.status_code,
+                       http_version=response.http_version, new_connection=int(self.new_connection),
+                       reused_connection=int(not self.new_connection), tls_handshake=int(self.tls))
+
+class AsyncRequestTrace(RequestTrace):
+    async def __call__(self, name:str, info:Dict[str, Any]) -> None:
+        self.event(name)
+
+def _on_request(request:"httpx.Request") -> None:
+    request.extensions["trace"] = RequestTrace()
+
+def _on_response(response:"httpx.Response") -> None:
+    trace = response.request.extensions.get("trace")
+    if isinstance(trace, RequestTrace):
+        trace.record(response)
+
+async def _on_async_request(request:"httpx.Request") -> None:
+    request.extensions["trace"] = AsyncRequestTrace()
+
+async def _on_async_response(response:"httpx.Response") -> None:
+    _on_response(response)
+
+def http_client() -> "httpx.Client":
+    """
+    The process-wide httpx client: keep-alive connections, HTTP/2 when h2 is installed and the pool limits
+    of the [transport] section. It is thread-safe and shared by the OpenAI clients and the image downloads.
+    """
+    global _client
+    with _client_lock:
+        if _client is None or _client.is_closed:
+            import httpx
+            _client = httpx.Client(event_hooks={"request": [_on_request], "response": [_on_response]},
+                                   **_client_options(transport_values()))
+        return _client
+
+def async_http_client() -> "httpx.AsyncClient":
+    """
+    The httpx async client of this thread, with the same options as `http_client`. Its connections belong
+    to the event loop of the thread (see `clients.run`), that is why there is one per thread.
+    """
+    client = getattr(_local, "client", None)
+    if client is None or client.is_closed:
+        import httpx
+        client = _local.client = httpx.AsyncClient(
+            event_hooks={"request": [_on_async_request], "response": [_on_async_response]},
+            **_client_options(transport_values(), asynchronous=True))
+    return client
+
+def close_async_http_client(loop:"asyncio.AbstractEventLoop|None" = None) -> None:
+    """
+    Closes the async client of this thread in its event loop (before the loop is closed) and drops it.
+    """
+    client = getattr(_local, "client", None)
+    _local.client = None
+    if client is not None and not client.is_closed and loop is not None and not loop.is_closed():
+        loop.run_until_complete(client.aclose())
+
+def close() -> None:
+    """
+    Closes the process-wide client. A new one is built if it is needed again.
+    """
+    global _client
+    with _client_lock:
+        if _client is not None:
+            _client.close()
+            _client = None
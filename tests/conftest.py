@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# the modules of src/ import each other by name, as main.py runs them
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
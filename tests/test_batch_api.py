@@ -0,0 +1,104 @@
+from pathlib import Path
+import sys
+import threading
+import time
+import uuid
+import pytest
+
+pytest.importorskip("openai")
+pytest.importorskip("langchain")
+sys.path.insert(0, str(Path(__file__).parent.parent / "benchmarks"))
+
+from fake_openai import FakeOpenAI
+import batch_api
+import history_generator as hg
+import prepare_prompt as pp
+import transport
+from read_configuration import BatchApiConfig, HistoryConfig, RateLimitConfig, TransportConfig
+
+base_dict_values = HistoryConfig(names=("Lydia",), birthdays=("2017-04-24",),
+                                 topics=("gatos",), include_moral_values=False, moral_values=("respeto",),
+                                 story_genere=("aventura",), language="CATALAN", pages=4, words_per_page=20,
+                                 questions=1)
+
+@pytest.fixture
+def fake():
+    server = FakeOpenAI(image_size=64, words_per_page=20, batch_latency="fixed:0.2").start()
+    yield server
+    server.stop()
+
+@pytest.fixture
+def collector(fake, tmp_path, monkeypatch):
+    # a new key gets a new OpenAI client, built with the URL of this server
+    api_key = f"fake-{uuid.uuid4().hex}"
+    monkeypatch.setenv("OPENAI_API_KEY", api_key)
+    monkeypatch.setenv("OPENAI_BASE_URL", fake.url)
+    transport.configure(TransportConfig(), RateLimitConfig(enabled=False))
+    batch = batch_api.BatchCollector(api_key, BatchApiConfig(enabled=True, poll_seconds=0.05, gather_seconds=0.05),
+                                     path=tmp_path)
+    yield batch
+    batch.close()
+    transport.configure(None, None)
+
+def test_stages_through_the_batch_api(fake, collector):
+    output_parser, output_prompts = pp.generate_prompts_for_chain(4, base_dict_values)
+    data = hg.llm_call_chain_for_history_generation(parser=output_parser, prompts=output_prompts,
+                                                    batch=collector)
+    assert set(data) == {"history_0"}
+    assert {f"history_{i}" for i in range(4)} | {"reasoning", "best_history"} <= set(data["history_0"])
+
+    data = hg.make_review(data, base_dict_values=base_dict_values, batch=collector)
+    pages = {f"page_{i}" for i in range(4)}
+    assert pages | {"reasoning", "title", "question_0"} <= set(data["history_0"])
+    assert all(isinstance(data["history_0"][page], str) and data["history_0"][page] for page in pages)
+
+    data = hg.make_prompt_images_after_review(data, base_dict_values=base_dict_values, batch=collector)
+    assert pages <= set(data["history_0"])
+    for i in range(3):
+        assert data["history_0"][f"prompt_image_{i}"]
+        assert data["history_0"][f"description_image_{i}"]
+
+    assert fake.stats["batches"] == 3
+    # no request went to the chat completions
+    assert fake.stats["chat"] == 0
+    assert sorted(path.name.split("_")[-1] for path in collector.path.iterdir()) == sorted(["input.jsonl", "output.jsonl"] * 3)
+
+def test_failed_row_is_an_error_of_its_history(fake, collector, monkeypatch):
+    request_line = batch_api.request_line
+    lines = []
+
+    def failing_request_line(custom_id, prompt_value, model, temperature):
+        line = request_line(custom_id, prompt_value, model, temperature)
+        lines.append(line)
+        if len(lines) == 2:
+            # the fake server answers any other url with an error line
+            line["url"] = "/v1/embeddings"
+        return line
+
+    monkeypatch.setattr(batch_api, "request_line", failing_request_line)
+    output_parser, output_prompts = pp.generate_prompts_for_chain(4, base_dict_values)
+    prompts = output_prompts * 2
+    data = hg.llm_call_chain_for_history_generation(parser=output_parser, prompts=prompts, batch=collector)
+    assert set(data) == {"history_0", "history_1"}
+    assert "best_history" in data["history_0"]
+    assert set(data["history_1"]) == {"error"}
+    assert "invalid_url" in data["history_1"]["error"]
+    assert sorted(path.name.split("_")[-1] for path in collector.path.iterdir()) == \
+        ["errors.jsonl", "input.jsonl", "output.jsonl"]
+
+def test_cancelled_batch_fails_its_requests(fake, collector):
+    def cancel():
+        while not fake.batches:
+            time.sleep(0.01)
+        fake.cancel_batch(next(iter(fake.batches)))
+
+    canceller = threading.Thread(target=cancel)
+    canceller.start()
+    output_parser, output_prompts = pp.generate_prompts_for_chain(4, base_dict_values)
+    data = hg.llm_call_chain_for_history_generation(parser=output_parser, prompts=output_prompts * 2,
+                                                    batch=collector)
+    canceller.join()
+    assert set(data) == {"history_0", "history_1"}
+    for details in data.values():
+        assert set(details) == {"error"}
+        assert "cancelled" in details["error"]
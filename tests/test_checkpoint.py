@@ -0,0 +1,126 @@
+from dataclasses import replace
+from pathlib import Path
+import sys
+import uuid
+import pytest
+
+pytest.importorskip("openai")
+pytest.importorskip("langchain")
+sys.path.insert(0, str(Path(__file__).parent.parent / "benchmarks"))
+
+from fake_openai import FakeOpenAI
+from checkpoint import Checkpoint
+from image_assets import ImageAssets
+import history_generator as hg
+import pipeline
+import prepare_prompt as pp
+import read_configuration as rc
+import transport
+
+base_dict_values = rc.HistoryConfig(names=("Lydia",), birthdays=("2017-04-24",),
+                                    topics=("gatos",), include_moral_values=False, moral_values=("respeto",),
+                                    story_genere=("aventura",), language="CATALAN", pages=4, words_per_page=20,
+                                    questions=1)
+stages = ("candidates", "review", "image_prompts")
+
+@pytest.fixture
+def fake(monkeypatch):
+    server = FakeOpenAI(image_size=64, words_per_page=20).start()
+    # a new key gets a new OpenAI client, built with the URL of this server
+    monkeypatch.setenv("OPENAI_API_KEY", f"fake-{uuid.uuid4().hex}")
+    monkeypatch.setenv("OPENAI_BASE_URL", server.url)
+    monkeypatch.setenv("OPENAI_API_BASE", server.url)
+    transport.configure(rc.TransportConfig(), rc.RateLimitConfig(enabled=False))
+    yield server
+    transport.configure(None, None)
+    server.stop()
+
+@pytest.fixture
+def calls(monkeypatch):
+    """
+    Counts the calls of every text stage and of the PDF renderer, which writes nothing.
+    """
+    calls = {stage: 0 for stage in stages + ("pdf",)}
+    # the prompts of the candidates are only built by their stage, the LLM call is shared by every stage
+    functions = {"candidates": (pp, "generate_prompts_for_chain"), "review": (hg, "make_review"),
+                 "image_prompts": (hg, "make_prompt_images_after_review")}
+    for stage, (module, name) in functions.items():
+        def counted(*args, _stage=stage, _function=getattr(module, name), **kwargs):
+            calls[_stage] += 1
+            return _function(*args, **kwargs)
+        monkeypatch.setattr(module, name, counted)
+
+    def render(data, **kwargs):
+        calls["pdf"] += 1
+    monkeypatch.setattr(pipeline, "pdf_renderer", lambda backend: render)
+    return calls
+
+def configuration() -> rc.Configuration:
+    configuration = rc.load_configuration()
+    return replace(configuration, images=replace(configuration.images, line_art=False),
+                   cache=replace(configuration.cache, llm_cache_candidates=False, llm_cache_review=False,
+                                 llm_cache_image_prompts=False))
+
+def run(checkpoint:Checkpoint) -> dict:
+    assets = ImageAssets(checkpoint.images_path)
+    try:
+        return pipeline.run_history("history_0", checkpoint.identifier, configuration(), base_dict_values,
+                                    checkpoint=checkpoint, assets=assets, verbose=False)
+    finally:
+        assets.close()
+
+def saved_stages(checkpoint:Checkpoint) -> list:
+    return [stage for stage in stages if checkpoint.has_stage(f"{stage}_history_0")]
+
+def test_resume_skips_the_saved_stages(tmp_path, fake, calls):
+    checkpoint = Checkpoint("run", path=tmp_path)
+    checkpoint.save_history_stage("candidates", "history_0", {"history_0": "Una", "history_1": "Dues",
+                                                             "history_2": "Tres", "history_3": "Quatre",
+                                                             "reasoning": "La segona.", "best_history": 1})
+    review = {"reasoning": "Bé.", "title": "El gat", "question_0": "Com es deia?",
+              **{f"page_{i}": f"Pàgina {i}." for i in range(4)}}
+    checkpoint.save_history_stage("review", "history_0", review)
+
+    details = run(checkpoint)
+    assert calls["candidates"] == calls["review"] == 0
+    assert calls["image_prompts"] == calls["pdf"] == 1
+    assert {key: details[key] for key in review} == review
+    assert saved_stages(checkpoint) == list(stages)
+    assert sorted(file.name for file in checkpoint.images_path.iterdir()) == \
+        [f"history_0_image_{i}.png" for i in range(3)]
+    assert all(isinstance(details[f"image_{i}"], Path) for i in range(3))
+    assert checkpoint.has_pdf("history_0")
+    images = fake.stats["images"]
+
+    # a finished history is not generated again, only its saved images are read
+    run(checkpoint)
+    assert calls["image_prompts"] == calls["pdf"] == 1
+    assert fake.stats["images"] == images
+
+    # a missing image and the PDF are done again
+    (checkpoint.images_path / "history_0_image_1.png").unlink()
+    (checkpoint.path / "pdf_history_0.done").unlink()
+    run(checkpoint)
+    assert calls["candidates"] == calls["review"] == 0
+    assert calls["image_prompts"] == 1
+    assert calls["pdf"] == 2
+    assert fake.stats["images"] == images + 1
+    assert (checkpoint.images_path / "history_0_image_1.png").exists()
+
+def test_stage_with_an_error_is_not_saved(tmp_path, fake, calls, monkeypatch):
+    checkpoint = Checkpoint("run", path=tmp_path)
+    make_review = hg.make_review
+    monkeypatch.setattr(hg, "make_review", lambda *args, **kwargs: {"history_0": {"error": "no answer"}})
+    with pytest.raises(Exception, match="Error generating review for history history_0: no answer"):
+        run(checkpoint)
+    assert calls["candidates"] == 1
+    assert saved_stages(checkpoint) == ["candidates"]
+    assert not checkpoint.has_pdf("history_0")
+
+    monkeypatch.setattr(hg, "make_review", make_review)
+    details = run(checkpoint)
+    assert calls["candidates"] == 1
+    assert calls["review"] == calls["image_prompts"] == calls["pdf"] == 1
+    assert saved_stages(checkpoint) == list(stages)
+    assert all(details[f"page_{i}"] for i in range(4))
+    assert checkpoint.has_pdf("history_0")
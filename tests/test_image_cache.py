@@ -0,0 +1,45 @@
+import os
+
+from image_cache import ImageCache
+
+def age(cache:ImageCache, key:str, mtime:float) -> None:
+    # the modification time of a file is its last use
+    os.utime(cache.path / f"{key}.png", (mtime, mtime))
+
+def test_key_depends_on_model_size_quality_and_prompt():
+    key = ImageCache.make_key("dall-e-3", "1024x1024", "standard", "un gat")
+    assert key == ImageCache.make_key("dall-e-3", "1024x1024", "standard", "un gat")
+    assert len({key, ImageCache.make_key("dall-e-2", "1024x1024", "standard", "un gat"),
+                ImageCache.make_key("dall-e-3", "512x512", "standard", "un gat"),
+                ImageCache.make_key("dall-e-3", "1024x1024", "hd", "un gat"),
+                ImageCache.make_key("dall-e-3", "1024x1024", "standard", "un gos")}) == 5
+
+def test_hit_and_miss(tmp_path):
+    cache = ImageCache(tmp_path)
+    assert cache.get("a") is None
+    cache.set("a", b"png")
+    assert cache.get("a") == b"png"
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert ImageCache(tmp_path).get("a") == b"png"
+    assert not list(tmp_path.glob("*.tmp"))
+
+def test_hit_marks_the_image_as_used(tmp_path):
+    cache = ImageCache(tmp_path)
+    cache.set("a", b"png")
+    age(cache, "a", 1000)
+    cache.get("a")
+    assert (tmp_path / "a.png").stat().st_mtime > 1000
+
+def test_size_bound_evicts_the_least_recently_used(tmp_path):
+    cache = ImageCache(tmp_path, max_bytes=30)
+    for i, key in enumerate("abc"):
+        cache.set(key, key.encode() * 10)
+        age(cache, key, 1000 + i)
+    cache.get("a")
+    # 40 bytes: b, the least recently used, goes first
+    cache.set("d", b"d" * 10)
+    assert sorted(file.stem for file in tmp_path.glob("*.png")) == ["a", "c", "d"]
+    assert sum(file.stat().st_size for file in tmp_path.glob("*.png")) <= 30
+    cache.set("e", b"e" * 25)
+    assert sorted(file.stem for file in tmp_path.glob("*.png")) == ["e"]
+    assert cache.get("b") is None
@@ -0,0 +1,28 @@
+import pytest
+
+from layout_memo import LayoutMemo
+
+def key(**kwargs) -> str:
+    values = dict(text="Hi havia una vegada", image_size=(400, 300), font="lmodern", widths=("0.75", "0.7"),
+                  title="El gat")
+    values.update(kwargs)
+    return LayoutMemo.make_key(**values)
+
+def test_key_depends_on_the_fit_method():
+    assert key() == key(fit="loop")
+    # the probe is an estimate of the page, its widths are not used by the compile loop
+    assert key(fit="loop") != key(fit="probe")
+    with pytest.raises(ValueError):
+        key(fit="guess")
+
+def test_key_depends_on_the_page():
+    assert len({key(), key(text="Fi"), key(image_size=(300, 400)), key(font="times"),
+                key(widths=("0.7",)), key(title=None)}) == 6
+
+def test_widths_are_kept_per_fit_method(tmp_path):
+    memo = LayoutMemo(tmp_path / "layout_memo.sqlite3")
+    memo.set(key(fit="loop"), "0.6")
+    assert memo.get(key(fit="probe")) is None
+    assert memo.get(key(fit="loop")) == "0.6"
+    assert (memo.hits, memo.misses) == (1, 1)
+    memo.close()
@@ -0,0 +1,72 @@
+import pytest
+
+import llm_cache
+from llm_cache import LLMCache
+
+class Clock:
+    def __init__(self, now:float = 1000.0):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(llm_cache.time, "time", clock)
+    return clock
+
+def test_key_depends_on_prompt_model_and_temperature():
+    key = LLMCache.make_key("hola", "gpt-4", 0.7)
+    assert key == LLMCache.make_key("hola", "gpt-4", 0.7)
+    assert len({key, LLMCache.make_key("adeu", "gpt-4", 0.7), LLMCache.make_key("hola", "gpt-3.5", 0.7),
+                LLMCache.make_key("hola", "gpt-4", 0.0)}) == 4
+
+def test_hit_and_miss(tmp_path, clock):
+    cache = LLMCache(tmp_path / "llm.sqlite3")
+    assert cache.get("a") is None
+    cache.set("a", "resposta")
+    assert cache.get("a") == "resposta"
+    cache.set("a", "una altra")
+    assert cache.get("a") == "una altra"
+    assert (cache.hits, cache.misses) == (2, 1)
+    cache.close()
+    # the answers are kept on disk
+    cache = LLMCache(tmp_path / "llm.sqlite3")
+    assert cache.get("a") == "una altra"
+    cache.close()
+
+def test_ttl_expiry(tmp_path, clock):
+    cache = LLMCache(tmp_path / "llm.sqlite3", ttl=60)
+    cache.set("a", "resposta")
+    clock.now += 60
+    assert cache.get("a") == "resposta"
+    # reading an answer does not extend its life
+    clock.now += 1
+    assert cache.get("a") is None
+    clock.now -= 10
+    assert cache.get("a") is None, "expired answers are deleted"
+    assert (cache.hits, cache.misses) == (1, 2)
+    cache.close()
+
+def test_least_recently_used_are_evicted(tmp_path, clock):
+    cache = LLMCache(tmp_path / "llm.sqlite3", max_bytes=30)
+    for key in "abc":
+        cache.set(key, key * 10)
+        clock.now += 1
+    assert cache.get("a") == "a" * 10
+    clock.now += 1
+    # 40 bytes: b, the least recently used, goes first
+    cache.set("d", "d" * 10)
+    assert cache.get("b") is None
+    assert [cache.get(key) for key in "acd"] == ["a" * 10, "c" * 10, "d" * 10]
+    clock.now += 1
+    cache.set("e", "e" * 25)
+    assert [cache.get(key) for key in "acde"] == [None, None, None, "e" * 25]
+    cache.close()
+
+def test_answer_larger_than_the_cache(tmp_path, clock):
+    cache = LLMCache(tmp_path / "llm.sqlite3", max_bytes=10)
+    cache.set("a", "a" * 11)
+    assert cache.get("a") is None
+    cache.close()
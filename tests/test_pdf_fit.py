@@ -0,0 +1,47 @@
+from pathlib import Path
+import io
+import shutil
+import pytest
+
+pytest.importorskip("pylatex")
+Image = pytest.importorskip("PIL.Image")
+if shutil.which("pdflatex") is None:
+    pytest.skip("pdflatex is not installed", allow_module_level=True)
+
+import pdf_generator
+
+# width x height of the images: from a landscape image that fits at the starting width
+# to portrait ones that only fit smaller, or not at all
+image_sizes = [(400, 300), (300, 400), (200, 360), (200, 420), (100, 400)]
+text = ("Hi havia una vegada un gat que vivia a la vora del riu i cada matí sortia a buscar "
+        "peixos amb els seus amics del bosc.")
+
+def histories(tmp_path:Path) -> tuple:
+    details = {"title": "El gat del riu", f"page_{len(image_sizes)}": "Fi."}
+    for j, size in enumerate(image_sizes):
+        image = tmp_path / f"image_{j}.png"
+        buffer = io.BytesIO()
+        Image.new("RGB", size, "white").save(buffer, format="PNG")
+        image.write_bytes(buffer.getvalue())
+        details[f"image_{j}"] = image
+        details[f"page_{j}"] = text * (1 + j % 2)
+    return {"gat": details}, len(image_sizes) + 1
+
+@pytest.mark.parametrize("precompiled_format", [True, False])
+def test_single_compile_fit_matches_compile_loop(tmp_path, precompiled_format):
+    data, number_of_pages = histories(tmp_path)
+    title = data["gat"]["title"]
+    build_dir = str(tmp_path / "build")
+    fitted = pdf_generator.fit_widths_single_compile(data, str(tmp_path / "fit"), title, "gat", number_of_pages,
+                                                     precompiled_format=precompiled_format, build_dir=build_dir)
+    for j in range(number_of_pages - 1):
+        if j == 0:
+            width = pdf_generator.number_of_pages_in_first_page(data, str(tmp_path / "first"), title, "gat",
+                                                                precompiled_format=precompiled_format,
+                                                                build_dir=build_dir)
+        else:
+            width = pdf_generator.number_of_pages_in_middle_page(data, str(tmp_path / "middle"), "gat",
+                                                                 f"image_{j}", f"page_{j}",
+                                                                 precompiled_format=precompiled_format,
+                                                                 build_dir=build_dir)
+        assert fitted[j] == width, f"page {j}"
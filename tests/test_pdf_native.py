@@ -0,0 +1,44 @@
+from pathlib import Path
+import base64
+import io
+import pytest
+
+pytest.importorskip("reportlab")
+Image = pytest.importorskip("PIL.Image")
+
+import pdf_native
+from read_configuration import HistoryConfig
+
+def history_values(pages:int) -> HistoryConfig:
+    return HistoryConfig(names=("Lydia",), birthdays=("2017-04-24",), topics=("gatos",),
+                         include_moral_values=False, moral_values=("respeto",), story_genere=("aventura",),
+                         language="CATALAN", pages=pages, words_per_page=20, questions=1)
+
+def png(path:Path|None = None) -> bytes:
+    buffer = io.BytesIO()
+    Image.new("RGB", (64, 48), "white").save(buffer, format="PNG")
+    if path is not None:
+        path.write_bytes(buffer.getvalue())
+    return buffer.getvalue()
+
+@pytest.fixture
+def output(tmp_path, monkeypatch):
+    # the books are written in out_put_test/ of the temporary directory, not of the repository
+    monkeypatch.setattr(pdf_native, "root_path", tmp_path)
+    return tmp_path / "out_put_test"
+
+@pytest.mark.parametrize("kind", ["path", "base64"])
+def test_two_page_book_with_image(tmp_path, output, kind):
+    image = tmp_path / "image_0.png"
+    content = png(image)
+    details = {"title": "El gat", "page_0": "Hi havia una vegada un gat.", "page_1": "Fi.",
+               "question_0": "Com es deia el gat?",
+               "image_0": image if kind == "path" else base64.b64encode(content).decode("ascii")}
+    identifier = f"test_native_{kind}"
+    pdf_native.generate_pdf({"history_0": details}, test_mode=True, identifier=identifier,
+                            base_dict_values=history_values(2))
+    assert [file.name for file in output.iterdir()] == [f"{identifier}_story_history_0.pdf"]
+    content = (output / f"{identifier}_story_history_0.pdf").read_bytes()
+    assert content.startswith(b"%PDF")
+    assert b"/Count 2" in content
+    assert b"/Subtype /Image" in content
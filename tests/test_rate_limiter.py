@@ -0,0 +1,184 @@
+import asyncio
+import threading
+import time
+import httpx
+import pytest
+
+import rate_limiter
+from read_configuration import RateLimitConfig
+
+chat_url = "https://api.openai.com/v1/chat/completions"
+chat_body = {"model": "gpt", "messages": [{"role": "user", "content": "hola"}], "max_tokens": 10}
+
+def limiter(**values) -> rate_limiter.RateLimiter:
+    values = {"backoff_base": 0.01, "backoff_max": 0.02, **values}
+    return rate_limiter.RateLimiter(RateLimitConfig(**values))
+
+class Server:
+    """
+    Answers the requests with the given responses in order (the last one for the rest) and counts them.
+    """
+    def __init__(self, *responses:httpx.Response, delay:float = 0.0):
+        self.responses = list(responses)
+        self.delay = delay
+        self.calls = 0
+        self.in_flight = 0
+        self.peak = 0
+        self._lock = threading.Lock()
+
+    def _answer(self) -> httpx.Response:
+        with self._lock:
+            index = min(self.calls, len(self.responses) - 1)
+            self.calls += 1
+        response = self.responses[index]
+        return httpx.Response(response.status_code, headers=response.headers, content=response.content)
+
+    def __call__(self, request:httpx.Request) -> httpx.Response:
+        with self._lock:
+            self.in_flight += 1
+            self.peak = max(self.peak, self.in_flight)
+        time.sleep(self.delay)
+        with self._lock:
+            self.in_flight -= 1
+        return self._answer()
+
+    async def handle_async(self, request:httpx.Request) -> httpx.Response:
+        self.in_flight += 1
+        self.peak = max(self.peak, self.in_flight)
+        await asyncio.sleep(self.delay)
+        self.in_flight -= 1
+        return self._answer()
+
+def client(server:Server, shared:rate_limiter.RateLimiter) -> httpx.Client:
+    return httpx.Client(transport=rate_limiter.RateLimitedTransport(httpx.MockTransport(server), shared))
+
+@pytest.mark.parametrize("value, seconds", [("1s", 1), ("6m0s", 360), ("20ms", 0.02), ("1.5", 1.5),
+                                            ("1h2m", 3720), ("", None), ("soon", None)])
+def test_parse_duration(value, seconds):
+    assert rate_limiter.parse_duration(value) == seconds
+
+def test_aimd_concurrency():
+    endpoint = rate_limiter.EndpointLimiter("chat", 0, 0, 4)
+    endpoint.on_response(429, {})
+    assert endpoint.concurrency == 2
+    endpoint.on_response(429, {})
+    endpoint.on_response(429, {})
+    assert endpoint.concurrency == 1
+    assert endpoint.rate_limited == 3
+    endpoint.on_response(200, {})
+    assert endpoint.concurrency == 2
+    endpoint.on_response(200, {})
+    assert endpoint.concurrency == 2.5
+    for _ in range(10):
+        endpoint.on_response(200, {})
+    assert endpoint.concurrency == 4
+    # errors other than 429 leave it as it is
+    endpoint.on_response(500, {})
+    assert endpoint.concurrency == 4
+
+def test_rate_limit_headers_update_the_budget():
+    endpoint = rate_limiter.EndpointLimiter("chat", 0, 0, 4)
+    assert endpoint.try_acquire(100) == 0
+    endpoint.on_response(200, {"x-ratelimit-limit-requests": "60", "x-ratelimit-remaining-requests": "0",
+                               "x-ratelimit-limit-tokens": "1000", "x-ratelimit-remaining-tokens": "500"})
+    assert endpoint.requests.limit == 60
+    assert endpoint.tokens.limit == 1000
+    assert endpoint.tokens.level == pytest.approx(500, abs=1)
+    # no request left: the next one waits about one second (60 per minute)
+    assert endpoint.try_acquire(100) == pytest.approx(1, abs=0.05)
+
+def test_backoff_follows_the_retry_headers():
+    shared = limiter(backoff_base=0.01, backoff_max=0.02)
+    assert shared.backoff(0, {"retry-after-ms": "1500", "retry-after": "9"}) == 1.5
+    assert shared.backoff(0, {"retry-after": "3"}) == 3
+    assert shared.backoff(0, {"x-ratelimit-reset-requests": "2s", "x-ratelimit-reset-tokens": "6m0s"}) == 360
+    assert 0.01 <= shared.backoff(5, {}) <= 0.02
+
+def test_retries_429_until_success():
+    server = Server(httpx.Response(429, headers={"retry-after-ms": "10"}),
+                    httpx.Response(429, headers={"retry-after-ms": "10"}),
+                    httpx.Response(200, headers={"x-ratelimit-limit-requests": "500"}, json={"ok": True}))
+    shared = limiter()
+    with client(server, shared) as http:
+        response = http.post(chat_url, json=chat_body)
+    assert response.status_code == 200
+    assert response.json() == {"ok": True}
+    assert server.calls == 3
+    endpoint = shared.endpoints["chat"]
+    assert endpoint.rate_limited == 2
+    assert endpoint.in_flight == 0
+    assert endpoint.requests.limit == 500
+
+def test_gives_up_after_max_retries():
+    server = Server(httpx.Response(429, headers={"retry-after-ms": "10"}))
+    with client(server, limiter(max_retries=2)) as http:
+        response = http.post(chat_url, json=chat_body)
+    assert response.status_code == 429
+    assert response.headers["x-should-retry"] == "false"
+    assert server.calls == 3
+
+def test_gives_up_on_insufficient_quota():
+    server = Server(httpx.Response(429, json={"error": {"code": "insufficient_quota"}}))
+    with client(server, limiter()) as http:
+        response = http.post(chat_url, json=chat_body)
+    assert response.status_code == 429
+    assert response.headers["x-should-retry"] == "false"
+    assert server.calls == 1
+
+def test_other_requests_are_not_limited():
+    server = Server(httpx.Response(429))
+    with client(server, limiter()) as http:
+        response = http.get("https://example.com/image.png")
+    assert response.status_code == 429
+    assert "x-should-retry" not in response.headers
+    assert server.calls == 1
+
+def test_threads_wait_for_a_free_slot():
+    endpoint = rate_limiter.EndpointLimiter("chat", 0, 0, 1)
+    assert endpoint.acquire(1) == 0
+    acquired = threading.Event()
+    waited = []
+    thread = threading.Thread(target=lambda: (waited.append(endpoint.acquire(1)), acquired.set()))
+    thread.start()
+    assert not acquired.wait(0.2)
+    endpoint.release()
+    assert acquired.wait(1)
+    thread.join()
+    assert waited[0] >= 0.2
+    assert endpoint.in_flight == 1
+
+def test_concurrency_limit_of_the_threads():
+    server = Server(httpx.Response(200), delay=0.05)
+    shared = limiter(max_concurrency=2)
+    with client(server, shared) as http:
+        threads = [threading.Thread(target=http.post, args=(chat_url,), kwargs={"json": chat_body})
+                   for _ in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    assert server.calls == 6
+    assert server.peak == 2
+    assert shared.endpoints["chat"].in_flight == 0
+
+def test_concurrency_limit_of_the_coroutines():
+    server = Server(httpx.Response(200), delay=0.05)
+    shared = limiter(max_concurrency=2)
+    transport = rate_limiter.AsyncRateLimitedTransport(httpx.MockTransport(server.handle_async), shared)
+
+    async def run():
+        async with httpx.AsyncClient(transport=transport) as http:
+            responses = await asyncio.gather(*(http.post(chat_url, json=chat_body) for _ in range(6)))
+        return [response.status_code for response in responses]
+
+    assert asyncio.run(run()) == [200] * 6
+    assert server.peak == 2
+    assert shared.endpoints["chat"].in_flight == 0
+
+def test_coroutine_woken_by_a_release_from_another_thread():
+    endpoint = rate_limiter.EndpointLimiter("chat", 0, 0, 1)
+    assert endpoint.acquire(1) == 0
+    threading.Timer(0.1, endpoint.release).start()
+    waited = asyncio.run(asyncio.wait_for(endpoint.acquire_async(1), 1))
+    assert waited >= 0.1
+    assert endpoint.in_flight == 1
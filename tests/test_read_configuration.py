@@ -0,0 +1,31 @@
+import datetime
+import re
+from types import SimpleNamespace
+
+import helper_functions as hf
+import read_configuration as rc
+
+def set_today(monkeypatch, year:int, month:int, day:int) -> None:
+    today = datetime.date(year, month, day)
+    monkeypatch.setattr(hf, "datetime", SimpleNamespace(date=SimpleNamespace(today=lambda: today)))
+
+def test_ages_are_computed_when_read(tmp_path, monkeypatch):
+    path = tmp_path / "configuration.ini"
+    path.write_text(re.sub(r"(?m)^BIRTHDAYS = .*$", "BIRTHDAYS = 2017-04-24",
+                           rc.default_path.read_text(encoding="utf-8")), encoding="utf-8")
+    set_today(monkeypatch, 2024, 4, 23)
+    configuration = rc.load_configuration(str(path))
+    assert configuration.history.number_of_years[0] == 6
+    # the same cached configuration, a day later
+    set_today(monkeypatch, 2024, 4, 24)
+    assert rc.load_configuration(str(path)) is configuration
+    assert configuration.history.number_of_years[0] == 7
+    assert configuration.history["number_of_years"][0] == 7
+    assert configuration.history.as_dict()["number_of_years"][0] == 7
+
+def test_ages_given_directly(monkeypatch):
+    set_today(monkeypatch, 2024, 4, 24)
+    values = rc.HistoryConfig(names=("Lydia",), birthdays=(), topics=("gatos",), include_moral_values=False,
+                              moral_values=("respeto",), story_genere=("aventura",), language="Catalan",
+                              pages=4, words_per_page=20, questions=1, ages=(5,))
+    assert values.number_of_years == (5,)
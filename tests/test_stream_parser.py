@@ -0,0 +1,67 @@
+import json
+import random
+import pytest
+
+from stream_parser import JsonFieldStream
+
+fields = {
+    "reasoning": "La història és \"bona\" però massa curta.\nAfegeixo detalls.",
+    "page_0": "Hi havia una vegada un gat anomenat Tomàs que vivia a la vora del riu.",
+    "page_1": "Un dia va trobar un camí \\ estret amb una porta màgica: á, è, ñ.",
+    "description_image_0": {"place": "riu", "characters": ["Tomàs", "la \"lluna\""], "size": [3, {"w": 2}]},
+    "prompt_image_0": "Dibuix per pintar: un gat {amb barret} i un riu [blau], sense colors.",
+    "best_history": 2,
+    "final": True,
+}
+
+def answer(escape_unicode:bool) -> str:
+    # the answer of the model for the StructuredOutputParser format instructions: a ```json fence with a
+    # tab-indented object
+    body = json.dumps(fields, indent="\t", ensure_ascii=escape_unicode)
+    return f"Aquí tens la resposta:\n```json\n{body}\n```"
+
+def stream(chunks) -> list:
+    parser = JsonFieldStream()
+    completed = []
+    for chunk in chunks:
+        completed.extend(parser.feed(chunk))
+    assert parser.done
+    return completed
+
+def check(completed:list, text:str) -> None:
+    from langchain.output_parsers import ResponseSchema, StructuredOutputParser
+    final = StructuredOutputParser.from_response_schemas(
+        [ResponseSchema(name=name, description=name) for name in fields]).parse(text)
+    keys = [key for key, _ in completed]
+    assert keys == list(fields)
+    assert dict(completed) == final == fields
+
+@pytest.mark.parametrize("escape_unicode", [True, False])
+def test_every_split_point(escape_unicode):
+    text = answer(escape_unicode)
+    # includes the splits inside strings, escape sequences (\", \\, á), nested values and the fence
+    for i in range(len(text) + 1):
+        check(stream([text[:i], text[i:]]), text)
+
+@pytest.mark.parametrize("escape_unicode", [True, False])
+def test_one_character_at_a_time(escape_unicode):
+    text = answer(escape_unicode)
+    check(stream(text), text)
+
+def test_random_chunks():
+    text = answer(True)
+    rng = random.Random(7)
+    for _ in range(200):
+        cuts = sorted(rng.sample(range(1, len(text)), rng.randint(1, 40)))
+        chunks = [text[start:end] for start, end in zip([0] + cuts, cuts + [len(text)])]
+        check(stream(chunks), text)
+
+def test_fields_are_returned_as_soon_as_complete():
+    parser = JsonFieldStream()
+    assert parser.feed('```json\n{"page_0": "Hi havia') == []
+    assert parser.feed(' una vegada", "page_1": "Fi') == [("page_0", "Hi havia una vegada")]
+    assert parser.feed('.", "questions": 2') == [("page_1", "Fi.")]
+    # a number is only complete once the next character arrives
+    assert parser.feed('}\n```') == [("questions", 2)]
+    assert parser.done
+    assert parser.feed('{"page_2": "no"}') == []